@@ -1,13 +1,40 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import mysql.connector
+from mysql.connector import errorcode
 import requests
 import json
 from datetime import datetime
 import os
 from fpdf import FPDF
 import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
+from db_pool import ConnectionPool, ReadRouter
+from db_query import (
+    PreparedStatements, QueryCancelled, date_range_bounds, fetch_dataframe, measure_transfer, query_budget,
+    staged_keys,
+)
+from db_write import bulk_insert, run_in_transaction
+from dup_keys import (
+    DUPLICATE_KEY_COLUMNS, VISIBLE_RETURN_SQL, DuplicateKeyIndex, DuplicateRowsError, duplicate_sequence, key_hashes,
+    key_hashes64, visible_sql,
+)
+from dup_key_file import SharedKeyFile
+from sales_snapshot import DEFAULT_LAG_DAYS, SalesSnapshot
+from sales_validation import fetch_rto_sales, fetch_rtv_sales
+from store_registry import STORE_CONFIG_QUERY, STORE_DATA_QUERY, StoreRegistry, normalize_store, parse_to_numbers
+from returned_qty import add_returned_qty, fetch_returned_qty, return_key_hashes, subtract_hidden_returns
+from migrations import column_exists, pending_migrations, run_migrations
+from change_log import (
+    SALES_RETURNS, SALES_RETURNS_HIDDEN, STORE_CONFIG, TRANSFER_OUT, UNVERSIONED_MAX_AGE, VersionedCache,
+    bump_versions, fetch_versions, hidden_version,
+)
+from archive import ARCHIVE_TABLE, HOT_TABLE, archive_exists, returns_params, returns_source, returns_tables
 
 
 # Set Page Title
@@ -81,80 +108,466 @@ except Exception as e:
 
 DB_CONFIG = st.secrets["db_config"]
 
-def fetch_all_data():
+# Pre-ping threshold, warm-up and keepalive for both pools ([db_pool] ping_after_idle,
+# warm_up, keepalive_seconds; keepalive_seconds = 0 turns the background pings off)
+def start_pool(pool, pool_config):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
+        pool.warm_up(int(pool_config.get("warm_up", 2)))
+    except mysql.connector.Error:
+        pass  # The first checkout connects (and reports the error) instead
+    keepalive_seconds = float(pool_config.get("keepalive_seconds", 300))
+    if keepalive_seconds > 0:
+        pool.start_keepalive(keepalive_seconds)
+    return pool
+
+# One connection pool per server process, shared by every session and rerun
+@st.cache_resource
+def get_db_pool():
+    pool_config = st.secrets.get("db_pool", {})
+    return start_pool(ConnectionPool(
+        DB_CONFIG,
+        size=int(pool_config.get("size", 10)),
+        checkout_timeout=float(pool_config.get("checkout_timeout", 30)),
+        compress=bool(pool_config.get("compress", False)),
+        ping_after_idle=float(pool_config.get("ping_after_idle", 60)),
+    ), pool_config)
+
+# Read-only pages use the optional db_config_replica; writes always go to the primary
+@st.cache_resource
+def get_read_router():
+    pool_config = st.secrets.get("db_pool", {})
+    replica = None
+    if "db_config_replica" in st.secrets:
+        replica = start_pool(ConnectionPool(
+            st.secrets["db_config_replica"],
+            size=int(pool_config.get("replica_size", pool_config.get("size", 10))),
+            checkout_timeout=float(pool_config.get("checkout_timeout", 30)),
+            compress=bool(pool_config.get("compress", False)),
+            ping_after_idle=float(pool_config.get("ping_after_idle", 60)),
+        ), pool_config)
+    return ReadRouter(
+        get_db_pool(),
+        replica,
+        sticky_seconds=float(pool_config.get("read_your_writes_seconds", 30)),
+    )
 
-        # Fetch full table data
-        cursor.execute("SELECT * FROM tbl_wh_sales_returns WHERE hidden <> 1;")
-        sales_returns_data = cursor.fetchall()
+def get_read_pool():
+    return get_read_router().for_read(st.session_state)
+
+# Call after every commit so this session keeps reading its own writes from the primary
+# (and this process's caches re-check the change log right away)
+def mark_primary_write():
+    get_read_router().mark_write(st.session_state)
+    get_change_cache().refresh()
+
+# Reference data shared by all sessions, reloaded only when tbl_wh_change_log shows a write.
+# Loaders read the primary so a lagging replica cannot be cached under a newer version.
+@st.cache_resource
+def get_change_cache():
+    interval = float(st.secrets.get("change_log", {}).get("check_interval", 2))
+    return VersionedCache(get_db_pool(), check_interval=interval)
+
+# tbl_store_data is not written by the app, so its ids are re-read on age alone
+STORE_DATA_MAX_AGE = 600
+
+# Store names, ids, active flags, addresses and max_to for every page (see store_registry.py).
+# With `fresh`, the change log is re-checked first - uploads number TOs from max_to.
+def get_store_registry(fresh=False):
+    cache = get_change_cache()
+    if fresh:
+        cache.refresh()
+    registry = cache.get("store_registry", [STORE_CONFIG], load_store_registry)
+    if registry.age() > STORE_DATA_MAX_AGE:
+        cache.invalidate("store_registry")
+        registry = cache.get("store_registry", [STORE_CONFIG], load_store_registry)
+    return registry
+
+# Hot queries prepared once per pooled connection (see get_statements().stats()). Only
+# statements on permanent tables: joins on staged_keys() tables stay plain queries, since
+# the server re-prepares a statement whenever a temporary table it reads is re-created
+PREPARED_STATEMENTS = {
+    "update_store_config": "UPDATE tbl_wh_store_config SET config = %s WHERE store_name = %s",
+    # Store lists and max_to behind the SR / TO page filters and the upload pages (StoreRegistry)
+    "store_config_list": STORE_CONFIG_QUERY,
+    "store_data_list": STORE_DATA_QUERY,
+    # Last TO per store, read inside the upload transaction (number_upload_batch)
+    "store_max_to": "SELECT store_name, max_to FROM tbl_wh_store_config",
+}
+
+@st.cache_resource
+def get_statements():
+    return PreparedStatements(PREPARED_STATEMENTS)
+
+# StoreRegistry.load() on the prepared store list statements
+def load_store_registry(conn):
+    statements = get_statements()
+    return StoreRegistry(
+        statements.fetch_dataframe(conn, "store_config_list"), statements.fetch_dataframe(conn, "store_data_list")
+    )
 
-        cursor.execute("SELECT * FROM tbl_wh_transfer_out;")
-        transfer_out_data = cursor.fetchall()
+# Per-page time budgets (seconds) for report queries; override under [query_timeouts] in secrets
+QUERY_TIMEOUTS = {"sr_page": 60, "to_page": 60, "sales_report": 60, "hidden_list": 30}
 
-        # Fetch max SR number per store
-        query = """ 
-        SELECT sr_no
-        FROM tbl_wh_sales_returns
-        WHERE id = (SELECT MAX(id) FROM tbl_wh_sales_returns);
-        """
-        cursor.execute(query)
-        row = cursor.fetchone()
-        sr_number = row["sr_no"] if row and "sr_no" in row else None
+# True once Streamlit has queued a rerun or stop (new widget input, closed tab) for the session.
+# Streamlit has no public API for this: ScriptRequests._state (a ScriptRequestType of
+# CONTINUE / STOP / RERUN) is private to the streamlit 1.x script runner. Anything
+# else - a renamed attribute or a new state - reads as "not requested", so a changed
+# Streamlit only loses early cancellation, never cancels a query that is still wanted.
+def session_rerun_requested(ctx):
+    try:
+        script_requests = getattr(ctx, "script_requests", None)
+        state = getattr(script_requests, "_state", None)
+        return getattr(state, "name", None) in ("STOP", "RERUN")
+    except Exception:
+        return False
+
+# Read connection for a report: statements are bounded by the page budget and
+# killed on the server when the session reruns or disconnects. With
+# db_pool.measure_transfer enabled, the bytes pulled from the server are shown too.
+@contextmanager
+def report_query(page):
+    pool = get_read_pool()
+    timeout = float(st.secrets.get("query_timeouts", {}).get(page, QUERY_TIMEOUTS[page]))
+    ctx = get_script_run_ctx()
+    with pool.connection() as conn:
+        with query_budget(conn, timeout, should_cancel=lambda: session_rerun_requested(ctx), kill_query=pool.kill_query):
+            if not st.secrets.get("db_pool", {}).get("measure_transfer", False):
+                yield conn
+                return
+            with measure_transfer(conn) as transfer:
+                yield conn
+    st.caption(
+        f"📡 {page}: {transfer['bytes_sent'] / 1024 ** 2:.2f} MB from database "
+        f"in {transfer['seconds']:.1f}s"
+    )
 
-        # Fetch store name mapping (lowercase to original case)
-        cursor.execute("SELECT store_name FROM tbl_wh_store_config;")
-        store_case_mapping = {row["store_name"].lower(): row["store_name"] for row in cursor.fetchall()}
+def show_query_cancelled(err):
+    if err.reason == "timeout":
+        st.warning(
+            f"⏱️ This report was stopped after {err.elapsed:.1f}s (limit {err.timeout:g}s). "
+            "Please narrow your date range or store selection and try again."
+        )
+    else:
+        st.info(f"⏹️ Report cancelled after {err.elapsed:.1f}s")
+
+# Apply pending schema migrations (indexes) once per server process when enabled in secrets;
+# table-rebuilding ones are left to the CLI and the server log says which are waiting
+@st.cache_resource
+def apply_schema_migrations():
+    with get_db_pool().connection() as conn:
+        applied = run_migrations(conn, log=lambda line: None, online_only=True)
+        for version, description in pending_migrations(conn):
+            print(f"⚠️ Migration {version} pending ({description}) - run 'python migrations.py run'")
+        return applied
+
+if st.secrets.get("migrations", {}).get("run_on_startup", False):
+    try:
+        apply_schema_migrations()
+    except mysql.connector.Error as err:
+        st.error(f"❌ Schema migration failed: {err}")
 
-        # Fetch max TO number per store
-        cursor.execute("SELECT store_name, max_to FROM tbl_wh_store_config GROUP BY store_name;")
-        to_numbers = {row["store_name"]: int(row["max_to"][2:]) for row in cursor.fetchall() if row["max_to"]}
+# Create (and warm) the pool on the first script run - usually the login page -
+# so the first data page does not wait for connections to open
+get_db_pool()
 
-        # Fetch max batch number (whole number only)
-        cursor.execute("SELECT MAX(batch_no) AS max_batch_no FROM tbl_wh_sales_returns;")
-        batch_result = cursor.fetchone()
-        max_batch_no = int(batch_result["max_batch_no"]) if batch_result["max_batch_no"] is not None else 0
+# Hidden and old returns live in the archive table once archive.py has run (migration 4)
+@st.cache_data(ttl=300)
+def archive_available():
+    try:
+        with get_db_pool().connection() as conn:
+            return archive_exists(conn)
+    except mysql.connector.Error:
+        return False
+
+# dup_key_hash / dup_key_seq and their unique index exist once migration 6 has run
+@st.cache_data(ttl=300)
+def duplicate_index_available():
+    try:
+        with get_db_pool().connection() as conn:
+            cursor = conn.cursor()
+            available = column_exists(cursor, "tbl_wh_sales_returns", "dup_key_seq")
+            cursor.close()
+            return available
+    except mysql.connector.Error:
+        return False
 
+# Uploaded store name -> tbl_store_data.id, so the validation queries can filter
+# tbl_sales on outlets_id instead of joining on the store name
+def resolve_store_ids(stores):
+    """
+    Map uploaded store names to tbl_store_data ids (case-insensitive).
+    tbl_store_data has no change-log version, so when a name is unknown the
+    registry is reloaded once before the name is reported.
+    
+    Returns:
+        tuple: (dict of store name -> id, sorted list of names with no store)
+    """
+    def lookup(registry):
+        store_ids, unknown = {}, []
+        for store in stores:
+            store_id = registry.store_id(store)
+            if store_id is None:
+                unknown.append(store)
+            else:
+                store_ids[store] = store_id
+        return store_ids, unknown
+
+    store_ids, unknown = lookup(get_store_registry())
+    if unknown:
+        # The store may have been added since the registry was loaded
+        get_change_cache().invalidate("store_registry")
+        store_ids, unknown = lookup(get_store_registry())
+    return store_ids, sorted(unknown)
+
+def stop_on_unknown_stores(uploaded_df):
+    # Report store names missing from tbl_store_data before any sales query runs
+    store_ids, unknown_stores = resolve_store_ids(uploaded_df["stores"].dropna().unique())
+    if unknown_stores:
+        st.error("❌ ❌ ❌ UNKNOWN STORES ❌ ❌ ❌")
+        st.error(f"⚠️ These stores do not exist in tbl_store_data: {', '.join(map(str, unknown_stores))}")
+        st.dataframe(uploaded_df[uploaded_df["stores"].isin(unknown_stores)], use_container_width=True)
+        st.error("🛑 Upload process stopped. Please correct the store names and try again.")
+        st.stop()
+    return store_ids
+
+# Temporary-table layouts for keys staged with staged_keys(); (table, column) entries
+# copy the type and collation of the production column they are joined to
+SR_KEY_COLUMNS = {"sr_no": ("tbl_wh_sales_returns", "sr_no")}
+# Bookkeeping columns of migration 6, dropped from SELECT * results shown to users
+DUP_KEY_COLUMNS = ["dup_key_hash", "dup_key_seq"]
+DUP_KEY_PROBE_COLUMNS = {"dup_key_hash": "BINARY(16)", "dup_key_seq": "SMALLINT UNSIGNED", "row_no": "INT"}
+STORE_MAX_TO_COLUMNS = {
+    "store_key": ("tbl_wh_store_config", "store_name"),
+    "store_name": ("tbl_wh_store_config", "store_name"),
+    "max_to": ("tbl_wh_store_config", "max_to"),
+}
+
+# Minimal single-purpose queries behind UploadDataContext
+def fetch_last_sr_number(conn):
+    cursor = conn.cursor()
+    if archive_available():
+        # The newest SR may already be archived (hidden right after upload)
+        cursor.execute(f"""
+            (SELECT id, sr_no FROM {HOT_TABLE} ORDER BY id DESC LIMIT 1)
+            UNION ALL
+            (SELECT id, sr_no FROM {ARCHIVE_TABLE} ORDER BY id DESC LIMIT 1)
+            ORDER BY id DESC LIMIT 1;
+        """)
+        row = cursor.fetchone()
         cursor.close()
-        conn.close()
+        return row[1] if row else None
+    cursor.execute("SELECT sr_no FROM tbl_wh_sales_returns ORDER BY id DESC LIMIT 1;")
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+def fetch_next_batch_no(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(batch_no) FROM tbl_wh_sales_returns;")
+    (max_batch_no,) = cursor.fetchone()
+    if archive_available():
+        cursor.execute(f"SELECT MAX(batch_no) FROM {ARCHIVE_TABLE};")
+        (archived_max,) = cursor.fetchone()
+        if archived_max is not None and (max_batch_no is None or int(archived_max) > int(max_batch_no)):
+            max_batch_no = archived_max
+    cursor.close()
+    return (int(max_batch_no) if max_batch_no is not None else 0) + 1
+
+# Duplicate-check keys of every visible return (hot + archive), held once per server
+# process - or, with [duplicate_index] path set, in memory-mapped files shared by all
+# processes on the host; each upload only reads the rows added since the previous one
+@st.cache_resource
+def get_duplicate_index():
+    index_config = st.secrets.get("duplicate_index", {})
+    if not index_config.get("path"):
+        return DuplicateKeyIndex()
+    key_file = SharedKeyFile(index_config["path"])
+    key_file.start_compaction(float(index_config.get("compact_interval", 300)))
+    return key_file
+
+def fetch_duplicate_index(conn):
+    # Without the change log (before migration 5) a hide cannot be seen: the index is
+    # rebuilt every [duplicate_index] unversioned_max_age seconds, else read incrementally
+    max_age = float(st.secrets.get("duplicate_index", {}).get("unversioned_max_age", UNVERSIONED_MAX_AGE))
+    return get_duplicate_index().refresh(
+        conn, hidden_version(fetch_versions(conn), max_age), returns_tables(archive_available())
+    )
 
-        return {
-            "sales_returns_df": pd.DataFrame(sales_returns_data),
-            "transfer_out_df": pd.DataFrame(transfer_out_data),
-            "sr_numbers": sr_number,
-            "to_numbers": to_numbers,
-            "store_case_mapping": store_case_mapping,
-            "next_batch_no": max_batch_no + 1
-        }
+# Optional local copy of the validation window ([sales_snapshot] in secrets), refreshed
+# in the background from the replica when there is one
+@st.cache_resource
+def get_sales_snapshot():
+    snapshot_config = st.secrets.get("sales_snapshot", {})
+    if not snapshot_config.get("path"):
+        return None
+    snapshot = SalesSnapshot(snapshot_config["path"], lag_days=int(snapshot_config.get("lag_days", DEFAULT_LAG_DAYS)))
+    refresh_interval = float(snapshot_config.get("refresh_interval", 3600))
+    if refresh_interval > 0:
+        router = get_read_router()
+        snapshot.start_refresh((router.replica or router.primary).connection, refresh_interval)
+    return snapshot
+
+# RTV / RTO validation rows: bills before the snapshot watermark from the snapshot,
+# newer ones live; the live queries alone without a (loaded) snapshot
+def fetch_rtv_validation(conn, key_tuples, outlet_ids):
+    snapshot = get_sales_snapshot()
+    since = snapshot.complete_before() if snapshot is not None else None
+    if since is None:
+        return fetch_rtv_sales(conn, key_tuples, outlet_ids)
+    recent = fetch_rtv_sales(conn, key_tuples, outlet_ids, since=since)
+    combined = pd.concat([snapshot.rtv_sales(key_tuples, outlet_ids), recent], ignore_index=True)
+    # A key can have lines on both sides of the watermark: sum them as the live query would
+    return combined.groupby(["stores", "bill no", "combination_id", "barcode"], as_index=False)["db_qty"].sum()
+
+def fetch_rto_validation(conn, key_tuples, outlet_ids):
+    snapshot = get_sales_snapshot()
+    since = snapshot.complete_before() if snapshot is not None else None
+    if since is None:
+        return fetch_rto_sales(conn, key_tuples, outlet_ids)
+    recent = fetch_rto_sales(conn, key_tuples, outlet_ids, since=since)
+    # Rows are per bill date, so the two sides never overlap
+    combined = pd.concat([snapshot.rto_sales(key_tuples, outlet_ids), recent], ignore_index=True)
+    combined["qty"] = combined["qty"].astype("float64")
+    return combined
+
+class UploadDataContext:
+    """
+    Reference data for one RTV/RTO upload.
 
-    except Exception as e:
-        st.error(f"❌ Error fetching data: {e}")
-        return {
-            "sales_returns_df": pd.DataFrame(),
-            "transfer_out_df": pd.DataFrame(),
-            "sr_numbers": {},
-            "to_numbers": {},
-            "store_case_mapping": {},
-            "next_batch_no": 1
-        }
-
-# Simple function to filter out inactive stores
-def filter_inactive_stores(uploaded_df):
-    try:
-        # Connect to database
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
-        # Fetch only active stores
-        cursor.execute("SELECT store_name FROM tbl_wh_store_config WHERE config = 1")
-        active_stores = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
+    Each property runs its own small query on first access and is reused for
+    the rest of the run. Once the upload's inputs are known, prefetch() runs
+    the independent queries side by side on separate pooled connections, so
+    the wait is the slowest query rather than their sum. On a database error
+    the property shows the error and falls back to an empty default.
+    """
+
+    LOADERS = {
+        "sr_number": (fetch_last_sr_number, None),
+        "next_batch_no": (fetch_next_batch_no, 1),
+        "duplicate_index": (fetch_duplicate_index, None),
+        "rtv_sales": (fetch_rtv_validation, None),
+        "rto_sales": (fetch_rto_validation, None),
+        "returned_qty": (fetch_returned_qty, None),
+    }
+
+    # Loaders that take no arguments and are needed by every upload that passes validation
+    PREP_LOADERS = ("sr_number", "next_batch_no")
+
+    def __init__(self, pool, max_workers=4):
+        self._pool = pool
+        self._max_workers = max_workers
+        self._values = {}
+        self._stores = None
+        self.prefetch_seconds = None
+
+    def _load(self, key):
+        # No Streamlit calls here: this may run in a prefetch worker thread
+        loader, default = self.LOADERS[key[0]]
+        try:
+            with self._pool.connection() as conn:
+                return loader(conn, *key[1:]), None
+        except Exception as e:
+            return default, e
+
+    def _store(self, key, result):
+        value, error = result
+        if error is not None:
+            st.error(f"❌ Error fetching {key[0].replace('_', ' ')}: {error}")
+        self._values[key] = value
+
+    def _get(self, name, *args):
+        key = (name,) + args
+        if key not in self._values:
+            self._store(key, self._load(key))
+        return self._values[key]
+
+    def prefetch(self, *requests):
+        """
+        Load several values at once, each on its own pooled connection.
         
+        Parameters:
+            requests: Loader names, or (name, *args) tuples for loaders with
+                arguments. Values already loaded are skipped.
+        """
+        keys = [request if isinstance(request, tuple) else (request,) for request in requests]
+        keys = [key for key in dict.fromkeys(keys) if key not in self._values]
+        if not keys:
+            return
+        ctx = get_script_run_ctx()
+
+        def run(key):
+            # Lets st.cache_data inside the loaders see this session
+            add_script_run_ctx(threading.current_thread(), ctx)
+            return self._load(key)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, len(keys))) as executor:
+            results = list(executor.map(run, keys))
+        self.prefetch_seconds = time.perf_counter() - started
+        for key, result in zip(keys, results):
+            self._store(key, result)
+
+    @property
+    def sr_number(self):
+        """SR number of the most recently inserted return (e.g. 'SR1234'); provisional, see number_upload_batch()."""
+        return self._get("sr_number")
+
+    @property
+    def stores(self):
+        """StoreRegistry as of this upload (the change log is re-checked once)."""
+        if self._stores is None:
+            try:
+                self._stores = get_store_registry(fresh=True)
+            except Exception as e:
+                st.error(f"❌ Error fetching store data: {e}")
+                st.stop()
+        return self._stores
+
+    @property
+    def to_numbers(self):
+        """Last TO sequence per store, from tbl_wh_store_config.max_to."""
+        return self.stores.to_numbers
+
+    @property
+    def store_case_mapping(self):
+        """Normalized store name (normalize_store) -> store name as configured."""
+        return self.stores.case_mapping
+
+    @property
+    def next_batch_no(self):
+        """Batch number to stamp on this upload; provisional, see number_upload_batch()."""
+        return self._get("next_batch_no")
+
+    @property
+    def active_stores(self):
+        """Names of stores with config = 1."""
+        return self.stores.active_stores
+
+    @property
+    def duplicate_index(self):
+        """DuplicateKeyIndex brought up to date for this upload (None if it could not be refreshed)."""
+        return self._get("duplicate_index")
+
+    def rtv_sales(self, key_tuples, outlet_ids):
+        """RTV validation rows (None on a database error); see fetch_rtv_validation()."""
+        return self._get("rtv_sales", tuple(key_tuples), tuple(outlet_ids))
+
+    def rto_sales(self, key_tuples, outlet_ids):
+        """RTO validation rows (None on a database error); see fetch_rto_validation()."""
+        return self._get("rto_sales", tuple(key_tuples), tuple(outlet_ids))
+
+    def returned_qty(self, key_hashes):
+        """Ledger key hash -> qty already returned (None before migration 9 or on a database error)."""
+        return self._get("returned_qty", tuple(key_hashes))
+
+# Simple function to filter out inactive stores (active_stores from UploadDataContext.active_stores)
+def filter_inactive_stores(uploaded_df, active_stores):
+    if active_stores is None:
+        # The lookup failed and was reported; keep the original DataFrame
+        return uploaded_df, pd.DataFrame()
+    try:
         # Create list of active store names (case insensitive)
-        active_store_list = [store['store_name'].lower() for store in active_stores]
+        active_store_list = [store.lower() for store in active_stores]
         uploaded_df['stores_lower'] = uploaded_df['stores'].str.lower()
         inactive_df = uploaded_df[~uploaded_df['stores_lower'].isin(active_store_list)].drop(columns=['stores_lower'])
         
@@ -174,63 +587,40 @@ def filter_inactive_stores(uploaded_df):
         st.error(f"❌ Error filtering stores: {e}")
         return uploaded_df, pd.DataFrame()  # Return original DataFrame if there's an error
 
-def check_duplicates(uploaded_df, db_df):
-    if db_df.empty:
+# duplicate_index comes from UploadDataContext.duplicate_index
+def check_duplicates(uploaded_df, duplicate_index):
+    if duplicate_index is None:
+        # The refresh failed and was reported; keep the original DataFrame
         return uploaded_df, pd.DataFrame()
     
-    working_df = uploaded_df.copy()
-    
-    column_mapping = {
-        "return_date": "date",
-        "outlet_name": "stores",
-        "bill_no": "bill no",
-        "combination_id": "combination_id",
-        "barcode": "barcode",
-    }
-    
     # Ensure mapped columns exist
-    for db_col, up_col in column_mapping.items():
-        if db_col not in db_df.columns or up_col not in working_df.columns:
-            st.error(f"❌ Missing column: {db_col} in database or {up_col} in uploaded file!")
+    for up_col in DUPLICATE_KEY_COLUMNS.values():
+        if up_col not in uploaded_df.columns:
+            st.error(f"❌ Missing column: {up_col} in uploaded file!")
             return uploaded_df, pd.DataFrame()
     
-    # Standardize column names
-    db_comparison = db_df.rename(columns=column_mapping).copy()
-    upload_comparison = working_df.copy()
+    # Look up the normalized (date, store, bill no, combination_id, barcode) keys
+    is_duplicate = duplicate_index.duplicate_mask(uploaded_df)
     
-    # Clean and standardize columns
-    for col in column_mapping.values():
-        if col == "date":
-            # ✅ FIX: Remove format parameter to handle any date format
-            upload_comparison[col] = pd.to_datetime(upload_comparison[col], errors='coerce').dt.strftime('%Y-%m-%d')
-            db_comparison[col] = pd.to_datetime(db_comparison[col], errors='coerce').dt.strftime('%Y-%m-%d')
-        else:
-            # ✅ FIX: Remove quotes, just normalize
-            upload_comparison[col] = upload_comparison[col].astype(str).str.strip().str.lower()
-            db_comparison[col] = db_comparison[col].astype(str).str.strip().str.lower()
-    
-    # Merge to find duplicates
-    merged_df = upload_comparison.merge(
-        db_comparison,
-        how="inner",
-        on=["date", "stores", "bill no", "combination_id", "barcode"]
-    )
-    
-    # Extract duplicate records
-    duplicate_indices = upload_comparison[
-        upload_comparison.set_index(["date", "stores", "bill no", "combination_id", "barcode"]).index.isin(
-            merged_df.set_index(["date", "stores", "bill no", "combination_id", "barcode"]).index
-        )
-    ].index
-    
-    duplicate_records = uploaded_df.loc[duplicate_indices].copy()
-    non_duplicate_df = uploaded_df.drop(duplicate_indices).copy()
+    duplicate_records = uploaded_df[is_duplicate].copy()
+    non_duplicate_df = uploaded_df[~is_duplicate].copy()
     
     if not duplicate_records.empty:
         st.warning(f"⚠️ Found {len(duplicate_records)} duplicate records. These will not be processed.")
     
     return non_duplicate_df, duplicate_records
 
+# Upload columns read as text whatever the cells hold: a numeric barcode would otherwise
+# come back as a float ('8901234.0') and hash differently from the stored one
+TEXT_UPLOAD_COLUMNS = ("barcode",)
+
+def read_upload(uploaded_file, reader, **kwargs):
+    # Header first, to find the text columns under the file's own spelling of their names
+    header = reader(uploaded_file, nrows=0, **kwargs).columns
+    uploaded_file.seek(0)
+    dtypes = {col: str for col in header if str(col).strip().lower() in TEXT_UPLOAD_COLUMNS}
+    return reader(uploaded_file, dtype=dtypes, **kwargs)
+
 # Function to assign SR numbers and return max SR per store
 def assign_sr_numbers(uploaded_df, sr_number):
     uploaded_df = uploaded_df.copy()
@@ -262,107 +652,103 @@ def assign_to_numbers(uploaded_df, to_dict, store_case_mapping):
     uploaded_df["to_no"] = ""  
     max_to_dict = {}
 
-    # Create a mapping of lowercase store names to their original names in the uploaded data
-    upload_store_mapping = {store.lower(): store for store in uploaded_df["stores"].unique()}
+    # Create a mapping of normalized store names (normalize_store) to their original names in the uploaded data
+    upload_store_mapping = {normalize_store(store): store for store in uploaded_df["stores"].unique()}
+    store_keys = uploaded_df["stores"].map(normalize_store)
 
-    for store_lower in [s.lower() for s in uploaded_df["stores"].unique()]:
+    for store_key in store_keys.unique():
         # --- SKIP BLR - WAREHOUSE ---
-        if store_lower == "blr - warehouse".lower():
+        if store_key == "blr - warehouse":
             continue  # Skip assigning any to_no
 
         # Get the original cased store name from the database, or from uploaded data
-        original_store = store_case_mapping.get(store_lower, upload_store_mapping.get(store_lower))
+        original_store = store_case_mapping.get(store_key, upload_store_mapping.get(store_key))
         
         # Determine the last TO number for this store (case-insensitive lookup)
         last_to = 0
         for db_store, to_num in to_dict.items():
-            if db_store.lower() == store_lower:
+            if normalize_store(db_store) == store_key:
                 last_to = to_num
                 break
                 
         # Assign new TO number
         new_to = f"TO{str(last_to + 1).zfill(3)}"
-        uploaded_df.loc[uploaded_df["stores"].str.lower() == store_lower, "to_no"] = new_to
+        uploaded_df.loc[store_keys == store_key, "to_no"] = new_to
         
         # Store the max TO for each store (with proper case)
         max_to_dict[original_store] = new_to
 
     return uploaded_df, max_to_dict
 
-def fetch_sales_data(DB_CONFIG, start_date, end_date, selected_stores):
+def fetch_sales_data(start_date, end_date, selected_stores, include_archive=False):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-
-        # Create placeholder string for IN clause
-        store_placeholders = ','.join(['%s'] * len(selected_stores))
-
-        # Updated sales_query_1 with filters
-        sales_query_1 = f"""
-        SELECT 
-            t1.design_no, 
-            t1.outlet_name, 
-            t2.item_name, 
-            t2.color, 
-            t2.polish, 
-            t2.size, 
-            SUM(t1.sold_qty) AS Qty,
-            SUM(t1.bill_amount) AS MRP_Amount,
-            t3.address,
-            t4.transfer_out_date,
-            t4.transfer_out_no,
-            SUM(t1.discount_amount) AS bill_discount
-        FROM tbl_wh_sales_returns t1
-        LEFT JOIN tbl_item_data t2 
-            ON t1.combination_id = t2.combination_id
-        LEFT JOIN tbl_wh_store_config t3
-            ON t1.outlet_name = t3.store_name
-        LEFT JOIN tbl_wh_transfer_out t4
-            ON t1.id = t4.id
-        WHERE date(t1.created_date) BETWEEN %s AND %s
-        AND t1.outlet_name IN ({store_placeholders})
-        AND (t1.hidden IS NULL OR t1.hidden = 0 OR t1.hidden = '')
-        GROUP BY 
-            t1.design_no, 
-            t1.outlet_name
-        """
+        # Store addresses come from the registry instead of a join on tbl_wh_store_config;
+        # resolved before report_query so a reload never waits for a second pooled connection
+        registry = get_store_registry()
+        with report_query("sales_report") as conn:
+            # Create placeholder string for IN clause
+            store_placeholders = ','.join(['%s'] * len(selected_stores))
+            # Date, store and hidden filters run inside each hot / archive branch
+            returns_filter = (
+                f"created_date >= %s AND created_date < %s AND outlet_name IN ({store_placeholders}) "
+                f"AND {VISIBLE_RETURN_SQL}"
+            )
+            returns_filter_params = returns_params(
+                list(date_range_bounds(start_date, end_date)) + selected_stores, include_archive
+            )
 
-        params1 = [start_date, end_date] + selected_stores
-        cursor.execute(sales_query_1, params1)
-        sales_data_1 = cursor.fetchall()
-        columns_1 = [desc[0] for desc in cursor.description]
-        df_sales_1 = pd.DataFrame(sales_data_1, columns=columns_1)
-
-        # Updated sales_query_2 with filters
-        sales_query_2 = f"""
-        SELECT 
-            t1.design_no AS Design,  
-            t2.item_name AS Product_name, 
-            SUM(t1.sold_qty) AS Qty,
-            SUM(t1.bill_amount) AS MRP_Amount,
-            t1.sr_no,
-            t1.returns_tran_refno
-        FROM tbl_wh_sales_returns t1
-        LEFT JOIN tbl_item_data t2 
-            ON t1.combination_id = t2.combination_id
-        WHERE date(t1.created_date) BETWEEN %s AND %s
-        AND t1.outlet_name IN ({store_placeholders})
-        AND (t1.hidden IS NULL OR t1.hidden = 0 OR t1.hidden = '')
-        GROUP BY 
-            t1.design_no
-        """
+            # Updated sales_query_1 with filters
+            sales_query_1 = f"""
+            SELECT 
+                t1.design_no, 
+                t1.outlet_name, 
+                t2.item_name, 
+                t2.color, 
+                t2.polish, 
+                t2.size, 
+                SUM(t1.sold_qty) AS Qty,
+                SUM(t1.bill_amount) AS MRP_Amount,
+                t4.transfer_out_date,
+                t4.transfer_out_no,
+                SUM(t1.discount_amount) AS bill_discount
+            FROM {returns_source(include_archive, returns_filter)} t1
+            LEFT JOIN tbl_item_data t2 
+                ON t1.combination_id = t2.combination_id
+            LEFT JOIN tbl_wh_transfer_out t4
+                ON t1.id = t4.id
+            GROUP BY 
+                t1.design_no, 
+                t1.outlet_name
+            """
 
-        params2 = [start_date, end_date] + selected_stores
-        cursor.execute(sales_query_2, params2)
-        sales_data_2 = cursor.fetchall()
-        columns_2 = [desc[0] for desc in cursor.description]
-        df_sales_2 = pd.DataFrame(sales_data_2, columns=columns_2)
+            df_sales_1 = fetch_dataframe(conn, sales_query_1, returns_filter_params)
+            df_sales_1.insert(
+                df_sales_1.columns.get_loc("MRP_Amount") + 1, "address", df_sales_1["outlet_name"].map(registry.address)
+            )
 
-        cursor.close()
-        conn.close()
+            # Updated sales_query_2 with filters
+            sales_query_2 = f"""
+            SELECT 
+                t1.design_no AS Design,  
+                t2.item_name AS Product_name, 
+                SUM(t1.sold_qty) AS Qty,
+                SUM(t1.bill_amount) AS MRP_Amount,
+                t1.sr_no,
+                t1.returns_tran_refno
+            FROM {returns_source(include_archive, returns_filter)} t1
+            LEFT JOIN tbl_item_data t2 
+                ON t1.combination_id = t2.combination_id
+            GROUP BY 
+                t1.design_no
+            """
+
+            df_sales_2 = fetch_dataframe(conn, sales_query_2, returns_filter_params)
 
         return df_sales_1, df_sales_2
 
+    except QueryCancelled as err:
+        show_query_cancelled(err)
+        return None, None
     except mysql.connector.Error as err:
         st.write("❌ Error fetching sales data:", err)
         return None, None
@@ -373,6 +759,8 @@ def insert_data_transactional(connection, cursor, df, table_name):
     """
     Inserts data from a DataFrame into a specified MySQL table within an existing transaction.
     Does NOT commit - commit is handled by the calling function.
+    Uses db_write.bulk_insert: multi-row VALUES batches, or LOAD DATA LOCAL INFILE
+    for large frames when the server allows it.
     
     Parameters:
         connection: Active MySQL connection object
@@ -381,29 +769,381 @@ def insert_data_transactional(connection, cursor, df, table_name):
         table_name (str): The name of the target table
     
     Returns:
-        int: Number of rows inserted
+        dict: rows, seconds, rows_per_sec and strategy used
         
     Raises:
-        Exception: Any database error during insertion
+        mysql.connector.Error: Any database error during insertion
+        Exception: Any other error, with the table name
     """
     try:
-        columns = ", ".join(df.columns)
-        placeholders = ", ".join(["%s"] * len(df.columns))
-        
-        query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-        
-        values = [tuple(row) for row in df.to_numpy()]
-        
-        cursor.executemany(query, values)
-        
-        rows_affected = cursor.rowcount
-        
-        return rows_affected
+        return bulk_insert(cursor, df, table_name)
         
+    except mysql.connector.Error:
+        # Unchanged, so callers can still tell duplicate keys and lock conflicts by errno
+        raise
     except Exception as e:
         raise Exception(f"Error inserting data into {table_name}: {str(e)}")
 
 
+def upsert_store_max_to(connection, cursor, max_to_dict):
+    """
+    Set max_to for every uploaded store in tbl_wh_store_config within an existing transaction.
+    Stores are matched case-insensitively; stores missing from the table are inserted.
+    Runs as one staged-key UPDATE JOIN plus one INSERT ... SELECT instead of a
+    query per store, so the config rows are locked only briefly.
+    Does NOT commit - commit is handled by the calling function.
+    
+    Parameters:
+        connection: Active MySQL connection object
+        cursor: Active cursor from the connection
+        max_to_dict (dict): Store name -> new max TO number (e.g. 'TO012')
+    
+    Returns:
+        int: Number of stores updated or inserted
+        
+    Raises:
+        Exception: Any database error during the upsert
+    """
+    # One row per normalized store key; the first spelling is kept for inserts
+    staged = {}
+    for store, max_to in max_to_dict.items():
+        staged.setdefault(store.strip().lower(), (store.strip(), max_to))
+    if not staged:
+        return 0
+
+    try:
+        rows = [(key, store, max_to) for key, (store, max_to) in staged.items()]
+        with staged_keys(connection, "tmp_store_max_to", STORE_MAX_TO_COLUMNS, rows) as keys:
+            cursor.execute(
+                f"""
+                UPDATE tbl_wh_store_config c
+                INNER JOIN {keys} k ON LOWER(TRIM(c.store_name)) = k.store_key
+                SET c.max_to = k.max_to
+                """
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO tbl_wh_store_config (store_name, max_to)
+                SELECT k.store_name, k.max_to
+                FROM {keys} k
+                LEFT JOIN tbl_wh_store_config c ON LOWER(TRIM(c.store_name)) = k.store_key
+                WHERE c.store_name IS NULL
+                """
+            )
+        return len(rows)
+    except Exception as e:
+        raise Exception(f"Error updating store configuration: {str(e)}")
+
+
+def stage_upload_batch(connection, cursor, sr_df, to_df):
+    """
+    Bulk-load an upload into session TEMPORARY staging tables shaped like the
+    production tables (CREATE ... LIKE). Touches no production rows, so it runs
+    before - and outside - the upload transaction. Each staged row gets its
+    1-based position in the frame as id (not copied to production), the key
+    renumber_staged_rows() updates by.
+    
+    Parameters:
+        connection: Active MySQL connection object
+        cursor: Active cursor from the connection
+        sr_df (pd.DataFrame): Validated rows for tbl_wh_sales_returns
+        to_df (pd.DataFrame): Validated rows for tbl_wh_transfer_out
+    """
+    for df, table_name in ((sr_df, "tbl_wh_sales_returns"), (to_df, "tbl_wh_transfer_out")):
+        staging_table = STAGING_TABLES[table_name]
+        with st.spinner(f"Staging {len(df)} rows for {table_name}..."):
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {staging_table}")
+            cursor.execute(f"CREATE TEMPORARY TABLE {staging_table} LIKE {table_name}")
+            result = insert_data_transactional(
+                connection, cursor, df.assign(id=range(1, len(df) + 1)), staging_table
+            )
+            st.info(f"✓ Staged {result['rows']} records for {table_name} "
+                    f"({result['rows_per_sec']:,.0f} rows/s, {result['strategy']})")
+
+
+def renumber_staged_rows(connection, sr_df, to_df):
+    """
+    Put number_upload_batch()'s numbers on rows staged with older ones: one
+    UPDATE per staging table, joined on the row id from stage_upload_batch().
+    Only the narrow (id, number, batch_no) keys are sent, not the rows again.
+    
+    Parameters:
+        connection: Active MySQL connection object
+        sr_df (pd.DataFrame): Rows as staged, with the new sr_no / batch_no
+        to_df (pd.DataFrame): Rows as staged, with the new transfer_out_no / batch_no
+    """
+    for df, table_name, number_column in (
+        (sr_df, "tbl_wh_sales_returns", "sr_no"),
+        (to_df, "tbl_wh_transfer_out", "transfer_out_no"),
+    ):
+        if df.empty:
+            continue
+        rows = [
+            (row_id, number, int(batch_no))
+            for row_id, (number, batch_no) in enumerate(zip(df[number_column], df["batch_no"]), start=1)
+        ]
+        columns = {"id": "INT", "number": (table_name, number_column), "batch_no": "INT"}
+        with staged_keys(connection, "tmp_staged_numbers", columns, rows) as keys:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(
+                    f"""
+                    UPDATE {STAGING_TABLES[table_name]} s
+                    INNER JOIN {keys} k ON s.id = k.id
+                    SET s.{number_column} = k.number, s.batch_no = k.batch_no
+                    """
+                )
+            finally:
+                cursor.close()
+
+
+def probe_duplicate_rows(connection, sr_df):
+    """
+    Rows of `sr_df` whose (dup_key_hash, dup_key_seq) is already taken in
+    tbl_wh_sales_returns - one unique-index lookup per uploaded row.
+    A locking read (FOR SHARE): it sees rows committed after the transaction's
+    snapshot, e.g. by the upload whose keys just made an INSERT fail, and
+    holds the keys it found absent until commit.
+    
+    Parameters:
+        connection: Active MySQL connection object
+        sr_df (pd.DataFrame): Validated rows carrying dup_key_seq
+    
+    Returns:
+        pd.DataFrame: The colliding rows of sr_df (empty when none)
+    """
+    hashes = key_hashes(sr_df)
+    rows = [
+        (key_hash, int(seq), row_no)
+        for row_no, (key_hash, seq) in enumerate(zip(hashes, sr_df["dup_key_seq"]))
+    ]
+    with staged_keys(connection, "tmp_dup_probe", DUP_KEY_PROBE_COLUMNS, rows) as keys:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"""
+            SELECT k.row_no FROM {keys} k
+            INNER JOIN tbl_wh_sales_returns r
+                ON r.dup_key_hash = k.dup_key_hash AND r.dup_key_seq = k.dup_key_seq
+            FOR SHARE
+            """
+        )
+        collided = sorted(row[0] for row in cursor.fetchall())
+        cursor.close()
+    return sr_df.iloc[collided]
+
+
+def move_staged_rows(cursor, df, table_name):
+    # One server-side INSERT ... SELECT from the staging table filled by stage_upload_batch()
+    columns = ", ".join(df.columns)
+    cursor.execute(f"INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {STAGING_TABLES[table_name]}")
+    return cursor.rowcount
+
+
+def insert_upload_rows(connection, cursor, sr_df, to_df, staged):
+    # Steps 1-2 of write_upload_batch(): returns (rows in tbl_wh_sales_returns, rows in tbl_wh_transfer_out)
+    if staged:
+        # Steps 1-2: Move the staged rows server-side
+        with st.spinner("Moving staged rows into tbl_wh_sales_returns and tbl_wh_transfer_out..."):
+            rows_sr = move_staged_rows(cursor, sr_df, "tbl_wh_sales_returns")
+            rows_to = move_staged_rows(cursor, to_df, "tbl_wh_transfer_out")
+            st.info(f"✓ Moved {rows_sr} records to tbl_wh_sales_returns and {rows_to} to tbl_wh_transfer_out")
+    else:
+        # Step 1: Insert into tbl_wh_sales_returns
+        with st.spinner("Inserting into tbl_wh_sales_returns..."):
+            result_sr = insert_data_transactional(connection, cursor, sr_df, "tbl_wh_sales_returns")
+            rows_sr = result_sr["rows"]
+            st.info(f"✓ Prepared {rows_sr} records for tbl_wh_sales_returns "
+                    f"({result_sr['rows_per_sec']:,.0f} rows/s, {result_sr['strategy']})")
+
+        # Step 2: Insert into tbl_wh_transfer_out
+        with st.spinner("Inserting into tbl_wh_transfer_out..."):
+            result_to = insert_data_transactional(connection, cursor, to_df, "tbl_wh_transfer_out")
+            rows_to = result_to["rows"]
+            st.info(f"✓ Prepared {rows_to} records for tbl_wh_transfer_out "
+                    f"({result_to['rows_per_sec']:,.0f} rows/s, {result_to['strategy']})")
+
+    return rows_sr, rows_to
+
+
+def lock_upload_numbering(cursor):
+    """
+    Lock the upload numbering row of UPLOAD_LOCK_TABLE (SELECT ... FOR UPDATE)
+    until the transaction ends.
+
+    Returns:
+        bool: False when the table does not exist yet (before migration 11)
+    """
+    try:
+        cursor.execute(f"SELECT name FROM {UPLOAD_LOCK_TABLE} WHERE name = %s FOR UPDATE", (UPLOAD_LOCK_NAME,))
+        return cursor.fetchone() is not None
+    except mysql.connector.Error as err:
+        if err.errno != errorcode.ER_NO_SUCH_TABLE:
+            raise
+        return False
+
+
+def number_upload_batch(connection, cursor, uploaded_df, sr_df, to_df):
+    """
+    Give an upload its final SR, TO and batch numbers inside the write transaction.
+
+    The numbers shown before the write come from a snapshot read before
+    validation; another upload may have committed since. SR and batch
+    numbers are global sequences (last committed + 1), so uploads take
+    their numbers one after the other: the first statement locks the single
+    numbering row of UPLOAD_LOCK_TABLE, and only then are the last SR, batch
+    and per-store TO numbers read. The locking read comes before InnoDB
+    takes the read snapshot, so the reads after it see every upload
+    committed before the lock was granted. tbl_wh_store_config is only read,
+    so the Config page is not held up by uploads. Before migration 11 the
+    store config rows are locked instead. A retried attempt numbers again.
+
+    Rows are matched on the upload's index: sr_df has the upload's rows and
+    to_df a subset of them (the rows with a to_no).
+    
+    Parameters:
+        connection: Active MySQL connection object
+        cursor: Active cursor from the connection
+        uploaded_df (pd.DataFrame): Validated upload (stores, to_no), in sr_df row order
+        sr_df (pd.DataFrame): Rows for tbl_wh_sales_returns
+        to_df (pd.DataFrame): Rows for tbl_wh_transfer_out (the uploaded rows with a to_no)
+    
+    Returns:
+        tuple: (sr_df, to_df, max_to_dict, changed) - copies with the final numbers;
+        changed is True when they differ from the ones the frames came with
+    """
+    if not uploaded_df.index.is_unique or not sr_df.index.equals(uploaded_df.index):
+        raise ValueError("sr_df must hold the upload's rows under the upload's unique index")
+    if not lock_upload_numbering(cursor):
+        cursor.execute("SELECT store_name FROM tbl_wh_store_config FOR UPDATE")
+        cursor.fetchall()
+    config_rows = get_statements().execute(connection, "store_max_to").fetchall()
+    case_mapping = {normalize_store(name): name for name, _ in config_rows if name is not None}
+    batch_no = fetch_next_batch_no(connection)
+
+    numbered_df = assign_sr_numbers(uploaded_df, fetch_last_sr_number(connection))
+    numbered_df, max_to_dict = assign_to_numbers(numbered_df, parse_to_numbers(config_rows), case_mapping)
+
+    new_sr_df = sr_df.copy()
+    new_sr_df["sr_no"] = numbered_df["sr_no"]
+    new_sr_df["batch_no"] = batch_no
+    new_to_df = to_df.copy()
+    # KeyError for a to_df row that is not in the upload
+    new_to_df["transfer_out_no"] = numbered_df.loc[to_df.index, "to_no"]
+    if (new_to_df["transfer_out_no"] == "").any():
+        raise ValueError("to_df holds upload rows that get no TO number")
+    new_to_df["batch_no"] = batch_no
+
+    changed = not (
+        new_sr_df[["sr_no", "batch_no"]].equals(sr_df[["sr_no", "batch_no"]])
+        and new_to_df[["transfer_out_no", "batch_no"]].equals(to_df[["transfer_out_no", "batch_no"]])
+    )
+    return new_sr_df, new_to_df, max_to_dict, changed
+
+
+def write_upload_batch(connection, cursor, uploaded_df, sr_df, to_df, procedure_name, staged=False):
+    """
+    Write phase of an RTV/RTO upload: numbering (number_upload_batch), both
+    inserts, the stored procedure and the store max_to update. Does NOT
+    commit - run it through run_in_transaction, which commits and re-runs it
+    after a deadlock or lock wait timeout.
+    With `staged`, the rows were already loaded by stage_upload_batch() and are
+    moved with INSERT ... SELECT, keeping the locks on the hot tables short.
+    
+    Parameters:
+        connection: Active MySQL connection object
+        cursor: Active cursor from the connection
+        uploaded_df (pd.DataFrame): Validated upload the frames were built from
+        sr_df (pd.DataFrame): Validated rows for tbl_wh_sales_returns
+        to_df (pd.DataFrame): Validated rows for tbl_wh_transfer_out
+        procedure_name (str): UpdateSalesReturns1 (RTV) or UpdateSalesReturns (RTO)
+        staged (bool): Move rows from the staging tables instead of sending them
+    
+    Returns:
+        tuple: (rows inserted into tbl_wh_sales_returns, rows inserted into tbl_wh_transfer_out,
+        sr_df as written, max_to_dict as written)
+    """
+    st.info("🔄 Starting transaction...")
+
+    # Numbers first: the numbering lock orders concurrent uploads before anything else is read
+    sr_df, to_df, max_to_dict, renumbered = number_upload_batch(connection, cursor, uploaded_df, sr_df, to_df)
+    if renumbered:
+        st.info("🔢 Another upload committed meanwhile - SR/TO/batch numbers were reassigned")
+        if staged:
+            # The staging tables hold the old numbers; temporary tables take no locks on the hot tables
+            renumber_staged_rows(connection, sr_df, to_df)
+
+    # With the unique duplicate-key index, refuse rows another upload has committed meanwhile
+    if "dup_key_seq" in sr_df.columns:
+        collided = probe_duplicate_rows(connection, sr_df)
+        if not collided.empty:
+            raise DuplicateRowsError(collided)
+
+    try:
+        rows_sr, rows_to = insert_upload_rows(connection, cursor, sr_df, to_df, staged)
+    except mysql.connector.Error as err:
+        # A concurrent upload committed the same keys after the probe; the index refused them
+        if err.errno != errorcode.ER_DUP_ENTRY or "dup_key_seq" not in sr_df.columns:
+            raise
+        collided = probe_duplicate_rows(connection, sr_df)
+        if collided.empty:
+            raise
+        raise DuplicateRowsError(collided) from err
+
+    # Count the new returns in the returned-qty ledger used by RTV quantity validation
+    add_returned_qty(cursor, sr_df)
+
+    # Step 3: Call the stored procedure (RTV and RTO use different ones)
+    with st.spinner(f"Executing stored procedure {procedure_name}..."):
+        call_stored_procedure_transactional(cursor, procedure_name)
+        st.info(f"✓ Stored procedure {procedure_name} executed")
+
+    # Step 4: Update store max TO numbers in the same transaction
+    with st.spinner("Updating store configuration..."):
+        upsert_store_max_to(connection, cursor, max_to_dict)
+        st.info("✓ Store configuration updated")
+
+    if staged:
+        # Not transactional, but a rollback leaves nothing behind that a retry's re-stage would not replace
+        for staging_table in STAGING_TABLES.values():
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {staging_table}")
+
+    # Last step: tell every app instance's caches that these tables changed
+    bump_versions(cursor, [SALES_RETURNS, TRANSFER_OUT, STORE_CONFIG])
+
+    return rows_sr, rows_to, sr_df, max_to_dict
+
+
+# Row locked by each upload while it takes SR / TO / batch numbers (migration 11)
+UPLOAD_LOCK_TABLE = "tbl_wh_upload_lock"
+UPLOAD_LOCK_NAME = "upload_numbering"
+
+# Session staging tables used when [upload] staging is enabled (the default)
+STAGING_TABLES = {
+    "tbl_wh_sales_returns": "stg_wh_sales_returns",
+    "tbl_wh_transfer_out": "stg_wh_transfer_out",
+}
+
+# Worker threads (each holding a pooled connection) for UploadDataContext.prefetch()
+def prefetch_workers():
+    return int(st.secrets.get("upload", {}).get("prefetch_workers", 4))
+
+def upload_staging_enabled():
+    return bool(st.secrets.get("upload", {}).get("staging", True))
+
+
+def write_retry_settings():
+    retry_config = st.secrets.get("write_retry", {})
+    return {
+        "attempts": int(retry_config.get("attempts", 4)),
+        "base_delay": float(retry_config.get("base_delay", 0.25)),
+        "max_delay": float(retry_config.get("max_delay", 4.0)),
+    }
+
+
+def show_write_retry(attempt, error, delay):
+    st.warning(f"🔁 Lock conflict on attempt {attempt} ({error}) - retrying the write in {delay:.2f}s...")
+
+
 def call_stored_procedure_transactional(cursor, procedure_name):
     """
     Calls a stored procedure within an existing transaction.
@@ -885,15 +1625,13 @@ def display_sales_return_pdfs(df_sales_2):
         st.markdown(download_link, unsafe_allow_html=True)
 
 # Function to search SR by sr_no (supports multiple SR numbers)
-def search_sr_by_number(sr_numbers):
+def search_sr_by_number(sr_numbers, include_archive=False):
     """
     Search for SR records by sr_no in tbl_wh_sales_returns
     Supports single SR or multiple SRs (list)
+    With include_archive, archived SRs are found as well
     """
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
         # Handle single SR number or list of SR numbers
         if isinstance(sr_numbers, str):
             sr_numbers = [sr_numbers]
@@ -904,17 +1642,19 @@ def search_sr_by_number(sr_numbers):
         if not sr_numbers:
             return pd.DataFrame()
         
-        # Create placeholders for SQL IN clause
-        placeholders = ','.join(['%s'] * len(sr_numbers))
-        query = f"SELECT * FROM tbl_wh_sales_returns WHERE sr_no IN ({placeholders})"
-        
-        cursor.execute(query, tuple(sr_numbers))
-        results = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
-        
-        return pd.DataFrame(results) if results else pd.DataFrame()
+        with get_read_pool().connection() as conn:
+            with staged_keys(conn, "tmp_sr_search", SR_KEY_COLUMNS, [(sr,) for sr in sr_numbers]) as keys:
+                # One query per table: the staged keys cannot be joined twice in one UNION query
+                tables = [HOT_TABLE, ARCHIVE_TABLE] if include_archive and archive_available() else [HOT_TABLE]
+                results = pd.concat(
+                    [
+                        fetch_dataframe(conn, f"SELECT r.* FROM {table} r INNER JOIN {keys} k ON r.sr_no = k.sr_no")
+                        for table in tables
+                    ],
+                    ignore_index=True,
+                ).drop(columns=DUP_KEY_COLUMNS, errors="ignore")
+        
+        return results if not results.empty else pd.DataFrame()
     except Exception as e:
         st.error(f"❌ Error searching SR: {e}")
         return pd.DataFrame()
@@ -936,39 +1676,50 @@ def update_hidden_status(sr_numbers):
         if not sr_numbers:
             return False, "No SR numbers provided"
         
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
-        # Create placeholders for SQL IN clause
-        placeholders = ','.join(['%s'] * len(sr_numbers))
-        
-        # First, get the ids from tbl_wh_sales_returns
-        query_get_ids = f"SELECT id, sr_no FROM tbl_wh_sales_returns WHERE sr_no IN ({placeholders})"
-        cursor.execute(query_get_ids, tuple(sr_numbers))
-        results = cursor.fetchall()
-        
-        if not results:
-            cursor.close()
-            conn.close()
-            return False, "SR number(s) not found"
-        
-        sr_ids = [result['id'] for result in results]
-        found_sr_numbers = [result['sr_no'] for result in results]
-        
-        # Update hidden column in tbl_wh_sales_returns
-        update_sr_query = f"UPDATE tbl_wh_sales_returns SET hidden = 1 WHERE sr_no IN ({placeholders})"
-        cursor.execute(update_sr_query, tuple(sr_numbers))
-        rows_updated_sr = cursor.rowcount
-        
-        # Update hidden column in tbl_wh_transfer_out where sr_id matches
-        id_placeholders = ','.join(['%s'] * len(sr_ids))
-        update_to_query = f"UPDATE tbl_wh_transfer_out SET hidden = 1 WHERE id IN ({id_placeholders})"
-        cursor.execute(update_to_query, tuple(sr_ids))
-        rows_updated_to = cursor.rowcount
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with get_db_pool().connection() as conn:
+            with staged_keys(conn, "tmp_sr_hide", SR_KEY_COLUMNS, [(sr,) for sr in sr_numbers]) as keys:
+                cursor = conn.cursor(dictionary=True)
+            
+                # Old SRs may already sit in the archive table, so check and update both
+                include_archive = archive_available()
+                returns_tables = [HOT_TABLE, ARCHIVE_TABLE] if include_archive else [HOT_TABLE]
+            
+                # First, check the SRs exist in tbl_wh_sales_returns (one query per table:
+                # the staged keys cannot be joined twice in one UNION query)
+                results = []
+                for returns_table in returns_tables:
+                    cursor.execute(f"SELECT r.id, r.sr_no FROM {returns_table} r INNER JOIN {keys} k ON r.sr_no = k.sr_no")
+                    results.extend(cursor.fetchall())
+            
+                if not results:
+                    cursor.close()
+                    return False, "SR number(s) not found"
+            
+                rows_updated_to = 0
+                rows_updated_sr = 0
+                for returns_table in returns_tables:
+                    # Update hidden column in tbl_wh_transfer_out where sr_id matches
+                    update_to_query = f"""
+                        UPDATE tbl_wh_transfer_out t
+                        INNER JOIN {returns_table} r ON t.id = r.id
+                        INNER JOIN {keys} k ON r.sr_no = k.sr_no
+                        SET t.hidden = 1
+                    """
+                    cursor.execute(update_to_query)
+                    rows_updated_to += cursor.rowcount
+                
+                    # Take the rows out of the returned-qty ledger while they are still visible
+                    subtract_hidden_returns(cursor, returns_table, keys)
+
+                    # Update hidden column in tbl_wh_sales_returns (and its archive)
+                    update_sr_query = f"UPDATE {returns_table} r INNER JOIN {keys} k ON r.sr_no = k.sr_no SET r.hidden = 1"
+                    cursor.execute(update_sr_query)
+                    rows_updated_sr += cursor.rowcount
+            
+                bump_versions(cursor, [SALES_RETURNS, SALES_RETURNS_HIDDEN, TRANSFER_OUT])
+                conn.commit()
+                mark_primary_write()
+                cursor.close()
         
         message = f"Successfully updated {rows_updated_sr} SR record(s) and {rows_updated_to} Transfer Out record(s)"
         return True, message
@@ -1113,20 +1864,10 @@ elif st.session_state.page == "Config":
         
     st.title("Store Configuration")
     
-    # Function to fetch store config data
-    @st.cache_data(ttl=10)  # Cache for 10 seconds to allow refreshing after updates
+    # Function to fetch store config data (reloaded only after tbl_wh_store_config changes)
     def fetch_store_config():
         try:
-            conn = mysql.connector.connect(**DB_CONFIG)
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute("SELECT store_name, config FROM tbl_wh_store_config ORDER BY store_name;")
-            stores_data = cursor.fetchall()
-            
-            cursor.close()
-            conn.close()
-            
-            return pd.DataFrame(stores_data)
+            return get_store_registry().config_frame()
         except Exception as e:
             st.error(f"❌ Error fetching store configuration: {e}")
             return pd.DataFrame()
@@ -1134,19 +1875,13 @@ elif st.session_state.page == "Config":
     # Function to update store configuration
     def update_store_config(store_name, active_status):
         try:
-            conn = mysql.connector.connect(**DB_CONFIG)
-            cursor = conn.cursor()
-            
-            update_query = """
-            UPDATE tbl_wh_store_config 
-            SET config = %s
-            WHERE store_name = %s
-            """
-            cursor.execute(update_query, (active_status, store_name))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with get_db_pool().connection() as conn:
+                get_statements().execute(conn, "update_store_config", (active_status, store_name))
+                cursor = conn.cursor()
+                bump_versions(cursor, [STORE_CONFIG])
+                cursor.close()
+                conn.commit()
+                mark_primary_write()
             
             return True
         except Exception as e:
@@ -1198,8 +1933,6 @@ elif st.session_state.page == "Config":
                     
                     if success:
                         st.success(f"✅ Successfully updated {selected_store} to {status}")
-                        # Clear the cache to refresh the data
-                        fetch_store_config.clear()
                         # Rerun to show updated data
                         st.rerun()
     else:
@@ -1218,6 +1951,18 @@ elif st.session_state.page == "upload":
     # Use the same key for both radios so selection persists
     if st.session_state.sidebar_open:
         selected_page = st.sidebar.radio("Select Page", options, key="upload_page")
+        with st.sidebar.expander("🔌 Connection pool"):
+            st.json(get_db_pool().stats())
+            if get_read_router().replica is not None:
+                st.caption("Read replica")
+                st.json(get_read_router().replica.stats())
+            st.caption("Prepared statements (client-side counts)")
+            st.json(get_statements().stats())
+            try:
+                with get_db_pool().connection() as conn:
+                    st.caption(f"Server re-prepares on one pooled connection: {PreparedStatements.server_reprepares(conn)}")
+            except mysql.connector.Error:
+                pass
     else:
         selected_page = st.radio("Select Page", options, key="upload_page")
     
@@ -1248,7 +1993,7 @@ elif st.session_state.page == "upload":
             
             if uploaded_file is not None:
                 if uploaded_file.name.endswith(".csv"):
-                    uploaded_df = pd.read_csv(uploaded_file)
+                    uploaded_df = read_upload(uploaded_file, pd.read_csv)
                 else:
                     try:
                         uploaded_df = pd.read_excel(uploaded_file, engine="openpyxl", dtype = str)
@@ -1276,22 +2021,36 @@ elif st.session_state.page == "upload":
                 validate_su_no(uploaded_df)
                 st.success("✅ SU no validation passed!")
 
-                data = fetch_all_data()  # Fetch all required data in one go
-                
-                db_df = data["sales_returns_df"]  # tbl_wh_sales_returns data
-                db_transfer_out = data["transfer_out_df"]  # tbl_wh_transfer_out data
-                
-                sr_dict = data["sr_numbers"]  # Max SR numbers per store
-                to_dict = data["to_numbers"]  # Max TO numbers per store
-                store_case_mapping = data["store_case_mapping"]  # Store name case mapping
+                upload_ctx = UploadDataContext(get_db_pool(), max_workers=prefetch_workers())
 
-                batch_no = data["next_batch_no"] # Max batch id for one time updation
+                # Resolve store names to ids first; unknown stores stop the upload here
+                store_ids = stop_on_unknown_stores(uploaded_df)
+                outlet_ids = sorted(set(store_ids.values()))
+
+                # Prepare filter tuples with ALL four keys: store id, bill no, combination_id, barcode
+                filter_keys = uploaded_df[["stores", "bill no", "combination_id", "barcode"]].dropna().drop_duplicates()
+                return_hashes = tuple(return_key_hashes(filter_keys, upload_columns=True))
+                filter_tuples = tuple(
+                    filter_keys.assign(stores=filter_keys["stores"].map(store_ids))
+                    .itertuples(index=False, name=None)
+                )
+
+                # Duplicate index, sales validation and the SR/TO/batch/store lookups are
+                # independent of each other: run them side by side on separate pooled connections
+                with st.spinner("Loading reference data..."):
+                    upload_ctx.prefetch(
+                        *UploadDataContext.PREP_LOADERS,
+                        "duplicate_index",
+                        ("rtv_sales", filter_tuples, tuple(outlet_ids)),
+                        ("returned_qty", return_hashes),
+                    )
+                st.caption(f"⏱️ Reference data loaded in {upload_ctx.prefetch_seconds:.2f}s")
 
                 # ============================================================
                 # STEP 1: DUPLICATE CHECK (NEW FIRST POSITION) ⚡
                 # ============================================================
             
-                uploaded_df, duplicate_records = check_duplicates(uploaded_df, db_df)
+                uploaded_df, duplicate_records = check_duplicates(uploaded_df, upload_ctx.duplicate_index)
 
                 if not duplicate_records.empty:
                     st.error("❌ ❌ ❌ DUPLICATE RECORDS FOUND ❌ ❌ ❌")
@@ -1317,44 +2076,9 @@ elif st.session_state.page == "upload":
 
                 st.info("🔍 Validating records against database...")
 
-                # Prepare filter tuples with ALL four keys: stores, bill no, combination_id, barcode
-                filter_tuples = list(
-                    uploaded_df[["stores", "bill no", "combination_id", "barcode"]]
-                    .dropna()
-                    .drop_duplicates()
-                    .itertuples(index=False, name=None)
-                )
-
-                placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(filter_tuples))
-                flat_values = [item for tup in filter_tuples for item in tup]
-
-                conn = mysql.connector.connect(**DB_CONFIG)
-                cursor = conn.cursor(dictionary=True)
-
-                # Single query that validates store mapping AND gets qty sold
-                query = f"""
-                    SELECT 
-                        t2.store_full_name as stores, 
-                        msr.GST_bill_number as `bill no`, 
-                        t1.combination_id, 
-                        t1.barcode,
-                        SUM(t1.sold_qty) AS db_qty
-                    FROM tbl_sales t1 
-                    INNER JOIN minimized_sales_register msr 
-                        ON t1.bill_number = msr.bill_number AND t1.bill_date = msr.bill_date
-                    LEFT JOIN tbl_store_data t2 
-                        ON t1.outlets_id = t2.id
-                    WHERE (t2.store_full_name, msr.GST_bill_number, t1.combination_id, t1.barcode) IN ({placeholders}) 
-                        AND t1.bill_date >= CURDATE() - INTERVAL 180 DAY
-                    GROUP BY t2.store_full_name, msr.GST_bill_number, t1.combination_id, t1.barcode;
-                """
-
-                cursor.execute(query, flat_values)
-                filtered_data = cursor.fetchall()
-                df_filtered = pd.DataFrame(filtered_data)
-
-                cursor.close()
-                conn.close()
+                df_filtered = upload_ctx.rtv_sales(filter_tuples, outlet_ids)
+                if df_filtered is None:
+                    st.stop()
 
                 # ========================================
                 # VALIDATION 1: Check for Invalid Store/Bill/Combination/Barcode Mapping
@@ -1431,18 +2155,28 @@ elif st.session_state.page == "upload":
                 # Fill missing DB qty as 0 (shouldn't happen after validation 1, but just in case)
                 qty_compare_df["db_qty"] = qty_compare_df["db_qty"].fillna(0).astype(int)
 
-                # Identify mismatched qty - uploaded MORE than sold from this specific store
+                # Quantities returned in earlier batches, one ledger lookup per key
+                returned_qty = upload_ctx.returned_qty(return_hashes)
+                if returned_qty is None:
+                    st.info("ℹ️ Returned-qty ledger not available - checking against sold qty only")
+                qty_compare_df["already_returned"] = (
+                    return_key_hashes(qty_compare_df, upload_columns=True).map(returned_qty or {}).fillna(0).astype(int)
+                )
+
+                # Identify mismatched qty - uploaded + already returned MORE than sold from this specific store
                 qty_mismatch_df = qty_compare_df[
-                    qty_compare_df["uploaded_qty"] > qty_compare_df["db_qty"]
+                    qty_compare_df["uploaded_qty"] + qty_compare_df["already_returned"] > qty_compare_df["db_qty"]
                 ]
 
                 if not qty_mismatch_df.empty:
                     st.error("❌ ❌ ❌ QTY MISMATCH DETECTED ❌ ❌ ❌")
                     st.error("⚠️ Cannot return more items than were sold from each store!")
-                    st.error("**The following records have UPLOADED QTY > DATABASE QTY:**")
+                    st.error("**The following records have UPLOADED QTY + ALREADY RETURNED > DATABASE QTY:**")
                     
                     # Add a column to show the difference
-                    qty_mismatch_df["excess_qty"] = qty_mismatch_df["uploaded_qty"] - qty_mismatch_df["db_qty"]
+                    qty_mismatch_df["excess_qty"] = (
+                        qty_mismatch_df["uploaded_qty"] + qty_mismatch_df["already_returned"] - qty_mismatch_df["db_qty"]
+                    )
                     
                     # Display with clear column names
                     display_mismatch = qty_mismatch_df.rename(columns={
@@ -1451,6 +2185,7 @@ elif st.session_state.page == "upload":
                         "combination_id": "Combination ID",
                         "barcode": "Barcode",
                         "uploaded_qty": "Uploaded Qty",
+                        "already_returned": "Already Returned Qty",
                         "db_qty": "Database Qty (Sold from this Store)",
                         "excess_qty": "Excess Qty (Over-returned)"
                     })
@@ -1488,15 +2223,15 @@ elif st.session_state.page == "upload":
                 )
                 
                 # Filter out inactive stores
-                uploaded_df, inactive_df = filter_inactive_stores(uploaded_df)
+                uploaded_df, inactive_df = filter_inactive_stores(uploaded_df, upload_ctx.active_stores)
 
                 if not inactive_df.empty:
                     st.write("Inactive store data:")
                     st.dataframe(inactive_df)
                 
                 # Use the modified functions with store_case_mapping
-                uploaded_df = assign_sr_numbers(uploaded_df, sr_dict)
-                uploaded_df, max_to_dict = assign_to_numbers(uploaded_df, to_dict, store_case_mapping)
+                uploaded_df = assign_sr_numbers(uploaded_df, upload_ctx.sr_number)
+                uploaded_df, max_to_dict = assign_to_numbers(uploaded_df, upload_ctx.to_numbers, upload_ctx.store_case_mapping)
 
                 # if not duplicate_records.empty:
                 #     st.write("Duplicate records")
@@ -1542,9 +2277,11 @@ elif st.session_state.page == "upload":
                     sr_df["created_by"] = "WH Team"
                     sr_df["modified_by"] = "WH Team"  
                     sr_df["tran_type"] = "Sales Returns"
-                    sr_df["batch_no"] = batch_no 
+                    sr_df["batch_no"] = upload_ctx.next_batch_no
                     sr_df["RTO"] = 0
                     sr_df["SU_date"] = pd.to_datetime(sr_df["SU_date"], errors="coerce").dt.strftime('%Y-%m-%d %H:%M:%S')
+                    if duplicate_index_available():
+                        sr_df["dup_key_seq"] = duplicate_sequence(key_hashes(sr_df))
                     
                     to_df = uploaded_df[uploaded_df["to_no"] != ""].copy()
                     to_df = to_df[[ "stores", "to_no", "qty", "date", "combination_id", "bill no"]].copy()
@@ -1564,64 +2301,30 @@ elif st.session_state.page == "upload":
                     to_df["modified_by"] = "WH Team"  
                     to_df["branch_recived"] = "Banglore_WH" 
                     to_df["transfer_out_date"] = current_time
-                    to_df["batch_no"] = batch_no
+                    to_df["batch_no"] = upload_ctx.next_batch_no
                     to_df["RTO"] = 0
 
                     # ==================== TRANSACTION BLOCK ====================
-                    conn = None
-                    cursor = None
-                    
+                    # Only the write phase is retried on lock conflicts; the validated rows are reused
+                    # and every attempt numbers them again under the upload numbering lock
+                    write_stats = {}
+                    staged = upload_staging_enabled()
+
+                    def stage_batch(conn, cursor):
+                        stage_upload_batch(conn, cursor, sr_df, to_df)
+
+                    def write_batch(conn, cursor):
+                        return write_upload_batch(conn, cursor, uploaded_df, sr_df, to_df, "UpdateSalesReturns1", staged=staged)
+
                     try:
-                        # Establish connection
-                        conn = mysql.connector.connect(**DB_CONFIG)
-                        cursor = conn.cursor()
-                        
-                        # Start transaction (autocommit is False by default)
-                        st.info("🔄 Starting transaction...")
-                        
-                        # Step 1: Insert into tbl_wh_sales_returns
-                        with st.spinner("Inserting into tbl_wh_sales_returns..."):
-                            rows_sr = insert_data_transactional(conn, cursor, sr_df, "tbl_wh_sales_returns")
-                            st.info(f"✓ Prepared {rows_sr} records for tbl_wh_sales_returns")
-                        
-                        # Step 2: Insert into tbl_wh_transfer_out
-                        with st.spinner("Inserting into tbl_wh_transfer_out..."):
-                            rows_to = insert_data_transactional(conn, cursor, to_df, "tbl_wh_transfer_out")
-                            st.info(f"✓ Prepared {rows_to} records for tbl_wh_transfer_out")
-                        
-                        # Step 3: Call stored procedure UpdateSalesReturns1
-                        with st.spinner("Executing stored procedure UpdateSalesReturns1..."):
-                            call_stored_procedure_transactional(cursor, "UpdateSalesReturns1")
-                            st.info("✓ Stored procedure UpdateSalesReturns1 executed")
-                        
-                        # Step 4: Update store max SR and TO numbers
-                        with st.spinner("Updating store configuration..."):
-                            # Inline the update logic here to keep it in same transaction
-                            cursor.execute("SELECT store_name, max_sr, max_to FROM tbl_wh_store_config")
-                            existing_data = {row[0]: {'max_sr': row[1], 'max_to': row[2]} for row in cursor.fetchall()}
-                            
-                            for store in set(max_to_dict):
-                                new_to = max_to_dict.get(store)
-                                existing_store = next((db_store for db_store in existing_data if db_store.lower() == store.lower()), None)
-                                
-                                if existing_store:
-                                    update_query = """
-                                    UPDATE tbl_wh_store_config 
-                                    SET max_to = %s
-                                    WHERE store_name = %s
-                                    """
-                                    cursor.execute(update_query, (new_to, existing_store))
-                                else:
-                                    insert_query = """
-                                    INSERT INTO tbl_wh_store_config (store_name, max_to)
-                                    VALUES (%s, %s)
-                                    """
-                                    cursor.execute(insert_query, (store, new_to))
-                            
-                            st.info("✓ Store configuration updated")
-                        
-                        # ==================== COMMIT ALL CHANGES ====================
-                        conn.commit()
+                        rows_sr, rows_to, sr_df, max_to_dict = run_in_transaction(
+                            get_db_pool(), write_batch, on_retry=show_write_retry, stats=write_stats,
+                            prepare=stage_batch if staged else None, **write_retry_settings()
+                        )
+                        mark_primary_write()
+                        uploaded_df["sr_no"] = sr_df["sr_no"]
+                        # The next upload in this process sees these keys before its own refresh
+                        get_duplicate_index().add(key_hashes64(sr_df))
                         
                         st.success("✅ ✅ ✅ TRANSACTION COMMITTED SUCCESSFULLY! ✅ ✅ ✅")
                         st.success(f"📊 Summary:")
@@ -1629,6 +2332,13 @@ elif st.session_state.page == "upload":
                         st.success(f"   • Inserted {rows_to} records into tbl_wh_transfer_out")
                         st.success(f"   • Updated store configuration for {len(max_to_dict)} stores")
                         st.success(f"   • Executed stored procedure UpdateSalesReturns1")
+                        st.success(f"   • Transaction on production tables held for {write_stats['transaction_seconds']:.2f}s")
+                        if write_stats["retries"]:
+                            st.success(
+                                f"   • Committed after {write_stats['retries']} lock-conflict retr"
+                                f"{'y' if write_stats['retries'] == 1 else 'ies'} "
+                                f"({write_stats['lock_wait_seconds']:.1f}s lost to lock waits)"
+                            )
                         st.balloons()
                         
                         # Download updated data
@@ -1636,10 +2346,16 @@ elif st.session_state.page == "upload":
                         csv_uploaded = uploaded_df.to_csv(index=False).encode("utf-8")
                         st.download_button("📥 Download Updated CSV", csv_uploaded, "updated_data.csv", "text/csv")
                         
+                    except DuplicateRowsError as dup_err:
+                        # Another upload committed some of these rows after the duplicate check
+                        st.error("❌ ❌ ❌ DUPLICATE ROWS - TRANSACTION ROLLED BACK ❌ ❌ ❌")
+                        st.error(f"🔴 {dup_err}. They were uploaded while this file was being processed.")
+                        st.dataframe(dup_err.rows[list(DUPLICATE_KEY_COLUMNS)].reset_index(drop=True))
+                        st.error("⚠️ No data was saved. Please upload the file again to skip these rows.")
+                    
                     except mysql.connector.Error as db_err:
                         # Database-specific error
-                        if conn:
-                            conn.rollback()
+                        if write_stats.get("connected"):
                             st.error("❌ ❌ ❌ DATABASE ERROR - TRANSACTION ROLLED BACK ❌ ❌ ❌")
                             st.error(f"🔴 Database Error: {db_err}")
                             st.error("⚠️ No data was saved. Please fix the error and try again.")
@@ -1649,22 +2365,18 @@ elif st.session_state.page == "upload":
                     
                     except Exception as e:
                         # Any other error (connection failure, data processing, etc.)
-                        if conn:
-                            conn.rollback()
+                        if write_stats.get("connected"):
                             st.error("❌ ❌ ❌ ERROR OCCURRED - TRANSACTION ROLLED BACK ❌ ❌ ❌")
                             st.error(f"🔴 Error: {str(e)}")
                             st.error("⚠️ No data was saved. Please check your data and try again.")
                         else:
                             st.error("❌ Failed to process data")
                             st.error(f"🔴 Error: {str(e)}")
+                        if write_stats.get("retries"):
+                            st.error(f"🔁 Stopped after {write_stats['attempts']} attempts ({write_stats['retries']} lock-conflict retries)")
                     
                     finally:
-                        # Always close cursor and connection
-                        if cursor:
-                            cursor.close()
-                        if conn:
-                            conn.close()
-                        st.info("🔌 Database connection closed")
+                        st.info("🔌 Database connection returned to pool")
             
                 else:
                     st.warning("⚠️ No new data to process after removing duplicates.")
@@ -1689,10 +2401,10 @@ elif st.session_state.page == "upload":
             
             if uploaded_file is not None:
                 if uploaded_file.name.endswith(".csv"):
-                    uploaded_df = pd.read_csv(uploaded_file)
+                    uploaded_df = read_upload(uploaded_file, pd.read_csv)
                 else:
                     try:
-                        uploaded_df = pd.read_excel(uploaded_file, engine="openpyxl")
+                        uploaded_df = read_upload(uploaded_file, pd.read_excel, engine="openpyxl")
                     except ImportError:
                         st.error("Missing dependency: Please install 'openpyxl' using `pip install openpyxl`.")
                 
@@ -1762,47 +2474,29 @@ elif st.session_state.page == "upload":
 
                 st.info("🔍 Step 2: Validating store + bill combinations against database...")
 
-                # Prepare tuples with BOTH store and GST bill number
-                validation_tuples = list(
-                    uploaded_df[['stores', 'bill no']]
-                    .dropna()
-                    .drop_duplicates()
+                # Resolve store names to ids first; unknown stores stop the upload here
+                store_ids = stop_on_unknown_stores(uploaded_df)
+                outlet_ids = sorted(set(store_ids.values()))
+
+                # Prepare tuples with BOTH store id and GST bill number
+                validation_keys = uploaded_df[['stores', 'bill no']].dropna().drop_duplicates()
+                validation_tuples = tuple(
+                    validation_keys.assign(stores=validation_keys['stores'].map(store_ids))
                     .itertuples(index=False, name=None)
                 )
 
-                placeholders = ', '.join(['(%s, %s)'] * len(validation_tuples))
-                flat_values = [item for tup in validation_tuples for item in tup]
-
-                conn = mysql.connector.connect(**DB_CONFIG)
-                cursor = conn.cursor(dictionary=True)
-
-                # Query that validates BOTH store AND GST bill number
-                query = f"""
-                    SELECT DISTINCT 
-                        t3.store_full_name as stores,
-                        t1.GST_bill_number as `bill no`,
-                        t2.combination_id, 
-                        t1.bill_date, 
-                        t1.bill_number,
-                        t2.design_number as `design numbers`, 
-                        SUM(t2.sold_qty) as qty, 
-                        t2.barcode
-                    FROM minimized_sales_register t1
-                    LEFT JOIN tbl_sales t2 
-                        ON t1.bill_number = t2.bill_number AND t1.bill_date = t2.bill_date
-                    LEFT JOIN tbl_store_data t3
-                        ON t2.outlets_id = t3.id
-                    WHERE (t3.store_full_name, t1.GST_bill_number) IN ({placeholders}) AND t1.bill_date >= curdate() - INTERVAL 120 DAY
-                    GROUP BY t3.store_full_name, t1.GST_bill_number, t2.combination_id, 
-                            t1.bill_date, t1.bill_number, t2.design_number, t2.barcode;
-                """
-
-                cursor.execute(query, flat_values)
-                filtered_data = cursor.fetchall()
-                df_filtered = pd.DataFrame(filtered_data)
+                # Duplicate index, sales validation and the SR/TO/batch/store lookups are independent
+                # of each other: run them side by side on separate pooled connections
+                upload_ctx = UploadDataContext(get_db_pool(), max_workers=prefetch_workers())
+                with st.spinner("Loading reference data..."):
+                    upload_ctx.prefetch(
+                        *UploadDataContext.PREP_LOADERS, "duplicate_index", ("rto_sales", validation_tuples, tuple(outlet_ids))
+                    )
+                st.caption(f"⏱️ Reference data loaded in {upload_ctx.prefetch_seconds:.2f}s")
 
-                cursor.close()
-                conn.close()
+                df_filtered = upload_ctx.rto_sales(validation_tuples, outlet_ids)
+                if df_filtered is None:
+                    st.stop()
 
                 # Check if database returned any results
                 if df_filtered.empty:
@@ -1918,24 +2612,13 @@ elif st.session_state.page == "upload":
 
                 st.success(f"✅ Successfully validated and merged {len(uploaded_df)} records")
 
-                uploaded_df, inactive_df = filter_inactive_stores(uploaded_df)
+                uploaded_df, inactive_df = filter_inactive_stores(uploaded_df, upload_ctx.active_stores)
 
                 if not inactive_df.empty:
                     st.write("Inactive store data:")
                     st.dataframe(inactive_df)
             
-                data = fetch_all_data()  # Fetch all required data in one go
-                
-                db_df = data["sales_returns_df"]  # tbl_wh_sales_returns data
-                db_transfer_out = data["transfer_out_df"]  # tbl_wh_transfer_out data
-                
-                sr_dict = data["sr_numbers"]  # Max SR numbers per store
-                to_dict = data["to_numbers"]  # Max TO numbers per store
-                store_case_mapping = data["store_case_mapping"]  # Store name case mapping
-
-                batch_no = data["next_batch_no"] # Max batch id for one time updation
-            
-                uploaded_df, duplicate_records = check_duplicates(uploaded_df, db_df)
+                uploaded_df, duplicate_records = check_duplicates(uploaded_df, upload_ctx.duplicate_index)
 
                 if not duplicate_records.empty:
                     st.error("❌ ❌ ❌ DUPLICATE RECORDS FOUND ❌ ❌ ❌")
@@ -1982,8 +2665,8 @@ elif st.session_state.page == "upload":
                     st.stop()
                 
                 # Use the modified functions with store_case_mapping
-                uploaded_df = assign_sr_numbers(uploaded_df, sr_dict)
-                uploaded_df, max_to_dict = assign_to_numbers(uploaded_df, to_dict, store_case_mapping)
+                uploaded_df = assign_sr_numbers(uploaded_df, upload_ctx.sr_number)
+                uploaded_df, max_to_dict = assign_to_numbers(uploaded_df, upload_ctx.to_numbers, upload_ctx.store_case_mapping)
             
                 # if not duplicate_records.empty:
                 #     st.write("Duplicate records")
@@ -2030,9 +2713,11 @@ elif st.session_state.page == "upload":
                     sr_df["created_by"] = "WH Team"
                     sr_df["modified_by"] = "WH Team"  
                     sr_df["tran_type"] = "Sales Returns"
-                    sr_df["batch_no"] = batch_no 
+                    sr_df["batch_no"] = upload_ctx.next_batch_no
                     sr_df["RTO"] = 1
                     sr_df["SU_date"] = pd.to_datetime(sr_df["SU_date"], errors="coerce").dt.strftime('%Y-%m-%d %H:%M:%S')
+                    if duplicate_index_available():
+                        sr_df["dup_key_seq"] = duplicate_sequence(key_hashes(sr_df))
 
                     to_df = uploaded_df[uploaded_df["to_no"] != ""].copy()
                     to_df = to_df[[ "stores", "to_no", "qty", "date", "combination_id", "bill no"]].copy()
@@ -2052,66 +2737,33 @@ elif st.session_state.page == "upload":
                     to_df["modified_by"] = "WH Team"  
                     to_df["branch_recived"] = "Banglore_WH" 
                     to_df["transfer_out_date"] = current_time
-                    to_df["batch_no"] = batch_no
+                    to_df["batch_no"] = upload_ctx.next_batch_no
                     to_df["RTO"] = 1
 
                     # st.write("created_date dtype:", sr_df["created_date"].dtype)
                     # st.write(sr_df[["created_date"]].head())
 
                     # ==================== TRANSACTION BLOCK ====================
-                    conn = None
-                    cursor = None
-                    
+                    # Only the write phase is retried on lock conflicts; the validated rows are reused
+                    # and every attempt numbers them again under the upload numbering lock
+                    write_stats = {}
+                    staged = upload_staging_enabled()
+
+                    def stage_batch(conn, cursor):
+                        stage_upload_batch(conn, cursor, sr_df, to_df)
+
+                    def write_batch(conn, cursor):
+                        return write_upload_batch(conn, cursor, uploaded_df, sr_df, to_df, "UpdateSalesReturns", staged=staged)
+
                     try:
-                        # Establish connection
-                        conn = mysql.connector.connect(**DB_CONFIG)
-                        cursor = conn.cursor()
-                        
-                        # Start transaction
-                        st.info("🔄 Starting transaction...")
-                        
-                        # Step 1: Insert into tbl_wh_sales_returns
-                        with st.spinner("Inserting into tbl_wh_sales_returns..."):
-                            rows_sr = insert_data_transactional(conn, cursor, sr_df, "tbl_wh_sales_returns")
-                            st.info(f"✓ Prepared {rows_sr} records for tbl_wh_sales_returns")
-                        
-                        # Step 2: Insert into tbl_wh_transfer_out
-                        with st.spinner("Inserting into tbl_wh_transfer_out..."):
-                            rows_to = insert_data_transactional(conn, cursor, to_df, "tbl_wh_transfer_out")
-                            st.info(f"✓ Prepared {rows_to} records for tbl_wh_transfer_out")
-                        
-                        # Step 3: Call stored procedure UpdateSalesReturns (different from RTV!)
-                        with st.spinner("Executing stored procedure UpdateSalesReturns..."):
-                            call_stored_procedure_transactional(cursor, "UpdateSalesReturns")
-                            st.info("✓ Stored procedure UpdateSalesReturns executed")
-                        
-                        # Step 4: Update store max SR and TO numbers
-                        with st.spinner("Updating store configuration..."):
-                            cursor.execute("SELECT store_name, max_sr, max_to FROM tbl_wh_store_config")
-                            existing_data = {row[0]: {'max_sr': row[1], 'max_to': row[2]} for row in cursor.fetchall()}
-                            
-                            for store in set(max_to_dict):
-                                new_to = max_to_dict.get(store)
-                                existing_store = next((db_store for db_store in existing_data if db_store.lower() == store.lower()), None)
-                                
-                                if existing_store:
-                                    update_query = """
-                                    UPDATE tbl_wh_store_config 
-                                    SET max_to = %s
-                                    WHERE store_name = %s
-                                    """
-                                    cursor.execute(update_query, (new_to, existing_store))
-                                else:
-                                    insert_query = """
-                                    INSERT INTO tbl_wh_store_config (store_name, max_to)
-                                    VALUES (%s, %s)
-                                    """
-                                    cursor.execute(insert_query, (store, new_to))
-                            
-                            st.info("✓ Store configuration updated")
-                        
-                        # ==================== COMMIT ALL CHANGES ====================
-                        conn.commit()
+                        rows_sr, rows_to, sr_df, max_to_dict = run_in_transaction(
+                            get_db_pool(), write_batch, on_retry=show_write_retry, stats=write_stats,
+                            prepare=stage_batch if staged else None, **write_retry_settings()
+                        )
+                        mark_primary_write()
+                        uploaded_df["sr_no"] = sr_df["sr_no"]
+                        # The next upload in this process sees these keys before its own refresh
+                        get_duplicate_index().add(key_hashes64(sr_df))
                         
                         st.success("✅ ✅ ✅ TRANSACTION COMMITTED SUCCESSFULLY! ✅ ✅ ✅")
                         st.success(f"📊 Summary:")
@@ -2119,6 +2771,13 @@ elif st.session_state.page == "upload":
                         st.success(f"   • Inserted {rows_to} records into tbl_wh_transfer_out")
                         st.success(f"   • Updated store configuration for {len(max_to_dict)} stores")
                         st.success(f"   • Executed stored procedure UpdateSalesReturns")
+                        st.success(f"   • Transaction on production tables held for {write_stats['transaction_seconds']:.2f}s")
+                        if write_stats["retries"]:
+                            st.success(
+                                f"   • Committed after {write_stats['retries']} lock-conflict retr"
+                                f"{'y' if write_stats['retries'] == 1 else 'ies'} "
+                                f"({write_stats['lock_wait_seconds']:.1f}s lost to lock waits)"
+                            )
                         st.balloons()
                         
                         # Download updated data
@@ -2126,9 +2785,16 @@ elif st.session_state.page == "upload":
                         csv_uploaded = uploaded_df.to_csv(index=False).encode("utf-8")
                         st.download_button("📥 Download Updated CSV", csv_uploaded, "updated_data.csv", "text/csv")
                         
+                    except DuplicateRowsError as dup_err:
+                        # Another upload committed some of these rows after the duplicate check
+                        st.error("❌ ❌ ❌ DUPLICATE ROWS - TRANSACTION ROLLED BACK ❌ ❌ ❌")
+                        st.error(f"🔴 {dup_err}. They were uploaded while this file was being processed.")
+                        st.dataframe(dup_err.rows[list(DUPLICATE_KEY_COLUMNS)].reset_index(drop=True))
+                        st.error("⚠️ No data was saved. Please upload the file again to skip these rows.")
+                    
                     except mysql.connector.Error as db_err:
-                        if conn:
-                            conn.rollback()
+                        # Database-specific error
+                        if write_stats.get("connected"):
                             st.error("❌ ❌ ❌ DATABASE ERROR - TRANSACTION ROLLED BACK ❌ ❌ ❌")
                             st.error(f"🔴 Database Error: {db_err}")
                             st.error("⚠️ No data was saved. Please fix the error and try again.")
@@ -2137,21 +2803,19 @@ elif st.session_state.page == "upload":
                             st.error(f"🔴 Connection Error: {db_err}")
                     
                     except Exception as e:
-                        if conn:
-                            conn.rollback()
+                        # Any other error (connection failure, data processing, etc.)
+                        if write_stats.get("connected"):
                             st.error("❌ ❌ ❌ ERROR OCCURRED - TRANSACTION ROLLED BACK ❌ ❌ ❌")
                             st.error(f"🔴 Error: {str(e)}")
                             st.error("⚠️ No data was saved. Please check your data and try again.")
                         else:
                             st.error("❌ Failed to process data")
                             st.error(f"🔴 Error: {str(e)}")
+                        if write_stats.get("retries"):
+                            st.error(f"🔁 Stopped after {write_stats['attempts']} attempts ({write_stats['retries']} lock-conflict retries)")
                     
                     finally:
-                        if cursor:
-                            cursor.close()
-                        if conn:
-                            conn.close()
-                        st.info("🔌 Database connection closed")
+                        st.info("🔌 Database connection returned to pool")
             
                 else:
                     st.warning("⚠️ No new data to process after removing duplicates.")
@@ -2166,13 +2830,8 @@ elif st.session_state.page == "upload":
         with col2:
             end_date = st.date_input("End Date", key="sr_end")
 
-        # Fetch distinct store names for dropdown
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT outlet_name FROM tbl_wh_sales_returns;")
-        store_names = [row[0] for row in cursor.fetchall()]
-        cursor.close()
-        conn.close()
+        # Configured store names for dropdown
+        store_names = get_store_registry().names
 
         # Initialize session state for SR stores if not exists
         if "sr_select_all_checked" not in st.session_state:
@@ -2189,6 +2848,12 @@ elif st.session_state.page == "upload":
         # Use store_names as default if "Select All" is checked
         default_stores = store_names if st.session_state.sr_select_all_checked else []
         selected_stores = st.multiselect("Select Store(s)", store_names, default=default_stores, key="sr_stores")
+        include_archive = st.checkbox(
+            "Include archived returns",
+            key="sr_include_archive",
+            disabled=not archive_available(),
+            help="Hidden returns and returns older than the archive horizon are kept in the archive table",
+        )
 
         # ========================================
         # ADD THIS DEBUG SECTION
@@ -2215,78 +2880,67 @@ elif st.session_state.page == "upload":
                 st.warning("Please select at least one store.")
             else:
                 try:
-                    conn = mysql.connector.connect(**DB_CONFIG)
-                    cursor = conn.cursor(dictionary=True)
-
-                    # Format the placeholders and store list
-                    store_placeholders = ','.join(['%s'] * len(selected_stores))
-
-                    query = f"""
-                SELECT 
-                    s.*,
-                    t4.item_name
-                FROM tbl_wh_sales_returns s
-                LEFT JOIN tbl_store_data t1 
-                    ON s.outlet_name = t1.store_full_name
-                LEFT JOIN tbl_item_data t4
-                    ON s.combination_id = t4.combination_id
-                WHERE 
-                    DATE(s.created_date) BETWEEN %s AND %s
-                    AND t1.store_full_name IN ({store_placeholders})
-                    AND (s.hidden IS NULL OR s.hidden = 0 OR s.hidden = '')
-                    AND t4.is_active = true
-                ORDER BY s.id
-                    """
-
-                    params = [start_date, end_date] + selected_stores
-                    cursor.execute(query, params)
-                    filtered_data = cursor.fetchall()
-                    df_filtered = pd.DataFrame(filtered_data)
-
-                    query1 = f"""
-                        SELECT 
-                            s.bill_date,
-                            s.tender,
-                            s.outlet_name,
-                            s.customer_name,
-                            s.sr_no AS return_no,
-                            s.return_date,
-                            s.bill_no AS Bill_refno,
-                            ROUND(SUM(s.bill_amount_1) + SUM(s.packing_charges), 2) AS total_amount,
-                            SUM(s.sold_qty) AS qty,
-                            SUM(s.item_gross) AS item_gross,
-                            SUM(s.discount_amount) AS discount_amount,
-                            s.sales_tran_refno,
-                            s.returns_tran_refno,
-                            ROUND(SUM(s.bill_amount_1), 2) AS item_charges,
-                            ROUND(SUM(s.packing_charges), 2) AS packing_charges,
-                            s.customer_state,
-                            s.mobile_number,
-                            s.gst_billno,
-                            SUM(s.gstamt) AS gst_amt,
-                            SUM(s.cgst_amt) AS cgst_amt,
-                            SUM(s.sgst_amt_ugst_amt) AS sgst_amt_ugst_amt,
-                            s.hsn_sac_code
-                        FROM tbl_wh_sales_returns s
-                        LEFT JOIN tbl_store_data t1 
-                            ON s.outlet_name = t1.store_full_name
-                        WHERE 
-                            DATE(s.created_date) BETWEEN %s AND %s
-                            AND t1.store_full_name IN ({store_placeholders})
-                            AND (s.hidden IS NULL OR s.hidden = 0 OR s.hidden = '')
-                        GROUP BY 
-                            s.outlet_name, 
-                            s.bill_no,
-                            s.bill_date
-                    """
-
-                    params1 = [start_date, end_date] + selected_stores
-                    cursor.execute(query1, params1)
-                    filtered_data1 = cursor.fetchall()
-                    df_filtered1 = pd.DataFrame(filtered_data1)
+                    with report_query("sr_page") as conn:
+                        # Format the placeholders and store list
+                        store_placeholders = ','.join(['%s'] * len(selected_stores))
+                        # Date, store and hidden filters run inside each hot / archive branch
+                        returns_filter = (
+                            f"created_date >= %s AND created_date < %s AND outlet_name IN ({store_placeholders}) "
+                            f"AND {VISIBLE_RETURN_SQL}"
+                        )
+                        returns_filter_params = returns_params(
+                            list(date_range_bounds(start_date, end_date)) + selected_stores, include_archive
+                        )
 
-                    cursor.close()
-                    conn.close()
+                        query = f"""
+                    SELECT 
+                        s.*,
+                        t4.item_name
+                    FROM {returns_source(include_archive, returns_filter)} s
+                    INNER JOIN tbl_store_data t1 
+                        ON s.outlet_name = t1.store_full_name
+                    LEFT JOIN tbl_item_data t4
+                        ON s.combination_id = t4.combination_id
+                    WHERE t4.is_active = true
+                    ORDER BY s.id
+                        """
+
+                        df_filtered = fetch_dataframe(conn, query, returns_filter_params).drop(columns=DUP_KEY_COLUMNS, errors="ignore")
+
+                        query1 = f"""
+                            SELECT 
+                                s.bill_date,
+                                s.tender,
+                                s.outlet_name,
+                                s.customer_name,
+                                s.sr_no AS return_no,
+                                s.return_date,
+                                s.bill_no AS Bill_refno,
+                                ROUND(SUM(s.bill_amount_1) + SUM(s.packing_charges), 2) AS total_amount,
+                                SUM(s.sold_qty) AS qty,
+                                SUM(s.item_gross) AS item_gross,
+                                SUM(s.discount_amount) AS discount_amount,
+                                s.sales_tran_refno,
+                                s.returns_tran_refno,
+                                ROUND(SUM(s.bill_amount_1), 2) AS item_charges,
+                                ROUND(SUM(s.packing_charges), 2) AS packing_charges,
+                                s.customer_state,
+                                s.mobile_number,
+                                s.gst_billno,
+                                SUM(s.gstamt) AS gst_amt,
+                                SUM(s.cgst_amt) AS cgst_amt,
+                                SUM(s.sgst_amt_ugst_amt) AS sgst_amt_ugst_amt,
+                                s.hsn_sac_code
+                            FROM {returns_source(include_archive, returns_filter)} s
+                            INNER JOIN tbl_store_data t1 
+                                ON s.outlet_name = t1.store_full_name
+                            GROUP BY 
+                                s.outlet_name, 
+                                s.bill_no,
+                                s.bill_date
+                        """
+
+                        df_filtered1 = fetch_dataframe(conn, query1, returns_filter_params)
 
                     if df_filtered.empty:
                         st.info("No data found for the selected filters.")
@@ -2299,10 +2953,12 @@ elif st.session_state.page == "upload":
                     else:
                         st.write("📦 Bill_wise data from `tbl_wh_sales_returns`:")
                         st.dataframe(df_filtered1.reset_index(drop=True))
+                except QueryCancelled as e:
+                    show_query_cancelled(e)
                 except Exception as e:
                     st.error(f"❌ Error querying data: {e}")
                     
-            _, df_sales_2 = fetch_sales_data(DB_CONFIG, start_date, end_date, selected_stores)
+            _, df_sales_2 = fetch_sales_data(start_date, end_date, selected_stores, include_archive)
             to_display = pd.DataFrame(df_sales_2)
 
             st.write("SR PDF output:")
@@ -2322,13 +2978,8 @@ elif st.session_state.page == "upload":
         with col2:
             end_date = st.date_input("End Date", key="to_end")
 
-        # Fetch distinct store names for dropdown
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT outlet_name_from FROM tbl_wh_transfer_out;")
-        store_names = [row[0] for row in cursor.fetchall()]
-        cursor.close()
-        conn.close()
+        # Configured store names for dropdown
+        store_names = get_store_registry().names
 
         # Initialize session state for TO stores if not exists
         if "to_select_all_checked" not in st.session_state:
@@ -2345,66 +2996,63 @@ elif st.session_state.page == "upload":
         # Use store_names as default if "Select All" is checked
         default_stores = store_names if st.session_state.to_select_all_checked else []
         selected_stores = st.multiselect("Select Store(s)", store_names, default=default_stores, key="to_stores")
+        include_archive = st.checkbox(
+            "Include archived returns",
+            key="to_include_archive",
+            disabled=not archive_available(),
+            help="Hidden returns and returns older than the archive horizon are kept in the archive table",
+        )
 
         if st.button("✅ Continue", key="to_continue"):
             if not selected_stores:
                 st.warning("Please select at least one store.")
             else:
                 try:
-                    conn = mysql.connector.connect(**DB_CONFIG)
-                    cursor = conn.cursor(dictionary=True)
-
-                    # Format the placeholders and store list
-                    store_placeholders = ','.join(['%s'] * len(selected_stores))
-
-                    query = f"""
-                        SELECT 
-                            t.*
-                        FROM tbl_wh_transfer_out t
-                        LEFT JOIN tbl_store_data t1 
-                            ON t.outlet_name_from = t1.store_full_name
-                        WHERE 
-                            DATE(t.created_date) BETWEEN %s AND %s
-                            AND t1.store_full_name IN ({store_placeholders})
-                            AND (t.hidden IS NULL OR t.hidden = 0 OR t.hidden = '')
-                        ORDER BY t.id
-                    """
-
-                    params = [start_date, end_date] + selected_stores
-                    cursor.execute(query, params)
-                    filtered_data = cursor.fetchall()
-                    df_filtered = pd.DataFrame(filtered_data)
-
-                    query1 = f"""
-                        SELECT 
-                            t.branch_recived AS `branch_name_(received_to)`,
-                            t.outlet_name_from AS `outlet_name_(sent_from)`,
-                            t.transaction_refno,
-                            t.transfer_out_date,
-                            ROUND(SUM(t.qty), 2) AS Tout_qty,
-                            ROUND(SUM(t.item_cost), 2) AS pur_price,
-                            ROUND(SUM(t.mrp), 2) AS MRP
-                        FROM tbl_wh_transfer_out t
-                        LEFT JOIN tbl_store_data t1 
-                            ON t.outlet_name_from = t1.store_full_name
-                        WHERE 
-                            DATE(t.created_date) BETWEEN %s AND %s
-                            AND t1.store_full_name IN ({store_placeholders})
-                            AND (t.hidden IS NULL OR t.hidden = 0 OR t.hidden = '')
-                        GROUP BY 
-                            t.branch_recived,
-                            t.outlet_name_from,
-                            t.transaction_refno,
-                            t.transfer_out_date
-                    """
-
-                    params1 = [start_date, end_date] + selected_stores
-                    cursor.execute(query1, params1)
-                    filtered_data1 = cursor.fetchall()
-                    df_filtered1 = pd.DataFrame(filtered_data1)
-
-                    cursor.close()
-                    conn.close()
+                    with report_query("to_page") as conn:
+                        # Format the placeholders and store list
+                        store_placeholders = ','.join(['%s'] * len(selected_stores))
+
+                        query = f"""
+                            SELECT 
+                                t.*
+                            FROM tbl_wh_transfer_out t
+                            INNER JOIN tbl_store_data t1 
+                                ON t.outlet_name_from = t1.store_full_name
+                            WHERE 
+                                t.created_date >= %s AND t.created_date < %s
+                                AND t.outlet_name_from IN ({store_placeholders})
+                                AND {visible_sql('t')}
+                            ORDER BY t.id
+                        """
+
+                        params = list(date_range_bounds(start_date, end_date)) + selected_stores
+                        df_filtered = fetch_dataframe(conn, query, params)
+
+                        query1 = f"""
+                            SELECT 
+                                t.branch_recived AS `branch_name_(received_to)`,
+                                t.outlet_name_from AS `outlet_name_(sent_from)`,
+                                t.transaction_refno,
+                                t.transfer_out_date,
+                                ROUND(SUM(t.qty), 2) AS Tout_qty,
+                                ROUND(SUM(t.item_cost), 2) AS pur_price,
+                                ROUND(SUM(t.mrp), 2) AS MRP
+                            FROM tbl_wh_transfer_out t
+                            INNER JOIN tbl_store_data t1 
+                                ON t.outlet_name_from = t1.store_full_name
+                            WHERE 
+                                t.created_date >= %s AND t.created_date < %s
+                                AND t.outlet_name_from IN ({store_placeholders})
+                                AND {visible_sql('t')}
+                            GROUP BY 
+                                t.branch_recived,
+                                t.outlet_name_from,
+                                t.transaction_refno,
+                                t.transfer_out_date
+                        """
+
+                        params1 = list(date_range_bounds(start_date, end_date)) + selected_stores
+                        df_filtered1 = fetch_dataframe(conn, query1, params1)
 
                     if df_filtered.empty:
                         st.info("No data found for the selected filters.")
@@ -2418,10 +3066,12 @@ elif st.session_state.page == "upload":
                         st.write("📦 Filtered data from `tbl_wh_transfer_out`:")
                         st.dataframe(df_filtered1.reset_index(drop=True))
                     
+                except QueryCancelled as e:
+                    show_query_cancelled(e)
                 except Exception as e:
                     st.error(f"❌ Error querying data: {e}")
             
-            df_sales_1, _ = fetch_sales_data(DB_CONFIG, start_date, end_date, selected_stores)
+            df_sales_1, _ = fetch_sales_data(start_date, end_date, selected_stores, include_archive)
             to_display = pd.DataFrame(df_sales_1)
 
             # Display sales data
@@ -2503,6 +3153,12 @@ elif st.session_state.page == "upload":
                 st.write("")  # Spacing
                 search_button_bulk = st.button("🔍 Search", key="search_sr_btn_bulk", type="primary", use_container_width=True)
             
+            search_archive = st.checkbox(
+                "Also search archived SRs",
+                key="hide_sr_search_archive",
+                disabled=not archive_available(),
+            )
+            
             # Bulk search functionality
             if search_button_bulk and bulk_sr_input:
                 with st.spinner("Searching SR numbers..."):
@@ -2515,7 +3171,7 @@ elif st.session_state.page == "upload":
                                 sr_numbers.append(sr_clean)
                     
                     if sr_numbers:
-                        results = search_sr_by_number(sr_numbers)
+                        results = search_sr_by_number(sr_numbers, include_archive=search_archive)
                         st.session_state.search_results = results
                         
                         if results.empty:
@@ -2646,31 +3302,24 @@ elif st.session_state.page == "upload":
             
             try:
                 # Fetch already hidden records from database
-                conn = mysql.connector.connect(**DB_CONFIG)
-                cursor = conn.cursor(dictionary=True)
-                
-                hidden_query = """
-                    SELECT 
-                        sr_no,
-                        outlet_name,
-                        bill_no,
-                        design_no,
-                        return_date,
-                        bill_amount,
-                        created_date,
-                        modified_date
-                    FROM tbl_wh_sales_returns
-                    WHERE hidden = 1
-                    ORDER BY modified_date DESC
-                """
+                with report_query("hidden_list") as conn:
+                    hidden_query = f"""
+                        SELECT 
+                            sr_no,
+                            outlet_name,
+                            bill_no,
+                            design_no,
+                            return_date,
+                            bill_amount,
+                            created_date,
+                            modified_date
+                        FROM {returns_source(archive_available(), "hidden = 1")} r
+                        ORDER BY modified_date DESC
+                    """
                 
-                cursor.execute(hidden_query)
-                hidden_records = cursor.fetchall()
-                cursor.close()
-                conn.close()
+                    hidden_df = fetch_dataframe(conn, hidden_query)
                 
-                if hidden_records:
-                    hidden_df = pd.DataFrame(hidden_records)
+                if not hidden_df.empty:
                     
                     # Rename columns for better display
                     hidden_df = hidden_df.rename(columns={
@@ -2706,6 +3355,8 @@ elif st.session_state.page == "upload":
                 else:
                     st.info("ℹ️ No hidden SR records found")
                     
+            except QueryCancelled as e:
+                show_query_cancelled(e)
             except Exception as e:
                 st.error(f"❌ Error fetching hidden records: {e}")
             
@@ -0,0 +1,208 @@
+"""
+Hot/archive split for tbl_wh_sales_returns.
+
+Hidden returns and returns older than the horizon are moved, in id-ordered
+batches, into tbl_wh_sales_returns_archive (same columns, created by
+migration 4), so the reports and duplicate checks that scan the hot table
+stay small. Each batch is copied and deleted in one short transaction.
+
+    python archive.py status --horizon-days 365
+    python archive.py run --horizon-days 365 --batch-size 5000
+    python archive.py run --dry-run
+
+The app reads the archive only where history is asked for (see
+returns_source()). Schema changes to tbl_wh_sales_returns must be applied to
+the archive table as well, since the two are read with UNION ALL.
+"""
+import argparse
+import datetime
+import time
+
+import mysql.connector
+
+from change_log import SALES_RETURNS, bump_versions
+from db_pool import DEFAULT_SECRETS_PATH, load_secrets
+
+HOT_TABLE = "tbl_wh_sales_returns"
+ARCHIVE_TABLE = "tbl_wh_sales_returns_archive"
+DEFAULT_HORIZON_DAYS = 365
+DEFAULT_BATCH_SIZE = 5000
+
+
+def returns_source(include_archive=False, where=None):
+    """
+    FROM-clause source for sales returns: the hot table, or hot + archive.
+
+    MySQL materializes a UNION in FROM and pushes neither join predicates nor
+    (before 8.0.29) WHERE predicates into it, so an unfiltered hot + archive
+    source copies both tables on every query. `where`, a condition on the
+    returns columns (unqualified, %s placeholders allowed), is therefore
+    applied inside each UNION ALL branch; pass its parameters through
+    returns_params(). Join to staged key tables per table instead: a
+    temporary table cannot be opened twice in one query.
+
+    Use with an alias, e.g. f"FROM {returns_source(True, 'created_date >= %s')} s".
+    """
+    tables = returns_tables(include_archive)
+    if where is None:
+        if not include_archive:
+            return HOT_TABLE
+        # Whole tables, every column: full scans should select their columns per table instead
+        return f"(SELECT * FROM {HOT_TABLE} UNION ALL SELECT * FROM {ARCHIVE_TABLE})"
+    return "(" + " UNION ALL ".join(f"SELECT * FROM {table} WHERE {where}" for table in tables) + ")"
+
+
+def returns_tables(include_archive=False):
+    """The sales-return tables to read: the hot table, or hot and archive."""
+    return [HOT_TABLE, ARCHIVE_TABLE] if include_archive else [HOT_TABLE]
+
+
+def returns_params(params, include_archive=False):
+    """Parameters of a returns_source() condition, repeated once per UNION ALL branch."""
+    return list(params) * (2 if include_archive else 1)
+
+
+def archive_exists(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT 1 FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+            (ARCHIVE_TABLE,),
+        )
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+
+
+def archive_cutoff(horizon_days=DEFAULT_HORIZON_DAYS, today=None):
+    """Rows created before this date are old enough to archive."""
+    today = today or datetime.date.today()
+    return today - datetime.timedelta(days=horizon_days)
+
+
+def _hot_columns(cursor):
+    # Generated columns (dup_key_hash) are computed by the archive table itself
+    cursor.execute(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s
+        AND extra NOT LIKE '%%GENERATED%%'
+        ORDER BY ordinal_position
+        """,
+        (HOT_TABLE,),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def archive_status(conn, horizon_days=DEFAULT_HORIZON_DAYS):
+    """
+    Returns:
+        dict: hot_rows, archivable_rows (hidden or older than the horizon), archive_rows
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"""
+            SELECT COUNT(*), COALESCE(SUM(hidden = 1 OR created_date < %s), 0)
+            FROM {HOT_TABLE}
+            """,
+            (archive_cutoff(horizon_days),),
+        )
+        hot_rows, archivable_rows = cursor.fetchone()
+        cursor.execute(f"SELECT COUNT(*) FROM {ARCHIVE_TABLE}")
+        (archive_rows,) = cursor.fetchone()
+    finally:
+        cursor.close()
+    return {"hot_rows": int(hot_rows), "archivable_rows": int(archivable_rows), "archive_rows": int(archive_rows)}
+
+
+def archive_returns(conn, horizon_days=DEFAULT_HORIZON_DAYS, batch_size=DEFAULT_BATCH_SIZE, dry_run=False,
+                    log=print):
+    """
+    Move hidden and old rows from the hot table into the archive.
+
+    Parameters:
+        conn: Active MySQL connection object
+        horizon_days (int): Rows with created_date older than this are archived
+        batch_size (int): Rows copied and deleted per transaction
+        dry_run (bool): Only report how many rows would move
+        log (callable): Receives one progress line per batch
+
+    Returns:
+        int: Rows moved (or that would move, with dry_run)
+    """
+    cutoff = archive_cutoff(horizon_days)
+    cursor = conn.cursor()
+    try:
+        if dry_run:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {HOT_TABLE} WHERE hidden = 1 OR created_date < %s", (cutoff,)
+            )
+            return int(cursor.fetchone()[0])
+
+        column_list = ", ".join(f"`{name}`" for name in _hot_columns(cursor))
+        moved = 0
+        last_id = 0
+        while True:
+            cursor.execute(
+                f"""
+                SELECT id FROM {HOT_TABLE}
+                WHERE id > %s AND (hidden = 1 OR created_date < %s)
+                ORDER BY id LIMIT %s
+                """,
+                (last_id, cutoff, batch_size),
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            started = time.perf_counter()
+            id_placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(
+                f"INSERT INTO {ARCHIVE_TABLE} ({column_list}) "
+                f"SELECT {column_list} FROM {HOT_TABLE} WHERE id IN ({id_placeholders})",
+                ids,
+            )
+            cursor.execute(f"DELETE FROM {HOT_TABLE} WHERE id IN ({id_placeholders})", ids)
+            bump_versions(cursor, [SALES_RETURNS])
+            conn.commit()
+            moved += len(ids)
+            last_id = ids[-1]
+            log(f"  moved {len(ids)} rows up to id {last_id} in {time.perf_counter() - started:.2f}s")
+        return moved
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "run"])
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH)
+    parser.add_argument("--horizon-days", type=int, default=None,
+                        help=f"Default: [archive] horizon_days in secrets, else {DEFAULT_HORIZON_DAYS}")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    secrets = load_secrets(args.secrets)
+    horizon_days = args.horizon_days or int(secrets.get("archive", {}).get("horizon_days", DEFAULT_HORIZON_DAYS))
+    conn = mysql.connector.connect(**secrets["db_config"])
+    try:
+        if not archive_exists(conn):
+            raise SystemExit(f"❌ {ARCHIVE_TABLE} does not exist - run 'python migrations.py run' first")
+        if args.command == "status":
+            status = archive_status(conn, horizon_days)
+            print(f"hot rows:        {status['hot_rows']:>12,}")
+            print(f"archivable now:  {status['archivable_rows']:>12,}  (hidden or created before {archive_cutoff(horizon_days)})")
+            print(f"archived rows:   {status['archive_rows']:>12,}")
+        else:
+            moved = archive_returns(conn, horizon_days, args.batch_size, args.dry_run)
+            print(f"✅ {'Would move' if args.dry_run else 'Moved'} {moved:,} row(s) to {ARCHIVE_TABLE}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
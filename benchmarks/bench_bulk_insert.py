@@ -0,0 +1,141 @@
+"""
+Benchmark: row-by-row executemany vs db_write.bulk_insert strategies.
+
+Needs a MySQL server (connection taken from secrets.toml). Rows go into a
+TEMPORARY table shaped like the RTV insert, so nothing persists:
+
+    python benchmarks/bench_bulk_insert.py --secrets .streamlit/secrets.toml --rows 50000
+
+For the load_data strategy set allow_local_infile = true under [db_config]
+and local_infile=ON on the server.
+
+--check-fallback instead checks that strategy "auto" falls back to VALUES
+batches when LOCAL INFILE is refused, on connections opened with
+allow_local_infile = false, with the pure-Python and the C extension
+connector (exits with status 1 when it does not):
+
+    python benchmarks/bench_bulk_insert.py --check-fallback --rows 25000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import mysql.connector
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_pool import DEFAULT_SECRETS_PATH, load_secrets  # noqa: E402
+from db_write import bulk_insert  # noqa: E402
+
+TABLE = "bench_bulk_insert"
+
+
+def synthetic_frame(count):
+    now = datetime.datetime.now().replace(microsecond=0)
+    return pd.DataFrame({
+        "sr_no": [f"SR{i:07d}" for i in range(count)],
+        "outlet_name": [f"Store {i % 300}" for i in range(count)],
+        "bill_no": [f"GST/{i % 50000:06d}" for i in range(count)],
+        "combination_id": [f"C{i % 90000}" for i in range(count)],
+        "barcode": [f"89012{i:08d}" for i in range(count)],
+        "sold_qty": [1] * count,
+        "bill_amount": [499.0 + i % 7 for i in range(count)],
+        "discount_amount": [None if i % 5 else 25.5 for i in range(count)],
+        "return_date": [(now - datetime.timedelta(days=i % 30)).strftime("%Y-%m-%d") for i in range(count)],
+        "created_date": [now] * count,
+        "hidden": [0] * count,
+    })
+
+
+def executemany_path(cursor, df):
+    # What insert_data_transactional did before
+    columns = ", ".join(df.columns)
+    placeholders = ", ".join(["%s"] * len(df.columns))
+    values = [tuple(row) for row in df.astype(object).where(df.notna(), None).to_numpy()]
+    cursor.executemany(f"INSERT INTO {TABLE} ({columns}) VALUES ({placeholders})", values)
+    return cursor.rowcount
+
+
+def create_table(cursor):
+    cursor.execute(
+        f"""
+        CREATE TEMPORARY TABLE {TABLE} (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            sr_no VARCHAR(20), outlet_name VARCHAR(150), bill_no VARCHAR(64),
+            combination_id VARCHAR(64), barcode VARCHAR(64), sold_qty INT,
+            bill_amount DECIMAL(12, 2), discount_amount DECIMAL(12, 2),
+            return_date DATE, created_date DATETIME, hidden TINYINT
+        )
+        """
+    )
+
+
+def check_fallback(db_config, df):
+    # "auto" must load every row through VALUES batches when LOCAL INFILE is refused
+    failures = 0
+    for use_pure in (True, False):
+        label = "pure" if use_pure else "c extension"
+        try:
+            conn = mysql.connector.connect(**{**db_config, "allow_local_infile": False, "use_pure": use_pure})
+        except (mysql.connector.Error, ImportError) as err:
+            print(f"{label:<12} skipped: {err}")
+            continue
+        cursor = conn.cursor()
+        try:
+            create_table(cursor)
+            result = bulk_insert(cursor, df, TABLE, strategy="auto")
+            conn.rollback()
+            ok = result["strategy"] == "values" and result["rows"] == len(df)
+            print(f"{label:<12} {'ok' if ok else 'FAILED'}: {result['rows']} rows via {result['strategy']}")
+        except mysql.connector.Error as err:
+            ok = False
+            print(f"{label:<12} FAILED: errno {err.errno}: {err}")
+        finally:
+            cursor.close()
+            conn.close()
+        failures += not ok
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--check-fallback", action="store_true")
+    args = parser.parse_args()
+
+    df = synthetic_frame(args.rows)
+    db_config = load_secrets(args.secrets)["db_config"]
+    if args.check_fallback:
+        sys.exit(1 if check_fallback(db_config, df) else 0)
+
+    conn = mysql.connector.connect(**db_config)
+    cursor = conn.cursor()
+    create_table(cursor)
+    try:
+        runs = [
+            ("executemany", lambda: executemany_path(cursor, df)),
+            ("values batches", lambda: bulk_insert(cursor, df, TABLE, strategy="values")["rows"]),
+            ("load data infile", lambda: bulk_insert(cursor, df, TABLE, strategy="load_data")["rows"]),
+        ]
+        for label, run in runs:
+            started = time.perf_counter()
+            try:
+                rows = run()
+            except mysql.connector.Error as err:
+                print(f"{label:<18} failed: {err}")
+                conn.rollback()
+                continue
+            elapsed = time.perf_counter() - started
+            conn.rollback()
+            print(f"{label:<18} {rows:>8} rows  {elapsed:7.2f} s  {rows / elapsed:10,.0f} rows/s")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Benchmark: dictionary-cursor fetch vs db_query.fetch_dataframe.
+
+By default a synthetic 1M-row result set shaped like tbl_wh_sales_returns is
+served from memory, so only the client-side row handling is measured:
+
+    python benchmarks/bench_columnar_fetch.py --rows 1000000
+
+Pass --secrets (and optionally --query) to time both paths against a real
+MySQL server instead:
+
+    python benchmarks/bench_columnar_fetch.py --secrets .streamlit/secrets.toml \\
+        --query "SELECT * FROM tbl_wh_sales_returns LIMIT 1000000"
+"""
+import argparse
+import datetime
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_query import fetch_dataframe  # noqa: E402
+
+COLUMNS = [
+    "id", "sr_no", "outlet_name", "bill_no", "combination_id", "barcode",
+    "design_no", "Sold_qty", "bill_amount", "return_date", "created_date", "hidden",
+]
+
+
+def synthetic_rows(count):
+    created = datetime.datetime(2024, 1, 1, 10, 30)
+    return [
+        (
+            i,
+            f"SR{i:07d}",
+            f"Store {i % 300}",
+            f"GST/{i % 50000:06d}",
+            f"C{i % 90000}",
+            f"89012{i:08d}",
+            f"D-{i % 7000}",
+            1,
+            Decimal("499.00"),
+            datetime.date(2024, 1 + i % 12, 1 + i % 28),
+            created,
+            0,
+        )
+        for i in range(count)
+    ]
+
+
+class FakeCursor:
+    """Serves pre-built rows the way mysql-connector's tuple/dictionary cursors do."""
+
+    def __init__(self, rows, dictionary=False):
+        self._rows = rows
+        self._dictionary = dictionary
+        self._pos = 0
+        self.description = [(name,) for name in COLUMNS]
+
+    def execute(self, query, params=()):
+        self._pos = 0
+
+    def _convert(self, rows):
+        if self._dictionary:
+            return [dict(zip(COLUMNS, row)) for row in rows]
+        return list(rows)
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return self._convert(rows)
+
+    def fetchmany(self, size):
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return self._convert(rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self._rows, dictionary=dictionary)
+
+
+def dictionary_path(conn, query):
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(query)
+    df = pd.DataFrame(cursor.fetchall())
+    cursor.close()
+    return df
+
+
+def columnar_path(conn, query):
+    return fetch_dataframe(conn, query, dtypes={"bill_amount": "float64"})
+
+
+def measure(label, fn, conn, query):
+    # Time and memory are taken in separate runs: tracemalloc slows allocation-heavy code a lot
+    gc.collect()
+    started = time.perf_counter()
+    df = fn(conn, query)
+    elapsed = time.perf_counter() - started
+    rows = len(df)
+    del df
+
+    gc.collect()
+    tracemalloc.start()
+    fn(conn, query)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<22} {elapsed:8.2f} s   peak {peak / 1024 ** 2:9.1f} MiB   {rows:>9} rows")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--secrets", help="Path to secrets.toml to benchmark a live database")
+    parser.add_argument("--query", default="SELECT * FROM tbl_wh_sales_returns LIMIT 1000000")
+    args = parser.parse_args()
+
+    if args.secrets:
+        import mysql.connector
+        from db_pool import load_secrets
+
+        conn = mysql.connector.connect(**load_secrets(args.secrets)["db_config"])
+        query = args.query
+    else:
+        conn = FakeConnection(synthetic_rows(args.rows))
+        query = "SELECT * FROM tbl_wh_sales_returns"
+
+    dict_time = measure("dictionary cursor", dictionary_path, conn, query)
+    col_time = measure("columnar fetch", columnar_path, conn, query)
+    print(f"speed-up: {dict_time / col_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark: plain vs compressed client/server protocol for a report query.
+
+Runs the same SELECT over an uncompressed and a compressed connection and
+reports wall time and the bytes the server put on the wire (Bytes_sent):
+
+    python benchmarks/bench_compressed_fetch.py --secrets .streamlit/secrets.toml \\
+        --query "SELECT s.* FROM tbl_wh_sales_returns s WHERE s.created_date >= '2024-01-01'"
+
+The gain depends on the link: on a LAN the compression CPU can outweigh the
+saved transfer time, over a WAN link it usually does not.
+"""
+import argparse
+import os
+import sys
+import time
+
+import mysql.connector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_pool import DEFAULT_SECRETS_PATH, load_secrets  # noqa: E402
+from db_query import fetch_dataframe, measure_transfer  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH)
+    parser.add_argument("--query", default="SELECT * FROM tbl_wh_sales_returns LIMIT 200000")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    db_config = load_secrets(args.secrets)["db_config"]
+    for compress in (False, True):
+        conn = mysql.connector.connect(**{**db_config, "compress": compress})
+        try:
+            best = None
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                with measure_transfer(conn) as transfer:
+                    df = fetch_dataframe(conn, args.query, batch_size=args.batch_size)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            conn.close()
+        label = "compressed" if compress else "plain"
+        print(
+            f"{label:<11} {len(df):>9} rows  best {best:7.2f} s  "
+            f"{transfer['bytes_sent'] / 1024 ** 2:9.2f} MB on the wire"
+        )
+
+
+if __name__ == "__main__":
+    main()
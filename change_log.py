@@ -0,0 +1,193 @@
+"""
+Change feed for cache invalidation across app instances.
+
+tbl_wh_change_log holds one row per entity (a table name) with a version
+that every writer bumps in the same transaction as its change. A cache keeps
+the versions its data was loaded under and reloads only when one of them has
+moved, so every app instance sees a write on its next check instead of
+refetching on a timer:
+
+    cache = VersionedCache(pool, check_interval=2)
+    stores = cache.get("store_config", ["tbl_wh_store_config"], load_store_config)
+
+The table is created by migration 5; until then fetch_versions() returns an
+empty dict and VersionedCache falls back to reloading on every get().
+"""
+import threading
+import time
+
+import mysql.connector
+from mysql.connector import errorcode
+
+CHANGE_LOG_TABLE = "tbl_wh_change_log"
+SALES_RETURNS = "tbl_wh_sales_returns"
+TRANSFER_OUT = "tbl_wh_transfer_out"
+STORE_CONFIG = "tbl_wh_store_config"
+# Bumped only when returns are hidden: rows leaving the visible set, which
+# readers that follow new ids (dup_keys.DuplicateKeyIndex) cannot detect
+SALES_RETURNS_HIDDEN = "tbl_wh_sales_returns.hidden"
+ENTITIES = (SALES_RETURNS, TRANSFER_OUT, STORE_CONFIG)
+# Seconds a duplicate-key index may go without a rebuild when hides cannot be seen
+UNVERSIONED_MAX_AGE = 900
+
+
+def bump_versions(cursor, entities):
+    """
+    Bump the version of each entity inside the caller's transaction (nothing is committed).
+
+    Rows are touched in sorted order so concurrent writers lock them in the
+    same order; call this last, just before the commit, to hold the row
+    locks as briefly as possible.
+    """
+    entities = sorted(set(entities))
+    if not entities:
+        return
+    try:
+        cursor.execute(
+            f"""
+            INSERT INTO {CHANGE_LOG_TABLE} (entity, version)
+            VALUES {', '.join(['(%s, 1)'] * len(entities))}
+            ON DUPLICATE KEY UPDATE version = version + 1, changed_at = CURRENT_TIMESTAMP
+            """,
+            entities,
+        )
+    except mysql.connector.Error as err:
+        # Before migration 5 there is nothing to bump; a failed statement
+        # does not roll back the rest of the transaction
+        if err.errno != errorcode.ER_NO_SUCH_TABLE:
+            raise
+
+
+def fetch_versions(conn):
+    """
+    Returns:
+        dict: entity -> version; empty when the change log table does not exist yet
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT entity, version FROM {CHANGE_LOG_TABLE}")
+        return {entity: int(version) for entity, version in cursor.fetchall()}
+    except mysql.connector.Error as err:
+        if err.errno != errorcode.ER_NO_SUCH_TABLE:
+            raise
+        return {}
+    finally:
+        cursor.close()
+
+
+def hidden_version(versions, max_age=UNVERSIONED_MAX_AGE, clock=time.time):
+    """
+    Version to build a duplicate-key index under (DuplicateKeyIndex.refresh()).
+
+    Parameters:
+        versions (dict): fetch_versions() result
+
+    Returns:
+        The SALES_RETURNS_HIDDEN version (None until the first hide). Before
+        migration 5 hides cannot be seen, so a label that changes every
+        `max_age` seconds: the index is rebuilt at that pace, not on every upload.
+    """
+    if versions:
+        return versions.get(SALES_RETURNS_HIDDEN)
+    return f"unversioned-{int(clock() // max_age)}"
+
+
+class VersionedCache:
+    """
+    Process-wide cache whose entries are tied to change-log versions.
+
+    The versions are read with one query at most every `check_interval`
+    seconds, shared by all entries. Loaders run on a connection from the
+    same pool as the version check; use the primary, since data read from a
+    lagging replica could be cached under a version it does not reflect.
+
+    Neither the check nor a load runs under the lock that guards the
+    entries: one thread checks while the others wait for its result, and
+    each key has its own load lock, so a slow loader only holds up callers
+    of the same key.
+    """
+
+    def __init__(self, pool, check_interval=2.0, clock=time.monotonic):
+        self._pool = pool
+        self._check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self._load_locks = {}
+        self._versions = {}
+        self._checked_at = None
+        self._entries = {}
+        self._stats = {"checks": 0, "hits": 0, "loads": 0}
+
+    def _stale(self, now):
+        # Caller holds self._lock
+        return self._checked_at is None or now - self._checked_at >= self._check_interval
+
+    def _current_versions(self):
+        with self._lock:
+            if not self._stale(self._clock()):
+                return self._versions
+        # Single flight: whoever gets the check lock first queries, the rest reuse its result
+        with self._check_lock:
+            with self._lock:
+                now = self._clock()
+                if not self._stale(now):
+                    return self._versions
+            with self._pool.connection() as conn:
+                versions = fetch_versions(conn)
+            with self._lock:
+                self._versions = versions
+                self._checked_at = now
+                self._stats["checks"] += 1
+            return versions
+
+    def _cached(self, key, wanted):
+        # Caller holds self._lock
+        entry = self._entries.get(key)
+        if entry is not None and None not in wanted and entry[0] == wanted:
+            self._stats["hits"] += 1
+            return True, entry[1]
+        return False, None
+
+    def get(self, key, entities, loader):
+        """
+        Cached value for `key`, reloaded with loader(conn) when a version of `entities` changed.
+
+        Entities missing from the change log never match, so their entries
+        are reloaded on every call.
+        """
+        versions = self._current_versions()
+        wanted = tuple(versions.get(entity) for entity in entities)
+        with self._lock:
+            hit, value = self._cached(key, wanted)
+            if hit:
+                return value
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        # One load per key at a time; a caller that waited takes the value just loaded
+        with load_lock:
+            with self._lock:
+                hit, value = self._cached(key, wanted)
+                if hit:
+                    return value
+            with self._pool.connection() as conn:
+                value = loader(conn)
+            with self._lock:
+                self._entries[key] = (wanted, value)
+                self._stats["loads"] += 1
+            return value
+
+    def refresh(self):
+        """Re-read the versions on the next get(), e.g. right after this process wrote."""
+        with self._lock:
+            self._checked_at = None
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
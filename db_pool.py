@@ -0,0 +1,339 @@
+import threading
+import time
+import tomllib
+from contextlib import contextmanager
+
+import mysql.connector
+
+
+DEFAULT_SECRETS_PATH = ".streamlit/secrets.toml"
+
+
+def load_secrets(path=DEFAULT_SECRETS_PATH):
+    """
+    Read the Streamlit secrets file outside of a running app (CLI tools, benchmarks).
+
+    Returns:
+        dict: Parsed TOML sections, e.g. secrets["db_config"]
+    """
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection is returned within the checkout timeout."""
+
+
+class ConnectionPool:
+    """
+    Process-wide pool of MySQL connections shared by every Streamlit session.
+
+    Connections are opened lazily up to `size`, or ahead of time with
+    `warm_up()`. `connection()` hands one out as a context manager and returns
+    it to the pool when the block exits; any transaction left open by the
+    caller is rolled back first so the next user never inherits a stale
+    snapshot or half-finished write. When every connection is busy, callers
+    wait up to `checkout_timeout` seconds, for a connection handed back or for
+    a slot freed by a discarded one (both wake a waiter).
+
+    A connection that sat idle for `ping_after_idle` seconds or more is pinged
+    before it is handed out, and replaced with a fresh one if the server has
+    dropped it (wait_timeout, failover, network blip), so callers never see a
+    stale connection. `start_keepalive()` pings idle connections in the
+    background so they are not dropped in the first place.
+
+    Parameters:
+        db_config (dict): Keyword arguments for mysql.connector.connect
+        size (int): Maximum number of open connections
+        checkout_timeout (float): Seconds to wait for a free connection
+        connect (callable): Connection factory, defaults to mysql.connector.connect
+        compress (bool): Use the compressed client/server protocol - worth it
+            over a WAN link, where result sets of text columns shrink several-fold
+        ping_after_idle (float): Idle seconds after which checkout pings first
+            (None never pings, 0 pings on every checkout)
+    """
+
+    def __init__(self, db_config, size=10, checkout_timeout=30, connect=None, compress=False, ping_after_idle=60,
+                 clock=time.monotonic):
+        self.db_config = dict(db_config)
+        if compress:
+            self.db_config["compress"] = True
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.ping_after_idle = ping_after_idle
+        self._connect = connect or mysql.connector.connect
+        self._clock = clock
+        # (connection, time it was returned) - most recently used last; guarded by _lock
+        self._idle = []
+        self._lock = threading.Lock()
+        # Notified whenever a connection is returned or a slot below `size` frees up
+        self._available = threading.Condition(self._lock)
+        self._closed = threading.Event()
+        self._opened = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+        self._connects = 0
+        self._connect_time = 0.0
+        self._connect_time_max = 0.0
+        self._pings = 0
+        self._stale = 0
+        self._reconnect_time = 0.0
+
+    def _open(self):
+        started = time.perf_counter()
+        try:
+            conn = self._connect(**self.db_config)
+        except Exception:
+            with self._available:
+                self._opened -= 1
+                self._available.notify()
+            raise
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._connects += 1
+            self._connect_time += elapsed
+            self._connect_time_max = max(self._connect_time_max, elapsed)
+        return conn
+
+    def _ping(self, conn):
+        # True if the server still answers on `conn`
+        with self._lock:
+            self._pings += 1
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _checked(self, conn, released_at):
+        # Hand out `conn` as is, after a ping, or replaced by a new connection
+        if self.ping_after_idle is None or self._clock() - released_at < self.ping_after_idle:
+            return conn
+        if self._ping(conn):
+            return conn
+        self._replace_stale(conn)
+        started = time.perf_counter()
+        conn = self._open()
+        with self._lock:
+            self._reconnect_time += time.perf_counter() - started
+        return conn
+
+    def _acquire(self):
+        started = None
+        with self._available:
+            # An idle connection, else a new one below `size`, else wait for either
+            while not self._idle and self._opened >= self.size:
+                if started is None:
+                    started = time.perf_counter()
+                remaining = self.checkout_timeout - (time.perf_counter() - started)
+                if remaining <= 0:
+                    self._waits += 1
+                    self._wait_time += time.perf_counter() - started
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"No database connection became free within {self.checkout_timeout}s "
+                        f"({self.size} connections in use)"
+                    )
+                self._available.wait(remaining)
+            if started is not None:
+                self._waits += 1
+                self._wait_time += time.perf_counter() - started
+            entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                self._opened += 1
+        if entry is None:
+            return self._open()
+        return self._checked(*entry)
+
+    def _replace_stale(self, conn):
+        # Close `conn` but keep its slot for the connection opened next, so no waiter takes it meanwhile
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._discarded += 1
+            self._stale += 1
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._available:
+            self._opened -= 1
+            self._discarded += 1
+            self._available.notify()
+
+    def _put_idle(self, conn):
+        with self._available:
+            self._idle.append((conn, self._clock()))
+            self._available.notify()
+
+    def _release(self, conn):
+        try:
+            # End whatever transaction the caller left open (no-op after commit)
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        self._put_idle(conn)
+
+    def warm_up(self, count=None):
+        """
+        Open connections ahead of the first request, e.g. at server start.
+
+        Parameters:
+            count (int): Idle connections to have ready (default and maximum: size)
+
+        Returns:
+            int: Connections opened by this call
+        """
+        count = self.size if count is None else min(count, self.size)
+        opened = 0
+        while True:
+            with self._lock:
+                if len(self._idle) >= count or self._opened >= self.size:
+                    break
+                self._opened += 1
+            self._put_idle(self._open())
+            opened += 1
+        return opened
+
+    def keepalive(self):
+        """
+        Ping every idle connection once; dead ones are replaced with new connections.
+
+        Idle connections are taken out while they are pinged, so a checkout
+        in the meantime opens a new connection or waits briefly.
+
+        Returns:
+            int: Connections that had to be replaced
+        """
+        with self._lock:
+            entries, self._idle = self._idle[::-1], []
+        replaced = 0
+        # Oldest first, so the most recently used connection ends up on top again
+        for conn, released_at in reversed(entries):
+            if not self._ping(conn):
+                self._replace_stale(conn)
+                try:
+                    conn = self._open()
+                except Exception:
+                    continue
+                replaced += 1
+            self._put_idle(conn)
+        return replaced
+
+    def start_keepalive(self, interval):
+        """Run keepalive() every `interval` seconds in a daemon thread until close_all()."""
+        def run():
+            while not self._closed.wait(interval):
+                try:
+                    self.keepalive()
+                except Exception:
+                    pass
+
+        thread = threading.Thread(target=run, name="db-pool-keepalive", daemon=True)
+        thread.start()
+        return thread
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a pooled connection for the duration of a `with` block.
+
+        Uncommitted work is rolled back when the block exits, whether or not
+        it raised, so callers must commit explicitly.
+        """
+        conn = self._acquire()
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._release(conn)
+
+    def stats(self):
+        """Return a snapshot of pool usage counters."""
+        with self._lock:
+            return {
+                "size": self.size,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time": round(self._wait_time, 3),
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "connects": self._connects,
+                "connect_time_avg": round(self._connect_time / self._connects, 3) if self._connects else 0.0,
+                "connect_time_max": round(self._connect_time_max, 3),
+                "pings": self._pings,
+                "stale_replaced": self._stale,
+                "reconnect_time": round(self._reconnect_time, 3),
+            }
+
+    def kill_query(self, connection_id):
+        """
+        Abort the statement running on `connection_id` (KILL QUERY).
+
+        Uses a short-lived connection outside the pool, so it works even when
+        every pooled connection is busy. The target connection stays open and
+        can go back to the pool once its caller has handled the error.
+        """
+        conn = self._connect(**self.db_config)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("KILL QUERY %s", (int(connection_id),))
+            cursor.close()
+        finally:
+            conn.close()
+
+    def close_all(self):
+        """Close every idle connection and stop the keepalive thread, e.g. before the pool is dropped."""
+        self._closed.set()
+        with self._lock:
+            entries, self._idle = self._idle, []
+        for conn, _ in entries:
+            self._discard(conn)
+
+
+class ReadRouter:
+    """
+    Chooses the pool for read-only queries: the replica when one is configured,
+    the primary otherwise.
+
+    A session that has just committed reads from the primary for
+    `sticky_seconds`, so it sees its own writes before they reach the replica.
+    The deadline is kept in the caller's per-session mapping (st.session_state).
+
+    Parameters:
+        primary (ConnectionPool): Pool that takes every write
+        replica (ConnectionPool): Optional read-only pool
+        sticky_seconds (float): Read-your-writes window after a commit
+    """
+
+    SESSION_KEY = "read_primary_until"
+
+    def __init__(self, primary, replica=None, sticky_seconds=30, clock=time.monotonic):
+        self.primary = primary
+        self.replica = replica
+        self.sticky_seconds = sticky_seconds
+        self._clock = clock
+
+    def for_read(self, session):
+        if self.replica is None or self._clock() < session.get(self.SESSION_KEY, 0):
+            return self.primary
+        return self.replica
+
+    def mark_write(self, session):
+        session[self.SESSION_KEY] = self._clock() + self.sticky_seconds
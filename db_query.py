@@ -0,0 +1,435 @@
+import datetime
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Rows pulled from the server per fetchmany() round
+DEFAULT_BATCH_SIZE = 10000
+# Key rows per multi-row INSERT when staging lookup keys
+STAGE_BATCH_SIZE = 1000
+# Seconds between checks of should_cancel() while a budgeted query runs
+CANCEL_POLL_INTERVAL = 0.5
+
+# MySQL errors for a SELECT stopped by MAX_EXECUTION_TIME / by KILL QUERY
+ER_QUERY_TIMEOUT = 3024
+ER_QUERY_INTERRUPTED = 1317
+
+
+class QueryCancelled(Exception):
+    """
+    A query stopped by its time budget (reason 'timeout') or by the session
+    going away (reason 'cancelled').
+    """
+
+    def __init__(self, reason, elapsed, timeout=None):
+        self.reason = reason
+        self.elapsed = elapsed
+        self.timeout = timeout
+        if reason == "timeout":
+            message = f"Query stopped after {elapsed:.1f}s (limit {timeout:g}s)"
+        else:
+            message = f"Query cancelled after {elapsed:.1f}s"
+        super().__init__(message)
+
+
+def fetch_dataframe(conn, query, params=None, dtypes=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Run a SELECT and build a DataFrame column by column from plain tuple rows.
+
+    Dictionary cursors allocate one dict per row before pandas re-reads every
+    key. Here each fetchmany() batch of tuples is copied into a 2-D object
+    block, sliced into per-column arrays (cast right away when `dtypes` names
+    the column) and the batch tuples are dropped before the next round trip.
+
+    Parameters:
+        conn: Active MySQL connection object
+        query (str): SQL to execute
+        params (sequence): Query parameters
+        dtypes (dict): Optional column name -> dtype map applied per batch
+        batch_size (int): Rows per fetchmany() call
+
+    Returns:
+        pd.DataFrame: Result set (with column names even when there are no rows)
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params or ())
+        return frame_from_cursor(cursor, dtypes, batch_size)
+    finally:
+        cursor.close()
+
+
+def frame_from_cursor(cursor, dtypes=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Build a DataFrame from a cursor that has just executed a SELECT.
+
+    The cursor is left open, so cached (e.g. prepared) cursors can be reused.
+    """
+    dtypes = dtypes or {}
+    columns = [desc[0] for desc in cursor.description]
+    column_dtypes = [dtypes.get(name) for name in columns]
+    chunks = [[] for _ in columns]
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        block = np.empty((len(rows), len(columns)), dtype=object)
+        block[:] = rows
+        for position, dtype in enumerate(column_dtypes):
+            column = block[:, position]
+            if dtype is not None:
+                column = pd.Series(column, copy=False).astype(dtype)
+            chunks[position].append(column)
+
+    # Build positionally so duplicate column names (e.g. s.* plus a join) survive
+    data = {}
+    for position, dtype in enumerate(column_dtypes):
+        parts = chunks[position]
+        if not parts:
+            data[position] = pd.Series([], dtype=dtype if dtype is not None else object)
+        elif dtype is not None:
+            data[position] = pd.concat(parts, ignore_index=True)
+        else:
+            # Infer datetime/int/float columns the way DataFrame(list_of_dicts) does
+            data[position] = pd.Series(np.concatenate(parts), copy=False).infer_objects()
+    df = pd.DataFrame(data)
+    df.columns = columns
+    return df
+
+
+def date_range_bounds(start_date, end_date):
+    """
+    Half-open bounds for an inclusive date filter on a DATETIME column.
+
+    `DATE(col) BETWEEN start AND end` hides the column inside a function and
+    cannot use an index; `col >= start AND col < end + 1 day` selects the same
+    rows and can.
+
+    Returns:
+        tuple: (start_date, day after end_date)
+    """
+    return start_date, end_date + datetime.timedelta(days=1)
+
+
+def _plain(value):
+    # numpy scalars (from itertuples on numeric columns) -> Python values the connector can bind
+    return value.item() if isinstance(value, np.generic) else value
+
+
+# (database, table, column) -> (column definition, max characters or None)
+_source_column_types = {}
+_source_column_lock = threading.Lock()
+
+
+def source_column_type(conn, table, column):
+    """
+    Column definition matching `table`.`column` of the connection's database:
+    its declared type plus CHARACTER SET / COLLATE for text columns, read once
+    from information_schema and cached per process.
+
+    A key column with the session default collation cannot be compared with a
+    production column that uses another one (error 1267, illegal mix of
+    collations), and a fixed VARCHAR(64) refuses longer keys.
+
+    Returns:
+        tuple: (SQL column definition, max length in characters or None)
+
+    Raises:
+        ValueError: The column does not exist
+    """
+    cache_key = (getattr(conn, "database", None), table, column)
+    with _source_column_lock:
+        cached = _source_column_types.get(cache_key)
+    if cached is not None:
+        return cached
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            SELECT COLUMN_TYPE, CHARACTER_SET_NAME, COLLATION_NAME, CHARACTER_MAXIMUM_LENGTH
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+            """,
+            (table, column),
+        )
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if row is None:
+        raise ValueError(f"Column {table}.{column} not found")
+    column_type, charset, collation, max_length = (
+        value.decode() if isinstance(value, (bytes, bytearray)) else value for value in row
+    )
+    if column_type.lower() in ("text", "mediumtext", "longtext", "tinytext"):
+        # TEXT cannot be indexed without a prefix; stage as a VARCHAR of the same collation
+        column_type, max_length = "VARCHAR(255)", 255
+    definition = column_type
+    if charset:
+        definition += f" CHARACTER SET {charset} COLLATE {collation}"
+    resolved = (definition, int(max_length) if max_length is not None else None)
+    with _source_column_lock:
+        _source_column_types[cache_key] = resolved
+    return resolved
+
+
+@contextmanager
+def staged_keys(conn, table_name, columns, rows, batch_size=STAGE_BATCH_SIZE):
+    """
+    Load lookup keys into an indexed session TEMPORARY table for JOINs.
+
+    Replaces `WHERE (a, b) IN ((%s, %s), ...)` lists, which MySQL plans poorly
+    and which grow the packet with every key. Rows are de-duplicated and sent
+    as chunked multi-row INSERTs. The table is dropped on exit; it is also
+    dropped up front because pooled connections keep their session (and any
+    temporary table left over from an aborted run).
+
+    A column given as (table, column) is created like that production column
+    (source_column_type), so the JOIN compares under the same collation. Rows
+    with a value longer than such a column holds are left out: no stored
+    value can equal them.
+
+    Parameters:
+        conn: Active MySQL connection object
+        table_name (str): Name of the temporary table (e.g. 'tmp_rtv_keys')
+        columns (dict): Column name -> SQL type or (table, column) to copy, in key order
+        rows (iterable): Tuples with one value per column
+        batch_size (int): Rows per INSERT statement
+
+    Returns:
+        str: table_name, to be used in the caller's JOIN
+    """
+    sql_types, max_lengths = [], []
+    for spec in columns.values():
+        if isinstance(spec, tuple):
+            sql_type, max_length = source_column_type(conn, *spec)
+        else:
+            sql_type, max_length = spec, None
+        sql_types.append(sql_type)
+        max_lengths.append(max_length)
+
+    unique_rows = [
+        row for row in dict.fromkeys(tuple(_plain(v) for v in row) for row in rows)
+        if all(
+            limit is None or not isinstance(value, str) or len(value) <= limit
+            for value, limit in zip(row, max_lengths)
+        )
+    ]
+    column_defs = ", ".join(f"`{name}` {sql_type}" for name, sql_type in zip(columns, sql_types))
+    column_list = ", ".join(f"`{name}`" for name in columns)
+    row_placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {table_name}")
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {table_name} ({column_defs}, INDEX idx_keys ({column_list})) ENGINE=InnoDB"
+        )
+        for start in range(0, len(unique_rows), batch_size):
+            chunk = unique_rows[start:start + batch_size]
+            cursor.execute(
+                f"INSERT INTO {table_name} ({column_list}) VALUES {', '.join([row_placeholder] * len(chunk))}",
+                [value for row in chunk for value in row],
+            )
+    finally:
+        cursor.close()
+
+    try:
+        yield table_name
+    finally:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {table_name}")
+        finally:
+            cursor.close()
+
+
+@contextmanager
+def query_budget(conn, timeout=None, should_cancel=None, kill_query=None):
+    """
+    Bound the SELECTs run on `conn` inside the block.
+
+    `timeout` seconds become the session's MAX_EXECUTION_TIME, so the server
+    aborts a runaway statement by itself; it is reset to 0 (no limit) on exit
+    because pooled connections keep session variables. When `should_cancel`
+    and `kill_query` are given, a watchdog thread polls should_cancel() and
+    calls kill_query(connection_id) once it returns True, e.g. when the user
+    reruns the page while a report is still running.
+
+    Parameters:
+        conn: Active MySQL connection object
+        timeout (float): Seconds per statement; None or 0 for no limit
+        should_cancel (callable): Returns True once the result is no longer wanted
+        kill_query (callable): Aborts the statement on a connection id (ConnectionPool.kill_query)
+
+    Raises:
+        QueryCancelled: The statement hit the time budget or was killed
+    """
+    started = time.perf_counter()
+    if timeout:
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (int(timeout * 1000),))
+        cursor.close()
+
+    done = threading.Event()
+    killed = threading.Event()
+    watchdog = None
+    if should_cancel is not None and kill_query is not None:
+        connection_id = conn.connection_id
+
+        def watch():
+            while not done.wait(CANCEL_POLL_INTERVAL):
+                if should_cancel():
+                    killed.set()
+                    try:
+                        kill_query(connection_id)
+                    except Exception:
+                        pass
+                    return
+
+        watchdog = threading.Thread(target=watch, name=f"query-watchdog-{connection_id}", daemon=True)
+        watchdog.start()
+
+    try:
+        yield
+    except Exception as err:
+        errno = getattr(err, "errno", None)
+        elapsed = time.perf_counter() - started
+        if errno == ER_QUERY_TIMEOUT:
+            raise QueryCancelled("timeout", elapsed, timeout) from err
+        if errno == ER_QUERY_INTERRUPTED or (killed.is_set() and errno is not None):
+            raise QueryCancelled("cancelled", elapsed) from err
+        raise
+    finally:
+        done.set()
+        if watchdog is not None:
+            watchdog.join()
+        if timeout:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SET SESSION MAX_EXECUTION_TIME = 0")
+                cursor.close()
+            except Exception:
+                # A broken connection fails its rollback next and is dropped by the pool
+                pass
+
+
+def session_bytes(conn):
+    """
+    Bytes the server has sent to / received from this connection so far.
+
+    Counted on the wire, i.e. after protocol compression.
+
+    Returns:
+        dict: {'Bytes_sent': int, 'Bytes_received': int}
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SHOW SESSION STATUS WHERE Variable_name IN ('Bytes_sent', 'Bytes_received')")
+        return {name: int(value) for name, value in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def measure_transfer(conn):
+    """
+    Measure network transfer for the queries run on `conn` inside the block.
+
+    Yields a dict that is filled in when the block exits normally:
+    bytes_sent (server -> app, the result sets), bytes_received (app -> server)
+    and seconds. Costs two extra SHOW STATUS round trips.
+    """
+    transfer = {}
+    before = session_bytes(conn)
+    started = time.perf_counter()
+    yield transfer
+    seconds = time.perf_counter() - started
+    after = session_bytes(conn)
+    transfer["bytes_sent"] = after["Bytes_sent"] - before["Bytes_sent"]
+    transfer["bytes_received"] = after["Bytes_received"] - before["Bytes_received"]
+    transfer["seconds"] = seconds
+
+
+class PreparedStatements:
+    """
+    Named queries prepared once per connection and reused afterwards.
+
+    The server parses and plans a prepared statement a single time; later
+    executions only ship the parameters. That holds for statements on
+    permanent tables only: when a table a statement reads is dropped and
+    re-created (a staged_keys() temporary table) the server re-prepares it on
+    the next execution, so such queries gain nothing here. Cursors
+    (cursor(prepared=True)) are cached per connection in a weak map, so they
+    go away with the connection when the pool discards it.
+
+    `stats()` counts per name, on the client: "prepared" - cursors created,
+    one server-side prepare each; "reused" - executions on an existing
+    cursor, each a parse the server skipped unless it had to re-prepare
+    (server_reprepares() reads the server's own count for a connection).
+
+    Parameters:
+        statements (dict): Name -> SQL with %s placeholders
+    """
+
+    def __init__(self, statements):
+        self.statements = dict(statements)
+        self._cursors = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._prepares = Counter()
+        self._hits = Counter()
+
+    def cursor(self, conn, name):
+        # A pooled connection is used by one thread at a time, so its entry needs no lock
+        cursors = self._cursors.setdefault(conn, {})
+        cursor = cursors.get(name)
+        with self._lock:
+            if cursor is None:
+                self._prepares[name] += 1
+            else:
+                self._hits[name] += 1
+        if cursor is None:
+            cursor = cursors[name] = conn.cursor(prepared=True)
+        return cursor
+
+    def execute(self, conn, name, params=()):
+        """
+        Run statement `name` on `conn` and return the (cached) cursor.
+
+        Read any result set before running another statement on `conn`; do
+        not close the cursor.
+        """
+        cursor = self.cursor(conn, name)
+        try:
+            cursor.execute(self.statements[name], tuple(params))
+        except Exception:
+            # Drop the cursor so a failed prepare is retried from scratch next time
+            self._cursors.get(conn, {}).pop(name, None)
+            raise
+        return cursor
+
+    def fetch_dataframe(self, conn, name, params=(), dtypes=None, batch_size=DEFAULT_BATCH_SIZE):
+        return frame_from_cursor(self.execute(conn, name, params), dtypes, batch_size)
+
+    @staticmethod
+    def server_reprepares(conn):
+        """Com_stmt_reprepare of `conn`'s session: statements the server had to prepare again."""
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SHOW SESSION STATUS LIKE 'Com_stmt_reprepare'")
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        return int(row[1]) if row else 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {"prepared": self._prepares[name], "reused": self._hits[name]}
+                for name in self.statements
+            }
@@ -0,0 +1,250 @@
+import csv
+import os
+import random
+import tempfile
+import time
+
+import mysql.connector
+from mysql.connector import errorcode
+
+# Rows per multi-row INSERT ... VALUES statement
+VALUES_BATCH_SIZE = 1000
+# From this many rows on, "auto" tries LOAD DATA LOCAL INFILE first
+LOAD_DATA_MIN_ROWS = 20000
+
+# Errors meaning LOCAL INFILE is switched off on the server or the client
+# (allow_local_infile in db_config) - fall back to VALUES batches
+_LOCAL_INFILE_DISABLED = {
+    errorcode.ER_NOT_ALLOWED_COMMAND,
+    getattr(errorcode, "ER_CLIENT_LOCAL_FILES_DISABLED", 3948),
+    getattr(errorcode, "CR_LOAD_DATA_LOCAL_INFILE_REJECTED", 2068),
+}
+# The pure-Python connector reports both as errno -1, so the message is checked too
+_LOCAL_INFILE_MESSAGES = ("local infile", "local_infile", "loading local data is disabled")
+
+# Lock wait timeout / deadlock: InnoDB has rolled back (the statement or the
+# whole transaction) and re-running the transaction usually succeeds
+LOCK_CONFLICT_ERRORS = {errorcode.ER_LOCK_WAIT_TIMEOUT, errorcode.ER_LOCK_DEADLOCK}
+
+
+class _NullField:
+    # csv.QUOTE_NONNUMERIC leaves numbers unquoted; posing as one writes a bare NULL,
+    # which LOAD DATA (with ESCAPED BY '') reads as SQL NULL while "NULL" stays a string
+    def __float__(self):
+        return 0.0
+
+    def __str__(self):
+        return "NULL"
+
+
+NULL_FIELD = _NullField()
+
+
+def _python_rows(df):
+    # Box every cell as a plain Python value in one pass; NaN/NaT/None -> None
+    values = df.astype(object).where(df.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def _csv_value(value):
+    if value is None:
+        return NULL_FIELD
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        # '12.0' is rejected by INT columns in strict mode
+        return int(value)
+    return value
+
+
+def insert_values_batches(cursor, df, table_name, batch_size=VALUES_BATCH_SIZE):
+    """
+    Insert `df` with multi-row INSERT ... VALUES statements of `batch_size` rows.
+
+    Returns:
+        int: Number of rows inserted
+    """
+    columns = ", ".join(df.columns)
+    row_placeholder = "(" + ", ".join(["%s"] * len(df.columns)) + ")"
+    rows = list(_python_rows(df))
+    inserted = 0
+    for start in range(0, len(rows), batch_size):
+        chunk = rows[start:start + batch_size]
+        query = f"INSERT INTO {table_name} ({columns}) VALUES {', '.join([row_placeholder] * len(chunk))}"
+        cursor.execute(query, [value for row in chunk for value in row])
+        inserted += cursor.rowcount
+    return inserted
+
+
+def load_data_infile(cursor, df, table_name):
+    """
+    Insert `df` with LOAD DATA LOCAL INFILE.
+
+    The frame is written as CSV (strings quoted, NULL bare) to a temporary file,
+    because mysql-connector streams LOCAL INFILE data from a path; the file is
+    removed afterwards. Needs local_infile=ON on the server and
+    allow_local_infile = true in db_config.
+
+    Returns:
+        int: Number of rows loaded
+    """
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+            for row in _python_rows(df):
+                writer.writerow([_csv_value(value) for value in row])
+
+        columns = ", ".join(df.columns)
+        cursor.execute(
+            f"""
+            LOAD DATA LOCAL INFILE %s INTO TABLE {table_name}
+            CHARACTER SET utf8mb4
+            FIELDS TERMINATED BY ',' ENCLOSED BY '"' ESCAPED BY ''
+            LINES TERMINATED BY '\\n'
+            ({columns})
+            """,
+            (path,),
+        )
+        return cursor.rowcount
+    finally:
+        os.remove(path)
+
+
+def local_infile_disabled(err):
+    """True if `err` says LOAD DATA LOCAL INFILE is not allowed by the server or the client."""
+    if err.errno in _LOCAL_INFILE_DISABLED:
+        return True
+    message = str(getattr(err, "msg", None) or err).lower()
+    return any(text in message for text in _LOCAL_INFILE_MESSAGES)
+
+
+def server_local_infile(cursor):
+    """@@GLOBAL.local_infile of the server: False when it refuses LOCAL INFILE outright."""
+    cursor.execute("SELECT @@GLOBAL.local_infile")
+    (enabled,) = cursor.fetchone()
+    return bool(int(enabled))
+
+
+def bulk_insert(cursor, df, table_name, strategy="auto", batch_size=VALUES_BATCH_SIZE):
+    """
+    Insert a DataFrame inside the caller's transaction (nothing is committed).
+
+    Parameters:
+        cursor: Active cursor from the connection
+        df (pd.DataFrame): Rows to insert; column names must match the table
+        table_name (str): The name of the target table
+        strategy (str): "values", "load_data" or "auto" - LOAD DATA from
+            LOAD_DATA_MIN_ROWS rows on, VALUES batches below that or when the
+            server (checked first) or the client has LOCAL INFILE disabled
+        batch_size (int): Rows per INSERT statement for the VALUES strategy
+
+    Returns:
+        dict: rows, seconds, rows_per_sec and the strategy actually used
+
+    Raises:
+        mysql.connector.Error: Any database error during insertion
+    """
+    if strategy not in ("auto", "values", "load_data"):
+        raise ValueError(f"Unknown bulk insert strategy: {strategy}")
+    started = time.perf_counter()
+    used = strategy
+    if strategy == "auto":
+        used = "load_data" if len(df) >= LOAD_DATA_MIN_ROWS and server_local_infile(cursor) else "values"
+
+    if used == "load_data":
+        try:
+            rows = load_data_infile(cursor, df, table_name)
+        except mysql.connector.Error as err:
+            # Still possible when the client side (allow_local_infile) refuses
+            if strategy != "auto" or not local_infile_disabled(err):
+                raise
+            used = "values"
+    if used == "values":
+        rows = insert_values_batches(cursor, df, table_name, batch_size)
+
+    seconds = time.perf_counter() - started
+    return {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_sec": rows / seconds if seconds > 0 else float(rows),
+        "strategy": used,
+    }
+
+
+def is_lock_conflict(err):
+    """True if `err`, or an error it was raised from, is a lock wait timeout or deadlock."""
+    while err is not None:
+        if getattr(err, "errno", None) in LOCK_CONFLICT_ERRORS:
+            return True
+        err = err.__cause__ or err.__context__
+    return False
+
+
+def run_in_transaction(pool, work, attempts=4, base_delay=0.25, max_delay=4.0, on_retry=None, stats=None,
+                       prepare=None):
+    """
+    Run `work(conn, cursor)` in its own transaction and commit, retrying on lock conflicts.
+
+    Each attempt borrows a pooled connection, so a failed attempt is rolled
+    back before the next one starts. Only errors 1205/1213 are retried, after
+    a jittered exponential backoff ("full jitter": a random delay up to
+    base_delay * 2 ** (attempt - 1), capped at max_delay) so two colliding
+    uploads do not collide again. `work` must be safe to re-run - it should
+    only write data prepared beforehand.
+
+    `prepare(conn, cursor)`, if given, runs first on the same connection and
+    is committed on its own - e.g. to bulk-load session staging tables - so
+    that the transaction around `work` stays short.
+
+    Parameters:
+        pool (ConnectionPool): Pool of the primary database
+        work (callable): Does the writes; its return value is passed through
+        attempts (int): Maximum number of tries
+        base_delay (float): Backoff ceiling in seconds for the first retry
+        max_delay (float): Upper bound for any backoff
+        on_retry (callable): Called as on_retry(attempt, error, delay) before sleeping
+        stats (dict): Optional dict filled in place (also when an error is raised):
+            connected, attempts, retries, lock_wait_seconds (time spent in
+            attempts that ended in a lock conflict), backoff_seconds and
+            transaction_seconds (work + commit of the committed attempt)
+        prepare (callable): Optional setup run before each attempt's transaction
+
+    Returns:
+        The value returned by `work` for the attempt that committed
+
+    Raises:
+        Exception: The last error, when it is not a lock conflict or attempts run out
+    """
+    stats = stats if stats is not None else {}
+    stats.update(
+        connected=False, attempts=0, retries=0, lock_wait_seconds=0.0, backoff_seconds=0.0, transaction_seconds=0.0
+    )
+    for attempt in range(1, attempts + 1):
+        stats["attempts"] = attempt
+        started = time.perf_counter()
+        try:
+            with pool.connection() as conn:
+                stats["connected"] = True
+                cursor = conn.cursor()
+                try:
+                    if prepare is not None:
+                        prepare(conn, cursor)
+                        conn.commit()
+                    transaction_started = time.perf_counter()
+                    result = work(conn, cursor)
+                    conn.commit()
+                    stats["transaction_seconds"] = time.perf_counter() - transaction_started
+                finally:
+                    cursor.close()
+            return result
+        except Exception as err:
+            if attempt == attempts or not is_lock_conflict(err):
+                raise
+            stats["lock_wait_seconds"] += time.perf_counter() - started
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            if on_retry is not None:
+                on_retry(attempt, err, delay)
+            time.sleep(delay)
+            stats["retries"] += 1
+            stats["backoff_seconds"] += delay
@@ -0,0 +1,349 @@
+"""
+Duplicate-check key hashes in files shared by every app process on a host.
+
+dup_keys.DuplicateKeyIndex keeps one copy of the keys per server process.
+SharedKeyFile keeps them on disk instead, in one directory:
+
+    manifest.json          generation, id watermark, hidden version, log name
+    keys-<generation>.u64  sorted little-endian uint64 key hashes
+    append-<generation>.log  uint64 hashes appended since that file was written
+
+Every process memory-maps the sorted file read-only, so the pages are shared
+through the OS page cache and a restarted process can look keys up at once.
+Only the append log is read into memory; compact() merges it into a new
+sorted file. Writers (refresh, add, compact) serialize on an exclusive lock
+on `lock`; readers never lock, since the manifest is replaced atomically and
+files of a generation are never changed after the manifest names them,
+apart from appends to its log.
+
+    python dup_key_file.py status --path /var/lib/centralized_returns/dup_keys
+    python dup_key_file.py build --path ...     # full rebuild from the database
+    python dup_key_file.py compact --path ...
+
+The app uses it instead of the in-process index when secrets.toml contains
+
+    [duplicate_index]
+    path = "/var/lib/centralized_returns/dup_keys"
+    compact_interval = 300
+"""
+import argparse
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import mysql.connector
+import numpy as np
+import pandas as pd
+
+from db_pool import DEFAULT_SECRETS_PATH, load_secrets
+from dup_keys import INDEX_MERGE_THRESHOLD, fetch_key_hashes64, upload_key_hashes64
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+KEY_DTYPE = np.dtype("<u8")
+MANIFEST = "manifest.json"
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _write_atomic(path, data):
+    temp_path = f"{path}.tmp{os.getpid()}"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class SharedKeyFile:
+    """
+    File-backed drop-in for dup_keys.DuplicateKeyIndex (same refresh / add /
+    contains / duplicate_mask), shared by all processes using `path`.
+
+    A full rebuild happens once per hidden version for all processes
+    together; after that each refresh appends the hashes of rows above the
+    watermark to the log. Per process the memory cost is the append log
+    (8 bytes per key, at most about `compact_threshold` keys) - the sorted
+    file stays in the page cache.
+    """
+
+    def __init__(self, path, table="tbl_wh_sales_returns", compact_threshold=INDEX_MERGE_THRESHOLD):
+        self.path = path
+        self.table = table
+        self.compact_threshold = compact_threshold
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # Reader view: the mapped generation and the log keys read so far
+        self._generation = None
+        self._keys = np.empty(0, dtype=KEY_DTYPE)
+        self._log_keys = np.empty(0, dtype=np.uint64)
+        self._log_offset = 0
+        self.stats = {"rebuilds": 0, "refreshes": 0, "rows_read": 0, "compactions": 0, "remaps": 0}
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def read_manifest(self):
+        """Returns: dict, or None before the first build."""
+        try:
+            with open(self._file(MANIFEST), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_generation(self, manifest, keys, watermark, hidden_version):
+        # Caller holds the file lock. The new files are complete before the manifest names them.
+        generation = (manifest["generation"] + 1) if manifest else 1
+        keys = np.asarray(keys, dtype=np.uint64).astype(KEY_DTYPE)
+        _write_atomic(self._file(f"keys-{generation}.u64"), keys.tobytes())
+        _write_atomic(self._file(f"append-{generation}.log"), b"")
+        new_manifest = {
+            "generation": generation,
+            "keys": f"keys-{generation}.u64",
+            "log": f"append-{generation}.log",
+            "watermark": int(watermark),
+            "hidden_version": hidden_version,
+            "key_count": int(len(keys)),
+        }
+        self._write_manifest(new_manifest)
+        if manifest:
+            self._remove_generation(manifest["generation"] - 1)
+        return new_manifest
+
+    def _remove_generation(self, generation):
+        # Keep the previous generation for readers that have not re-read the
+        # manifest yet. Mapped files cannot be removed on Windows - retried next time.
+        for name in (f"keys-{generation}.u64", f"append-{generation}.log"):
+            try:
+                os.remove(self._file(name))
+            except OSError:
+                pass
+
+    def _append(self, manifest, hashes):
+        # Caller holds the file lock
+        hashes = np.asarray(hashes, dtype=np.uint64).astype(KEY_DTYPE)
+        if len(hashes):
+            with open(self._file(manifest["log"]), "ab") as f:
+                f.write(hashes.tobytes())
+
+    def log_size(self, manifest):
+        try:
+            return os.path.getsize(self._file(manifest["log"])) // KEY_DTYPE.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def _write_manifest(self, manifest):
+        _write_atomic(self._file(MANIFEST), json.dumps(manifest).encode("utf-8"))
+
+    def _rebuild(self, conn, manifest, hidden_version, tables):
+        # Caller holds the file lock
+        rows = fetch_key_hashes64(conn, tables or self.table)
+        self._write_generation(
+            manifest, np.unique(rows["key_hash"].to_numpy(dtype=np.uint64)),
+            rows["id"].max() if len(rows) else 0, hidden_version,
+        )
+        self.stats["rebuilds"] += 1
+        self.stats["rows_read"] += len(rows)
+
+    def rebuild(self, conn, hidden_version=None, tables=None):
+        """Write a new generation from every visible row of `tables` (default: the table)."""
+        with _file_lock(self._file("lock")):
+            self._rebuild(conn, self.read_manifest(), hidden_version, tables)
+        self._load()
+        return self
+
+    def refresh(self, conn, hidden_version=None, tables=None):
+        """
+        Bring the shared files up to date (rebuilding when `hidden_version`
+        differs from the one they were built under), then this process's view.
+
+        Parameters:
+            conn: Active MySQL connection object
+            hidden_version: Changes whenever returns are hidden (must be JSON-serializable)
+            tables (list): Tables for a full build, e.g. hot + archive
+
+        Returns:
+            SharedKeyFile: self
+        """
+        with _file_lock(self._file("lock")):
+            # Read under the lock: another process may have just rebuilt for this version
+            manifest = self.read_manifest()
+            if manifest is None or manifest["hidden_version"] != hidden_version:
+                self._rebuild(conn, manifest, hidden_version, tables)
+            else:
+                rows = fetch_key_hashes64(conn, self.table, manifest["watermark"])
+                if len(rows):
+                    self._append(manifest, rows["key_hash"].to_numpy(dtype=np.uint64))
+                    manifest["watermark"] = max(manifest["watermark"], int(rows["id"].max()))
+                    self._write_manifest(manifest)
+                self.stats["rows_read"] += len(rows)
+            self.stats["refreshes"] += 1
+        self._load()
+        return self
+
+    def add(self, hashes):
+        """Append keys this process has just committed; other processes see them on their next lookup."""
+        with _file_lock(self._file("lock")):
+            manifest = self.read_manifest()
+            if manifest is None:
+                return
+            self._append(manifest, hashes)
+        self._load()
+
+    def compact(self, force=False):
+        """
+        Merge the append log into a new sorted file once it holds
+        `compact_threshold` keys (or any keys, with force).
+
+        Returns:
+            bool: True if a new generation was written
+        """
+        manifest = self.read_manifest()
+        if manifest is None or (not force and self.log_size(manifest) < self.compact_threshold):
+            return False
+        with _file_lock(self._file("lock")):
+            manifest = self.read_manifest()
+            log_size = self.log_size(manifest)
+            if log_size == 0 or (not force and log_size < self.compact_threshold):
+                return False
+            keys = np.fromfile(self._file(manifest["keys"]), dtype=KEY_DTYPE)
+            log_keys = np.fromfile(self._file(manifest["log"]), dtype=KEY_DTYPE, count=log_size)
+            self._write_generation(
+                manifest, np.union1d(keys, log_keys), manifest["watermark"], manifest["hidden_version"]
+            )
+            self.stats["compactions"] += 1
+        self._load()
+        return True
+
+    def start_compaction(self, interval):
+        """Run compact() every `interval` seconds in a daemon thread until close()."""
+        def run():
+            while not self._closed.wait(interval):
+                try:
+                    self.compact()
+                except Exception:
+                    pass
+
+        thread = threading.Thread(target=run, name="dup-key-compaction", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self._closed.set()
+
+    def _load(self):
+        # Re-map after a new generation, then read whatever was appended to its log since last time
+        manifest = self.read_manifest()
+        if manifest is None:
+            return
+        with self._lock:
+            if manifest["generation"] != self._generation:
+                size = os.path.getsize(self._file(manifest["keys"]))
+                self._keys = (
+                    np.memmap(self._file(manifest["keys"]), dtype=KEY_DTYPE, mode="r")
+                    if size else np.empty(0, dtype=KEY_DTYPE)
+                )
+                self._generation = manifest["generation"]
+                self._log_keys = np.empty(0, dtype=np.uint64)
+                self._log_offset = 0
+                self.stats["remaps"] += 1
+            with open(self._file(manifest["log"]), "rb") as f:
+                f.seek(self._log_offset * KEY_DTYPE.itemsize)
+                data = f.read()
+            # An append in progress may have written part of a key
+            count = len(data) // KEY_DTYPE.itemsize
+            if count:
+                tail = np.frombuffer(data[:count * KEY_DTYPE.itemsize], dtype=KEY_DTYPE)
+                self._log_keys = np.union1d(self._log_keys, tail.astype(np.uint64))
+                self._log_offset += count
+
+    def contains(self, hashes):
+        """
+        Returns:
+            np.ndarray: Boolean membership per uint64 key in `hashes`
+        """
+        self._load()
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        found = np.zeros(len(hashes), dtype=bool)
+        with self._lock:
+            for keys in (self._keys, self._log_keys):
+                if len(keys):
+                    positions = np.minimum(np.searchsorted(keys, hashes), len(keys) - 1)
+                    found |= keys[positions] == hashes
+        return found
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys) + len(self._log_keys)
+
+    def duplicate_mask(self, uploaded_df):
+        """
+        Flag uploaded rows (UPLOAD_KEY_COLUMNS) whose key is in the shared files.
+
+        Returns:
+            pd.Series: Boolean mask aligned with uploaded_df.index
+        """
+        return pd.Series(self.contains(upload_key_hashes64(uploaded_df)), index=uploaded_df.index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "build", "compact"])
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH)
+    parser.add_argument("--path", default=None, help="Default: [duplicate_index] path in secrets")
+    args = parser.parse_args()
+
+    secrets = load_secrets(args.secrets)
+    path = args.path or secrets.get("duplicate_index", {}).get("path")
+    if not path:
+        raise SystemExit("❌ No key file directory: pass --path or set [duplicate_index] path")
+    key_file = SharedKeyFile(path)
+    if args.command == "status":
+        manifest = key_file.read_manifest()
+        if manifest is None:
+            print("⚠️ Not built yet - the app builds it on the first upload, or run 'build'")
+            return
+        print(f"generation:      {manifest['generation']:>12}")
+        print(f"sorted keys:     {manifest['key_count']:>12,}")
+        print(f"append log keys: {key_file.log_size(manifest):>12,}")
+        print(f"id watermark:    {manifest['watermark']:>12,}")
+    elif args.command == "compact":
+        merged = key_file.compact(force=True)
+        print("✅ Compacted" if merged else "✅ Nothing to compact")
+    else:
+        # Imported here: change_log / archive are only needed to build
+        from archive import archive_exists, returns_tables
+        from change_log import fetch_versions, hidden_version
+
+        conn = mysql.connector.connect(**secrets["db_config"])
+        try:
+            key_file.rebuild(conn, hidden_version(fetch_versions(conn)), returns_tables(archive_exists(conn)))
+        finally:
+            conn.close()
+        print(f"✅ Built generation {key_file.read_manifest()['generation']} with {len(key_file):,} keys")
+
+
+if __name__ == "__main__":
+    main()
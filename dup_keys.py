@@ -0,0 +1,226 @@
+import hashlib
+import threading
+
+import numpy as np
+import pandas as pd
+
+from db_query import fetch_dataframe
+
+# Database column -> uploaded file column for the five duplicate-check keys
+DUPLICATE_KEY_COLUMNS = {
+    "return_date": "date",
+    "outlet_name": "stores",
+    "bill_no": "bill no",
+    "combination_id": "combination_id",
+    "barcode": "barcode",
+}
+UPLOAD_KEY_COLUMNS = list(DUPLICATE_KEY_COLUMNS.values())
+
+# MD5 (hex) of the normalized key; key_hashes() must produce the same bytes
+DUP_KEY_MD5_SQL = (
+    "MD5(CONCAT_WS(CHAR(31), DATE_FORMAT(return_date, '%Y-%m-%d'), "
+    "LOWER(TRIM(outlet_name)), LOWER(TRIM(bill_no)), LOWER(TRIM(combination_id)), LOWER(TRIM(barcode))))"
+)
+# A sales return is visible unless hidden = 1 (NULL, 0 and '' are visible). Every
+# query that counts, matches or lists visible rows uses this one condition - the
+# transfer-out rows' hidden flag too (visible_sql(alias) for joined queries)
+VISIBLE_SQL_TEMPLATE = "COALESCE({hidden}, 0) <> 1"
+VISIBLE_RETURN_SQL = VISIBLE_SQL_TEMPLATE.format(hidden="hidden")
+# Stored generated column on tbl_wh_sales_returns (migration 6): NULL for
+# hidden rows so hiding a return frees its key. Same rows as VISIBLE_RETURN_SQL
+# (hidden = 1 is NULL, not true, for a NULL hidden); kept as created by migration 6.
+DUP_KEY_HASH_SQL = f"IF(hidden = 1, NULL, UNHEX({DUP_KEY_MD5_SQL}))"
+# First 8 bytes of the MD5 as BIGINT UNSIGNED, for DuplicateKeyIndex
+DUP_KEY_HASH64_SQL = f"CAST(CONV(LEFT({DUP_KEY_MD5_SQL}, 16), 16, 10) AS UNSIGNED)"
+# Keys held in memory are merged into the sorted array once this many pile up
+INDEX_MERGE_THRESHOLD = 50000
+
+
+def visible_sql(alias):
+    """VISIBLE_RETURN_SQL on `alias`.hidden, e.g. visible_sql("t") for tbl_wh_transfer_out t."""
+    return VISIBLE_SQL_TEMPLATE.format(hidden=f"{alias}.hidden")
+
+
+class DuplicateRowsError(Exception):
+    """Raised when rows of an upload already exist under the unique duplicate-key index."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        super().__init__(f"{len(rows)} uploaded row(s) already exist in tbl_wh_sales_returns")
+
+
+def key_hashes(df):
+    """
+    16-byte key hash per row of `df` (database column names), as computed by DUP_KEY_HASH_SQL.
+
+    Like CONCAT_WS, missing values are skipped; like TRIM, only spaces are stripped.
+    """
+    dates = pd.to_datetime(df["return_date"], errors="coerce").dt.strftime("%Y-%m-%d")
+    return hash_key_parts([dates] + [df[col] for col in list(DUPLICATE_KEY_COLUMNS)[1:]], df.index)
+
+
+def _key_text(value):
+    # A whole float is a number read from a spreadsheet cell ('8901234.0'): hash it as stored, '8901234'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def hash_key_parts(parts, index):
+    """
+    MD5 of CONCAT_WS(CHAR(31), LOWER(TRIM(part)), ...) per row, as 16 bytes.
+
+    Parameters:
+        parts (list): One sequence per key column, already formatted as text
+        index: Index of the returned Series
+    """
+    hashes = []
+    for row in zip(*parts):
+        text = "\x1f".join(_key_text(value).strip(" ").lower() for value in row if not pd.isna(value))
+        hashes.append(hashlib.md5(text.encode("utf-8")).digest())
+    return pd.Series(hashes, index=index, dtype=object)
+
+
+def duplicate_sequence(hashes):
+    """
+    Occurrence number of each key within one upload (0 for the first).
+
+    Stored as dup_key_seq, so repeated lines of one upload fit the unique
+    (dup_key_hash, dup_key_seq) index while the same upload sent twice does not.
+    """
+    return hashes.groupby(hashes).cumcount()
+
+
+def key_hashes64(df):
+    """The first 8 bytes of key_hashes() as uint64, matching DUP_KEY_HASH64_SQL."""
+    digests = b"".join(key_hashes(df))
+    return np.frombuffer(digests, dtype=">u8")[::2].astype(np.uint64)
+
+
+def upload_key_hashes64(uploaded_df):
+    """key_hashes64() of an upload frame (UPLOAD_KEY_COLUMNS names)."""
+    return key_hashes64(uploaded_df.rename(columns={up: db for db, up in DUPLICATE_KEY_COLUMNS.items()}))
+
+
+def fetch_key_hashes64(conn, tables, after_id=0):
+    """
+    Parameters:
+        tables (str or list): Table(s) to read; several are read with one
+            (id, key_hash) projection per UNION ALL branch, not SELECT *
+
+    Returns:
+        pd.DataFrame: id and key_hash (uint64) of visible rows of `tables` with id > after_id
+    """
+    tables = [tables] if isinstance(tables, str) else list(tables)
+    return fetch_dataframe(
+        conn,
+        " UNION ALL ".join(
+            f"SELECT id, {DUP_KEY_HASH64_SQL} AS key_hash FROM {table} WHERE id > %s AND {VISIBLE_RETURN_SQL}"
+            for table in tables
+        ),
+        [after_id] * len(tables),
+        dtypes={"id": "int64", "key_hash": "uint64"},
+    )
+
+
+class DuplicateKeyIndex:
+    """
+    In-process set of the duplicate-check keys of visible sales returns.
+
+    Keys are 64-bit prefixes of the key MD5, computed by the server and kept
+    in a sorted NumPy uint64 array (8 bytes per row) plus a small set of
+    recent additions. refresh() reads only rows above the highest id seen so
+    far; hiding a return removes a key, which an id watermark cannot see, so
+    the caller passes a version that changes on every hide (see
+    change_log.SALES_RETURNS_HIDDEN) and a new version rebuilds the index.
+
+    With 64-bit keys a false duplicate needs a hash collision: about one in
+    10^12 per uploaded row against 10M stored keys.
+
+    A transaction that commits after a higher id was already read is missed
+    until the next rebuild; the unique dup_key_hash index still refuses such
+    rows at write time (see write_upload_batch()).
+    """
+
+    def __init__(self, table="tbl_wh_sales_returns"):
+        self.table = table
+        self._lock = threading.Lock()
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._recent = set()
+        self.watermark = None
+        self.hidden_version = None
+        self.stats = {"rebuilds": 0, "refreshes": 0, "rows_read": 0}
+
+    def _merge(self):
+        # Caller holds the lock
+        if self._recent:
+            recent = np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))
+            self._keys = np.union1d(self._keys, recent)
+            self._recent = set()
+
+    def refresh(self, conn, hidden_version=None, tables=None):
+        """
+        Bring the index up to date: a full build the first time or after a
+        hide, otherwise only rows with id > watermark.
+
+        Parameters:
+            conn: Active MySQL connection object
+            hidden_version: Changes whenever returns are hidden
+            tables (list): Tables for a full build, e.g. hot + archive
+                (default: the table); increments always read the table
+
+        Returns:
+            DuplicateKeyIndex: self
+        """
+        with self._lock:
+            rebuild = self.watermark is None or hidden_version != self.hidden_version
+            rows = fetch_key_hashes64(conn, (tables or self.table) if rebuild else self.table,
+                                      0 if rebuild else self.watermark)
+            if rebuild:
+                self._keys = np.unique(rows["key_hash"].to_numpy(dtype=np.uint64))
+                self._recent = set()
+                self.watermark = int(rows["id"].max()) if len(rows) else 0
+                self.hidden_version = hidden_version
+                self.stats["rebuilds"] += 1
+            elif len(rows):
+                self._recent.update(rows["key_hash"].tolist())
+                self.watermark = max(self.watermark, int(rows["id"].max()))
+            if len(self._recent) >= INDEX_MERGE_THRESHOLD:
+                self._merge()
+            self.stats["refreshes"] += 1
+            self.stats["rows_read"] += len(rows)
+        return self
+
+    def add(self, hashes):
+        """Record keys this process has just committed, so they count before the next refresh."""
+        with self._lock:
+            self._recent.update(int(h) for h in hashes)
+            if len(self._recent) >= INDEX_MERGE_THRESHOLD:
+                self._merge()
+
+    def contains(self, hashes):
+        """
+        Returns:
+            np.ndarray: Boolean membership per uint64 key in `hashes`
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        with self._lock:
+            positions = np.searchsorted(self._keys, hashes)
+            found = positions < len(self._keys)
+            found[found] = self._keys[positions[found]] == hashes[found]
+            if self._recent:
+                found |= np.fromiter((int(h) in self._recent for h in hashes), dtype=bool, count=len(hashes))
+        return found
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys) + len(self._recent)
+
+    def duplicate_mask(self, uploaded_df):
+        """
+        Flag uploaded rows (UPLOAD_KEY_COLUMNS) whose key is in the index.
+
+        Returns:
+            pd.Series: Boolean mask aligned with uploaded_df.index
+        """
+        return pd.Series(self.contains(upload_key_hashes64(uploaded_df)), index=uploaded_df.index)
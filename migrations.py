@@ -0,0 +1,371 @@
+"""
+Versioned schema migrations for the centralized returns database.
+
+Applied versions are recorded in `schema_migrations`, so every migration runs
+once per database. Index steps first look the index up in
+information_schema and are skipped when it already exists, which makes it
+safe to adopt this on a database where some indexes were added by hand.
+
+    python migrations.py status            # applied / pending versions
+    python migrations.py run               # apply pending migrations
+    python migrations.py check             # EXPLAIN the hot queries
+
+The app runs pending migrations at startup when secrets.toml contains
+
+    [migrations]
+    run_on_startup = true
+
+Migrations listed in OFFLINE_MIGRATIONS copy or lock a whole table and block
+writes while they run; startup stops before the first of them, so they are
+only applied by `python migrations.py run`, at a quiet time.
+"""
+import argparse
+import datetime
+from collections import namedtuple
+
+import mysql.connector
+
+from db_pool import DEFAULT_SECRETS_PATH, load_secrets
+from dup_keys import DUP_KEY_HASH_SQL, VISIBLE_RETURN_SQL
+from returned_qty import RETURN_KEY_HASH_SQL, RETURN_QTY_SQL
+
+
+# Sum the quantities of the visible returns already in the hot and archive tables
+# (re-running resets the counts)
+RETURNED_QTY_BACKFILL = f"""
+        INSERT INTO tbl_wh_returned_qty (key_hash, outlet_name, bill_no, combination_id, barcode, returned_qty)
+        SELECT {RETURN_KEY_HASH_SQL} AS key_hash,
+               MIN(outlet_name), MIN(bill_no), MIN(combination_id), MIN(barcode), {RETURN_QTY_SQL}
+        FROM (
+            SELECT outlet_name, bill_no, combination_id, barcode, Sold_qty
+            FROM tbl_wh_sales_returns WHERE {VISIBLE_RETURN_SQL}
+            UNION ALL
+            SELECT outlet_name, bill_no, combination_id, barcode, Sold_qty
+            FROM tbl_wh_sales_returns_archive WHERE {VISIBLE_RETURN_SQL}
+        ) r
+        GROUP BY key_hash
+        ON DUPLICATE KEY UPDATE returned_qty = VALUES(returned_qty)
+"""
+
+# Step kinds besides (table, index name, column list) and plain SQL; the first two
+# are skipped when the column / index already exists, DropIndex when it does not
+AddColumn = namedtuple("AddColumn", "table column definition")
+UniqueIndex = namedtuple("UniqueIndex", "table index columns")
+DropIndex = namedtuple("DropIndex", "table index")
+
+# (version, description, [step, ...]) - a step is (table, index name, column list)
+# for an index, an AddColumn / UniqueIndex / DropIndex, or a plain SQL string that must
+# itself be idempotent
+MIGRATIONS = [
+    (1, "Index SR / TO page filters", [
+        ("tbl_wh_sales_returns", "idx_wsr_outlet_created", "outlet_name, created_date, hidden"),
+        ("tbl_wh_transfer_out", "idx_wto_outlet_from_created", "outlet_name_from, created_date, hidden"),
+        ("tbl_store_data", "idx_store_full_name", "store_full_name"),
+    ]),
+    (2, "Index SR number and duplicate-check lookups", [
+        ("tbl_wh_sales_returns", "idx_wsr_sr_no", "sr_no"),
+        ("tbl_wh_sales_returns", "idx_wsr_outlet_return_date", "outlet_name, return_date, hidden"),
+        ("tbl_wh_sales_returns", "idx_wsr_bill_keys", "bill_no, combination_id, barcode"),
+    ]),
+    (3, "Index RTV / RTO validation joins", [
+        ("minimized_sales_register", "idx_msr_gst_bill", "GST_bill_number, bill_date"),
+        ("tbl_sales", "idx_sales_bill_item", "bill_number, bill_date, combination_id, barcode"),
+    ]),
+    (4, "Archive table for hidden and old sales returns (see archive.py)", [
+        # LIKE copies the columns in order and every index, including those above
+        "CREATE TABLE IF NOT EXISTS tbl_wh_sales_returns_archive LIKE tbl_wh_sales_returns",
+    ]),
+    (5, "Change log of per-table versions for cache invalidation (see change_log.py)", [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_wh_change_log (
+            entity VARCHAR(64) PRIMARY KEY,
+            version BIGINT UNSIGNED NOT NULL DEFAULT 1,
+            changed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        INSERT IGNORE INTO tbl_wh_change_log (entity) VALUES
+            ('tbl_wh_sales_returns'), ('tbl_wh_transfer_out'), ('tbl_wh_store_config')
+        """,
+    ]),
+    (6, "Unique duplicate-key hash on sales returns (rebuilds the table)", [
+        # STORED generated columns cannot be added in place: this copies the table once
+        AddColumn("tbl_wh_sales_returns", "dup_key_hash", f"BINARY(16) AS ({DUP_KEY_HASH_SQL}) STORED"),
+        AddColumn("tbl_wh_sales_returns", "dup_key_seq", "SMALLINT UNSIGNED NOT NULL DEFAULT 0"),
+        # The archive is read with SELECT * UNION ALL, so it needs the same columns (no unique index)
+        AddColumn("tbl_wh_sales_returns_archive", "dup_key_hash", f"BINARY(16) AS ({DUP_KEY_HASH_SQL}) STORED"),
+        AddColumn("tbl_wh_sales_returns_archive", "dup_key_seq", "SMALLINT UNSIGNED NOT NULL DEFAULT 0"),
+        # Number the duplicates already in the table so the unique index can be built
+        """
+        UPDATE tbl_wh_sales_returns r
+        INNER JOIN (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY dup_key_hash ORDER BY id) - 1 AS seq
+            FROM tbl_wh_sales_returns
+            WHERE dup_key_hash IS NOT NULL
+        ) d ON r.id = d.id
+        SET r.dup_key_seq = d.seq
+        WHERE r.dup_key_seq <> d.seq
+        """,
+        UniqueIndex("tbl_wh_sales_returns", "uq_wsr_dup_key", "dup_key_hash, dup_key_seq"),
+    ]),
+    (7, "Index tbl_sales by store id and bill date for RTV / RTO validation", [
+        ("tbl_sales", "idx_sales_outlet_bill_date", "outlets_id, bill_date"),
+    ]),
+    (8, "Index tbl_sales by bill date for sales snapshot refreshes (see sales_snapshot.py)", [
+        ("tbl_sales", "idx_sales_bill_date", "bill_date"),
+    ]),
+    (9, "Returned-quantity ledger for RTV quantity validation (see returned_qty.py)", [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_wh_returned_qty (
+            key_hash BINARY(16) PRIMARY KEY,
+            outlet_name VARCHAR(255),
+            bill_no VARCHAR(255),
+            combination_id VARCHAR(255),
+            barcode VARCHAR(255),
+            returned_qty INT UNSIGNED NOT NULL DEFAULT 0,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+        """,
+        RETURNED_QTY_BACKFILL,
+    ]),
+    (10, "Recount the returned-quantity ledger from Sold_qty, NULL-hidden returns as visible", [
+        RETURNED_QTY_BACKFILL,
+    ]),
+    (11, "Upload numbering lock row (see number_upload_batch in the app)", [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_wh_upload_lock (
+            name VARCHAR(64) PRIMARY KEY
+        )
+        """,
+        "INSERT IGNORE INTO tbl_wh_upload_lock (name) VALUES ('upload_numbering')",
+    ]),
+    (12, "Drop the return-date scope index (duplicate checks use the key-hash index)", [
+        DropIndex("tbl_wh_sales_returns", "idx_wsr_outlet_return_date"),
+        DropIndex("tbl_wh_sales_returns_archive", "idx_wsr_outlet_return_date"),
+    ]),
+]
+
+
+# Versions that rebuild (copy) a table or otherwise block its writes for the
+# length of a full scan - CLI only, never from the app. The ledger backfill of
+# 9 and 10 share-locks every sales-return row it reads.
+OFFLINE_MIGRATIONS = {6, 9, 10}
+
+
+# (name, table alias, index expected to be chosen, query, sample params)
+# Sample params only need the right types: EXPLAIN does not depend on matching rows.
+_SAMPLE_START = datetime.date.today() - datetime.timedelta(days=30)
+_SAMPLE_END = datetime.date.today() + datetime.timedelta(days=1)
+EXPLAIN_CHECKS = [
+    (
+        "SR page date/store filter", "s", "idx_wsr_outlet_created",
+        "SELECT s.id FROM tbl_wh_sales_returns s "
+        "WHERE s.created_date >= %s AND s.created_date < %s AND s.outlet_name IN (%s, %s)",
+        (_SAMPLE_START, _SAMPLE_END, "Store A", "Store B"),
+    ),
+    (
+        "TO page date/store filter", "t", "idx_wto_outlet_from_created",
+        "SELECT t.id FROM tbl_wh_transfer_out t "
+        "WHERE t.created_date >= %s AND t.created_date < %s AND t.outlet_name_from IN (%s, %s)",
+        (_SAMPLE_START, _SAMPLE_END, "Store A", "Store B"),
+    ),
+    (
+        "SR number lookup", "r", "idx_wsr_sr_no",
+        "SELECT r.id FROM tbl_wh_sales_returns r WHERE r.sr_no = %s",
+        ("SR0000001",),
+    ),
+    (
+        "Sales validation window", "t1", "idx_sales_outlet_bill_date",
+        "SELECT t1.bill_number FROM tbl_sales t1 "
+        "WHERE t1.outlets_id IN (%s, %s) AND t1.bill_date >= %s",
+        (1, 2, _SAMPLE_START),
+    ),
+    (
+        "Sales snapshot day", "t1", "idx_sales_bill_date",
+        "SELECT t1.bill_number FROM tbl_sales t1 WHERE t1.bill_date >= %s AND t1.bill_date < %s",
+        (_SAMPLE_START, _SAMPLE_START + datetime.timedelta(days=1)),
+    ),
+    (
+        "Duplicate-key probe", "r", "uq_wsr_dup_key",
+        "SELECT r.id FROM tbl_wh_sales_returns r WHERE r.dup_key_hash = %s AND r.dup_key_seq = %s",
+        (bytes(16), 0),
+    ),
+]
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+
+def applied_versions(cursor):
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def index_exists(cursor, table, index_name):
+    cursor.execute(
+        """
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+        """,
+        (table, index_name),
+    )
+    return cursor.fetchone() is not None
+
+
+def column_exists(cursor, table, column):
+    cursor.execute(
+        """
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        LIMIT 1
+        """,
+        (table, column),
+    )
+    return cursor.fetchone() is not None
+
+
+def run_migrations(conn, log=print, online_only=False):
+    """
+    Apply every pending migration in version order.
+
+    Parameters:
+        conn: Active MySQL connection object
+        log (callable): Receives one progress line per step
+        online_only (bool): Stop before the first pending OFFLINE_MIGRATIONS
+            version (the app at startup); later versions wait for it too
+
+    Returns:
+        list: Versions applied by this call (empty when up to date)
+
+    Raises:
+        mysql.connector.Error: If a step fails; earlier versions stay recorded
+    """
+    cursor = conn.cursor()
+    try:
+        ensure_migrations_table(cursor)
+        done = applied_versions(cursor)
+        applied = []
+        for version, description, steps in MIGRATIONS:
+            if version in done:
+                continue
+            if online_only and version in OFFLINE_MIGRATIONS:
+                log(f"Migration {version} blocks writes - run 'python migrations.py run'")
+                break
+            log(f"Migration {version}: {description}")
+            for step in steps:
+                if isinstance(step, str):
+                    cursor.execute(step)
+                    log(f"  ran: {' '.join(step.split())[:80]}")
+                    continue
+                if isinstance(step, AddColumn):
+                    if column_exists(cursor, step.table, step.column):
+                        log(f"  {step.table}.{step.column} already exists")
+                        continue
+                    cursor.execute(f"ALTER TABLE {step.table} ADD COLUMN {step.column} {step.definition}")
+                    log(f"  added column {step.table}.{step.column}")
+                    continue
+                if isinstance(step, UniqueIndex):
+                    if index_exists(cursor, step.table, step.index):
+                        log(f"  {step.table}.{step.index} already exists")
+                        continue
+                    cursor.execute(
+                        f"ALTER TABLE {step.table} ADD UNIQUE INDEX {step.index} ({step.columns}), "
+                        "ALGORITHM=INPLACE, LOCK=NONE"
+                    )
+                    log(f"  created unique {step.table}.{step.index} ({step.columns})")
+                    continue
+                if isinstance(step, DropIndex):
+                    if not index_exists(cursor, step.table, step.index):
+                        log(f"  {step.table}.{step.index} does not exist")
+                        continue
+                    cursor.execute(f"ALTER TABLE {step.table} DROP INDEX {step.index}, ALGORITHM=INPLACE, LOCK=NONE")
+                    log(f"  dropped {step.table}.{step.index}")
+                    continue
+                table, index_name, columns = step
+                if index_exists(cursor, table, index_name):
+                    log(f"  {table}.{index_name} already exists")
+                    continue
+                # DDL commits implicitly; ALGORITHM=INPLACE keeps the table writable meanwhile
+                cursor.execute(f"ALTER TABLE {table} ADD INDEX {index_name} ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+                log(f"  created {table}.{index_name} ({columns})")
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description),
+            )
+            conn.commit()
+            applied.append(version)
+        return applied
+    finally:
+        cursor.close()
+
+
+def pending_migrations(conn):
+    cursor = conn.cursor()
+    try:
+        ensure_migrations_table(cursor)
+        done = applied_versions(cursor)
+    finally:
+        cursor.close()
+    return [(version, description) for version, description, _ in MIGRATIONS if version not in done]
+
+
+def check_index_usage(conn):
+    """
+    EXPLAIN each query in EXPLAIN_CHECKS and report the index MySQL picks.
+
+    Returns:
+        list: (name, chosen index or None, access type, ok) per check; `ok` means
+        the expected index was used (on tiny tables MySQL may prefer a scan)
+    """
+    results = []
+    cursor = conn.cursor(dictionary=True)
+    try:
+        for name, alias, expected_index, query, params in EXPLAIN_CHECKS:
+            cursor.execute("EXPLAIN " + query, params)
+            plan = cursor.fetchall()
+            row = next((r for r in plan if r["table"] == alias), plan[0])
+            results.append((name, row["key"], row["type"], row["key"] == expected_index))
+    finally:
+        cursor.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "run", "check"])
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH)
+    args = parser.parse_args()
+
+    conn = mysql.connector.connect(**load_secrets(args.secrets)["db_config"])
+    try:
+        if args.command == "status":
+            pending = pending_migrations(conn)
+            if not pending:
+                print("✅ Schema is up to date")
+            for version, description in pending:
+                print(f"pending {version}: {description}")
+        elif args.command == "run":
+            applied = run_migrations(conn)
+            print(f"✅ Applied {len(applied)} migration(s)")
+        else:
+            failed = 0
+            for name, key, access_type, ok in check_index_usage(conn):
+                failed += not ok
+                print(f"{'✅' if ok else '❌'} {name}: key={key} type={access_type}")
+            raise SystemExit(1 if failed else 0)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
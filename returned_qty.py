@@ -0,0 +1,146 @@
+"""
+Ledger of quantities already returned per (store, bill, combination_id, barcode).
+
+RTV quantity validation compares uploaded + already returned against sold.
+Summing tbl_wh_sales_returns for that would scan the returns of every
+uploaded key, so tbl_wh_returned_qty (migration 9) keeps the running count,
+keyed by the MD5 of the normalized key. It holds the summed Sold_qty of the
+visible sales-return rows (a NULL quantity counts as 0), so a multi-unit RTO
+line counts in full. Writers maintain it in the same transaction as the rows
+it counts:
+
+    add_returned_qty(cursor, sr_df)                      # after inserting sr_df
+    subtract_hidden_returns(cursor, returns_table, keys)  # before hiding those SRs
+
+Archiving moves rows without changing the ledger.
+"""
+import mysql.connector
+import pandas as pd
+from mysql.connector import errorcode
+
+from db_query import staged_keys
+from dup_keys import VISIBLE_RETURN_SQL, hash_key_parts
+
+RETURNED_QTY_TABLE = "tbl_wh_returned_qty"
+# Database column -> uploaded file column, in hash order
+RETURN_KEY_COLUMNS = {
+    "outlet_name": "stores",
+    "bill_no": "bill no",
+    "combination_id": "combination_id",
+    "barcode": "barcode",
+}
+RETURN_KEY_HASH_SQL = (
+    "UNHEX(MD5(CONCAT_WS(CHAR(31), LOWER(TRIM(outlet_name)), LOWER(TRIM(bill_no)), "
+    "LOWER(TRIM(combination_id)), LOWER(TRIM(barcode)))))"
+)
+# Quantity of one sales-return row, NULL as 0
+RETURN_QTY_COLUMN = "Sold_qty"
+RETURN_QTY_SQL = f"SUM(COALESCE({RETURN_QTY_COLUMN}, 0))"
+LEDGER_KEY_COLUMNS = {"key_hash": "BINARY(16)"}
+# Keys per multi-row upsert
+UPSERT_BATCH_SIZE = 1000
+
+
+def return_key_hashes(df, upload_columns=False):
+    """
+    16-byte ledger key per row, as computed by RETURN_KEY_HASH_SQL.
+
+    Parameters:
+        df (pd.DataFrame): Rows with the database key columns, or the upload
+            columns when `upload_columns` is set
+    """
+    columns = RETURN_KEY_COLUMNS.values() if upload_columns else RETURN_KEY_COLUMNS
+    return hash_key_parts([df[col] for col in columns], df.index)
+
+
+def fetch_returned_qty(conn, hashes):
+    """
+    Returns:
+        dict: key hash -> returned qty for the keys that have returns; None
+        when the ledger table does not exist yet (before migration 9)
+    """
+    try:
+        with staged_keys(conn, "tmp_returned_qty_keys", LEDGER_KEY_COLUMNS, [(h,) for h in hashes]) as keys:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    f"SELECT l.key_hash, l.returned_qty FROM {keys} k "
+                    f"INNER JOIN {RETURNED_QTY_TABLE} l ON l.key_hash = k.key_hash"
+                )
+                return {bytes(key_hash): int(qty) for key_hash, qty in cursor.fetchall()}
+            finally:
+                cursor.close()
+    except mysql.connector.Error as err:
+        if err.errno != errorcode.ER_NO_SUCH_TABLE:
+            raise
+        return None
+
+
+def _ignore_missing_ledger(cursor, query, params=()):
+    # Before migration 9 there is no ledger to maintain; a failed statement
+    # does not roll back the rest of the transaction
+    try:
+        cursor.execute(query, params)
+    except mysql.connector.Error as err:
+        if err.errno != errorcode.ER_NO_SUCH_TABLE:
+            raise
+
+
+def ledger_rows(sr_df):
+    """
+    Rows (key_hash, outlet_name, bill_no, combination_id, barcode, returned_qty)
+    for the rows of `sr_df` (database column names), one per key in hash
+    order, with Sold_qty summed as RETURN_QTY_SQL does.
+    """
+    keyed = sr_df[list(RETURN_KEY_COLUMNS)].assign(
+        key_hash=return_key_hashes(sr_df),
+        returned_qty=pd.to_numeric(sr_df[RETURN_QTY_COLUMN], errors="coerce").fillna(0).astype(int),
+    )
+    counts = keyed.groupby("key_hash", sort=True).agg(
+        **{col: (col, "first") for col in RETURN_KEY_COLUMNS}, returned_qty=("returned_qty", "sum")
+    ).reset_index()
+    return list(counts.astype(object).where(counts.notna(), None).itertuples(index=False, name=None))
+
+
+def add_returned_qty(cursor, sr_df):
+    """
+    Add the rows of `sr_df` (database column names) to the ledger inside the
+    caller's transaction (nothing is committed).
+
+    Keys are upserted in hash order so concurrent uploads lock ledger rows
+    in the same order.
+    """
+    rows = ledger_rows(sr_df)
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        chunk = rows[start:start + UPSERT_BATCH_SIZE]
+        _ignore_missing_ledger(
+            cursor,
+            f"""
+            INSERT INTO {RETURNED_QTY_TABLE} (key_hash, {', '.join(RETURN_KEY_COLUMNS)}, returned_qty)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(chunk))}
+            ON DUPLICATE KEY UPDATE returned_qty = returned_qty + VALUES(returned_qty)
+            """,
+            [value for row in chunk for value in row],
+        )
+
+
+def subtract_hidden_returns(cursor, returns_table, sr_keys_table):
+    """
+    Take the still-visible rows of `returns_table` whose sr_no is in
+    `sr_keys_table` out of the ledger. Run it before they are hidden, in
+    the same transaction.
+    """
+    _ignore_missing_ledger(
+        cursor,
+        f"""
+        UPDATE {RETURNED_QTY_TABLE} l
+        INNER JOIN (
+            SELECT {RETURN_KEY_HASH_SQL} AS key_hash, {RETURN_QTY_SQL} AS qty
+            FROM {returns_table} r
+            INNER JOIN {sr_keys_table} k ON r.sr_no = k.sr_no
+            WHERE {VISIBLE_RETURN_SQL}
+            GROUP BY key_hash
+        ) d ON l.key_hash = d.key_hash
+        SET l.returned_qty = GREATEST(CAST(l.returned_qty AS SIGNED) - d.qty, 0)
+        """,
+    )
@@ -0,0 +1,425 @@
+"""
+Local SQLite snapshot of recent sales lines for RTV / RTO upload validation.
+
+Validation joins tbl_sales, minimized_sales_register and tbl_store_data over
+the last 180 days on the live database for every upload. The snapshot keeps
+those lines, projected to the validation columns and summed per
+(store id, GST bill, bill number, bill date, combination_id, barcode, design
+number), in a SQLite file next to the app, so validation reads the bulk of
+the window locally:
+
+    python sales_snapshot.py status --path sales_snapshot.sqlite3
+    python sales_snapshot.py refresh --path sales_snapshot.sqlite3
+
+Days before `complete_before` (today minus `lag_days` at the last refresh)
+are held in full; a refresh loads the days from the previous watermark up to
+the new one, one committed day at a time, and drops days that fell out of
+the retention window. Bills on or after the watermark are always read live,
+so late-arriving sales for recent days are never missed. Changes to sales
+lines older than `lag_days` after the fact are only seen by a rebuild
+(refresh --rebuild).
+
+MySQL compares the bill, combination_id and barcode keys under their column
+collation: case-insensitive, trailing spaces ignored. SQLite's `=` is
+binary, so the snapshot stores those keys normalized (match_key: trailing
+spaces cut, lower case) next to the original values and normalizes uploaded
+keys the same way. `check` compares the snapshot with the live RTV query on
+a sample of keys:
+
+    python sales_snapshot.py check --path sales_snapshot.sqlite3 --sample 200
+
+The app uses it when secrets.toml contains
+
+    [sales_snapshot]
+    path = "sales_snapshot.sqlite3"
+    refresh_interval = 3600   # seconds between background refreshes (0 = CLI only)
+    lag_days = 2
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import mysql.connector
+import pandas as pd
+
+from db_pool import DEFAULT_SECRETS_PATH, load_secrets
+from db_query import fetch_dataframe
+from sales_validation import fetch_rtv_sales
+
+RETENTION_DAYS = 180
+DEFAULT_LAG_DAYS = 2
+# PRAGMA user_version of the current layout; an older file is emptied and reloaded
+SCHEMA_VERSION = 2
+
+# Same joins as the live validation queries, aggregated once per line key
+SNAPSHOT_QUERY = """
+    SELECT
+        t1.outlets_id,
+        msr.GST_bill_number AS gst_bill_no,
+        t1.bill_number,
+        t1.bill_date,
+        t1.combination_id,
+        t1.barcode,
+        t1.design_number,
+        SUM(t1.sold_qty) AS sold_qty
+    FROM tbl_sales t1
+    INNER JOIN minimized_sales_register msr
+        ON t1.bill_number = msr.bill_number AND t1.bill_date = msr.bill_date
+    WHERE t1.bill_date >= %s AND t1.bill_date < %s
+    GROUP BY t1.outlets_id, msr.GST_bill_number, t1.bill_number, t1.bill_date,
+             t1.combination_id, t1.barcode, t1.design_number
+"""
+SNAPSHOT_COLUMNS = [
+    "outlets_id", "gst_bill_no", "bill_number", "bill_date", "combination_id", "barcode", "design_number", "sold_qty",
+]
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sales_lines (
+        outlets_id INTEGER NOT NULL,
+        gst_bill_no TEXT,
+        bill_number TEXT,
+        bill_date TEXT NOT NULL,
+        combination_id TEXT,
+        barcode TEXT,
+        design_number TEXT,
+        sold_qty REAL,
+        bill_key TEXT,
+        combination_key TEXT,
+        barcode_key TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_lines_key ON sales_lines (outlets_id, bill_key, combination_key, barcode_key);
+    CREATE INDEX IF NOT EXISTS idx_lines_date ON sales_lines (bill_date);
+    CREATE TABLE IF NOT EXISTS stores (id INTEGER PRIMARY KEY, store_full_name TEXT);
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Same keys as the app's staged RTV / RTO key tables, in SQLite types (TEXT keys go through match_key)
+SNAPSHOT_RTV_KEY_COLUMNS = {"outlets_id": "INTEGER", "bill_no": "TEXT", "combination_id": "TEXT", "barcode": "TEXT"}
+SNAPSHOT_RTO_KEY_COLUMNS = {"outlets_id": "INTEGER", "bill_no": "TEXT"}
+
+
+def match_key(value):
+    """
+    `value` as MySQL's case-insensitive, PAD SPACE collations compare it:
+    trailing spaces removed, lower case. None stays None (matches nothing).
+    """
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).rstrip(" ").lower()
+
+
+def _iso(value):
+    # bill_date as 'YYYY-MM-DD', also when the column is a DATETIME
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value.isoformat() if isinstance(value, datetime.date) else value
+
+
+class SalesSnapshot:
+    """
+    Reader and refresher for one snapshot file.
+
+    Every call opens its own SQLite connection, so lookups may run in
+    prefetch worker threads while a refresh writes (the file is in WAL
+    mode: readers see the last committed day). Lookups return the same
+    columns as the live queries, for bill dates before complete_before().
+    """
+
+    def __init__(self, path, lag_days=DEFAULT_LAG_DAYS, retention_days=RETENTION_DAYS):
+        self.path = path
+        self.lag_days = lag_days
+        self.retention_days = retention_days
+        self._refresh_lock = threading.Lock()
+        self._closed = threading.Event()
+        self.last_refresh = None
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            (version,) = db.execute("PRAGMA user_version").fetchone()
+            if version < SCHEMA_VERSION:
+                # Lines without normalized keys: drop them, the next refresh reloads the window
+                db.execute("DROP TABLE IF EXISTS sales_lines")
+                db.execute("DROP TABLE IF EXISTS meta")
+            db.executescript(SCHEMA)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _read_meta(self, db, key):
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def complete_before(self):
+        """
+        Returns:
+            datetime.date: Bills dated before this are in the snapshot (None before the first refresh)
+        """
+        db = self._connect()
+        try:
+            value = self._read_meta(db, "complete_before")
+        finally:
+            db.close()
+        return datetime.date.fromisoformat(value) if value else None
+
+    def status(self):
+        """
+        Returns:
+            dict: lines, stores, oldest / newest bill date, complete_before
+        """
+        db = self._connect()
+        try:
+            lines, oldest, newest = db.execute(
+                "SELECT COUNT(*), MIN(bill_date), MAX(bill_date) FROM sales_lines"
+            ).fetchone()
+            (stores,) = db.execute("SELECT COUNT(*) FROM stores").fetchone()
+            complete_before = self._read_meta(db, "complete_before")
+        finally:
+            db.close()
+        return {"lines": lines, "stores": stores, "oldest": oldest, "newest": newest,
+                "complete_before": complete_before}
+
+    def refresh(self, conn, rebuild=False, today=None, log=print):
+        """
+        Load the days between the stored watermark and today - lag_days.
+
+        Parameters:
+            conn: Active MySQL connection object (a replica is fine)
+            rebuild (bool): Drop the snapshot and load the whole retention window
+            today (datetime.date): For tests; defaults to today
+            log (callable): Receives one progress line per loaded day
+
+        Returns:
+            int: Sales lines loaded
+        """
+        today = today or datetime.date.today()
+        window_start = today - datetime.timedelta(days=self.retention_days)
+        target = today - datetime.timedelta(days=self.lag_days)
+        loaded = 0
+        with self._refresh_lock:
+            db = self._connect()
+            try:
+                stores = fetch_dataframe(conn, "SELECT id, store_full_name FROM tbl_store_data")
+                with db:
+                    db.execute("DELETE FROM stores")
+                    db.executemany("INSERT INTO stores (id, store_full_name) VALUES (?, ?)",
+                                   stores.itertuples(index=False, name=None))
+                    if rebuild:
+                        db.execute("DELETE FROM sales_lines")
+                        db.execute("DELETE FROM meta WHERE key = 'complete_before'")
+                    db.execute("DELETE FROM sales_lines WHERE bill_date < ?", (window_start.isoformat(),))
+
+                watermark = self._read_meta(db, "complete_before")
+                day = max(datetime.date.fromisoformat(watermark), window_start) if watermark else window_start
+                while day < target:
+                    next_day = day + datetime.timedelta(days=1)
+                    rows = fetch_dataframe(conn, SNAPSHOT_QUERY, (day, next_day), dtypes={"sold_qty": "float64"})
+                    # One transaction per day: an interrupted refresh resumes from the last full day
+                    with db:
+                        db.executemany(
+                            f"INSERT INTO sales_lines ({', '.join(SNAPSHOT_COLUMNS)}, bill_key, combination_key, barcode_key) "
+                            f"VALUES ({', '.join(['?'] * (len(SNAPSHOT_COLUMNS) + 3))})",
+                            ((int(outlet), bill, number, _iso(date), combination, barcode, design, float(qty),
+                              match_key(bill), match_key(combination), match_key(barcode))
+                             for outlet, bill, number, date, combination, barcode, design, qty
+                             in rows[SNAPSHOT_COLUMNS].itertuples(index=False, name=None)),
+                        )
+                        db.execute(
+                            "INSERT OR REPLACE INTO meta (key, value) VALUES ('complete_before', ?)",
+                            (next_day.isoformat(),),
+                        )
+                    loaded += len(rows)
+                    log(f"  {day}: {len(rows)} lines")
+                    day = next_day
+            finally:
+                db.close()
+            self.last_refresh = time.time()
+        return loaded
+
+    def start_refresh(self, connection_factory, interval):
+        """
+        Run refresh() every `interval` seconds in a daemon thread until close().
+
+        connection_factory() must return a context manager yielding a
+        connection, e.g. pool.connection.
+        """
+        def run():
+            while True:
+                try:
+                    with connection_factory() as conn:
+                        self.refresh(conn, log=lambda line: None)
+                except Exception:
+                    pass
+                if self._closed.wait(interval):
+                    return
+
+        thread = threading.Thread(target=run, name="sales-snapshot-refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self._closed.set()
+
+    def _lookup(self, query, key_columns, key_tuples, outlet_ids, days):
+        # Keys go into a TEMP table of this connection, like db_query.staged_keys()
+        start = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+        column_list = ", ".join(key_columns)
+        db = self._connect()
+        try:
+            column_defs = ", ".join(f"{name} {sql_type}" for name, sql_type in key_columns.items())
+            db.execute(f"CREATE TEMP TABLE upload_keys ({column_defs})")
+            # De-duplicated before normalizing, as staged_keys() does for the live query
+            text_columns = [sql_type == "TEXT" for sql_type in key_columns.values()]
+            db.executemany(
+                f"INSERT INTO upload_keys VALUES ({', '.join(['?'] * len(key_columns))})",
+                (
+                    tuple(match_key(value) if is_text else value for value, is_text in zip(key, text_columns))
+                    for key in dict.fromkeys(tuple(key) for key in key_tuples)
+                ),
+            )
+            db.execute(f"CREATE INDEX temp.idx_upload_keys ON upload_keys ({column_list})")
+            outlet_placeholders = ", ".join(["?"] * len(outlet_ids))
+            return pd.read_sql_query(
+                query.format(outlet_placeholders=outlet_placeholders),
+                db,
+                params=[start] + [int(outlet) for outlet in outlet_ids],
+            )
+        finally:
+            db.close()
+
+    def rtv_sales(self, key_tuples, outlet_ids, days=180):
+        """Columns of the live RTV validation query for (outlets_id, bill_no, combination_id, barcode) keys."""
+        return self._lookup(
+            """
+            SELECT s.store_full_name AS stores, l.gst_bill_no AS `bill no`, l.combination_id, l.barcode,
+                   SUM(l.sold_qty) AS db_qty
+            FROM sales_lines l
+            INNER JOIN stores s ON s.id = l.outlets_id
+            INNER JOIN upload_keys k ON k.outlets_id = l.outlets_id AND k.bill_no = l.bill_key
+                AND k.combination_id = l.combination_key AND k.barcode = l.barcode_key
+            WHERE l.bill_date >= ? AND l.outlets_id IN ({outlet_placeholders})
+            GROUP BY s.store_full_name, l.gst_bill_no, l.combination_id, l.barcode
+            """,
+            SNAPSHOT_RTV_KEY_COLUMNS, key_tuples, outlet_ids, days,
+        )
+
+    def rto_sales(self, key_tuples, outlet_ids, days=120):
+        """Columns of the live RTO validation query for (outlets_id, bill_no) keys."""
+        df = self._lookup(
+            """
+            SELECT s.store_full_name AS stores, l.gst_bill_no AS `bill no`, l.combination_id, l.bill_date,
+                   l.bill_number, l.design_number AS `design numbers`, SUM(l.sold_qty) AS qty, l.barcode
+            FROM sales_lines l
+            INNER JOIN stores s ON s.id = l.outlets_id
+            INNER JOIN upload_keys k ON k.outlets_id = l.outlets_id AND k.bill_no = l.bill_key
+            WHERE l.bill_date >= ? AND l.outlets_id IN ({outlet_placeholders})
+            GROUP BY s.store_full_name, l.gst_bill_no, l.combination_id, l.bill_date, l.bill_number,
+                     l.design_number, l.barcode
+            """,
+            SNAPSHOT_RTO_KEY_COLUMNS, key_tuples, outlet_ids, days,
+        )
+        df["bill_date"] = pd.to_datetime(df["bill_date"]).dt.date
+        return df
+
+    def check_rtv_parity(self, conn, sample=200, seed=None):
+        """
+        Compare rtv_sales() with the live RTV query for `sample` keys taken
+        from the snapshot, each sent as stored, upper-cased or with a
+        trailing space (MySQL matches all three).
+
+        Returns:
+            pd.DataFrame: stores, bill no, combination_id, barcode, snapshot_qty,
+            live_qty of the groups whose quantities differ (empty when they agree)
+        """
+        complete_before = self.complete_before()
+        if complete_before is None:
+            raise ValueError("The snapshot has not been refreshed yet")
+        db = self._connect()
+        try:
+            rows = db.execute(
+                """
+                SELECT outlets_id, gst_bill_no, combination_id, barcode
+                FROM (SELECT DISTINCT outlets_id, bill_key, combination_key, barcode_key,
+                             gst_bill_no, combination_id, barcode
+                      FROM sales_lines WHERE bill_date >= ?)
+                GROUP BY outlets_id, bill_key, combination_key, barcode_key
+                ORDER BY RANDOM() LIMIT ?
+                """,
+                ((datetime.date.today() - datetime.timedelta(days=180)).isoformat(), sample),
+            ).fetchall()
+        finally:
+            db.close()
+        if not rows:
+            return pd.DataFrame(columns=["stores", "bill no", "combination_id", "barcode", "snapshot_qty", "live_qty"])
+
+        rng = random.Random(seed)
+        variants = [str, lambda value: value.upper(), lambda value: value + " "]
+        key_tuples = [
+            (outlet,) + tuple(rng.choice(variants)(str(value)) for value in key)
+            for outlet, *key in rows
+        ]
+        outlet_ids = sorted({key[0] for key in key_tuples})
+
+        group = ["stores", "bill no", "combination_id", "barcode"]
+
+        def totals(df):
+            # Quantity per group, the text keys compared as match_key() does
+            keyed = df.assign(**{col: df[col].map(match_key) for col in group[1:]})
+            return keyed.groupby(group)["db_qty"].sum()
+
+        # Live rows dated before the watermark: all of them minus those from it on
+        live = totals(fetch_rtv_sales(conn, key_tuples, outlet_ids)).sub(
+            totals(fetch_rtv_sales(conn, key_tuples, outlet_ids, since=complete_before)), fill_value=0
+        )
+        compared = pd.concat(
+            [totals(self.rtv_sales(key_tuples, outlet_ids)).rename("snapshot_qty"), live.rename("live_qty")], axis=1
+        ).fillna(0)
+        return compared[compared["snapshot_qty"] != compared["live_qty"]].reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "refresh", "check"])
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH)
+    parser.add_argument("--path", default=None, help="Default: [sales_snapshot] path in secrets")
+    parser.add_argument("--rebuild", action="store_true", help="Reload the whole retention window")
+    parser.add_argument("--replica", action="store_true", help="Read from db_config_replica")
+    parser.add_argument("--sample", type=int, default=200, help="check: keys to compare")
+    args = parser.parse_args()
+
+    secrets = load_secrets(args.secrets)
+    snapshot_config = secrets.get("sales_snapshot", {})
+    path = args.path or snapshot_config.get("path")
+    if not path:
+        raise SystemExit("❌ No snapshot file: pass --path or set [sales_snapshot] path")
+    snapshot = SalesSnapshot(path, lag_days=int(snapshot_config.get("lag_days", DEFAULT_LAG_DAYS)))
+    if args.command == "status":
+        for name, value in snapshot.status().items():
+            print(f"{name + ':':<17}{value}")
+        print(f"{'file size:':<17}{os.path.getsize(path) / 1024 ** 2:.1f} MB")
+        return
+
+    conn = mysql.connector.connect(**secrets["db_config_replica" if args.replica else "db_config"])
+    try:
+        if args.command == "check":
+            mismatches = snapshot.check_rtv_parity(conn, sample=args.sample)
+            if len(mismatches):
+                print(mismatches.to_string(index=False))
+                raise SystemExit(f"❌ {len(mismatches)} key(s) differ from the live RTV query")
+            print(f"✅ Snapshot matches the live RTV query on {args.sample} sampled key(s)")
+            return
+        started = time.perf_counter()
+        loaded = snapshot.refresh(conn, rebuild=args.rebuild)
+    finally:
+        conn.close()
+    print(f"✅ Loaded {loaded:,} sales line(s) in {time.perf_counter() - started:.1f}s; "
+          f"complete before {snapshot.complete_before()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Live RTV / RTO validation queries against tbl_sales and minimized_sales_register.
+
+The upload pages call them through the app's fetch_*_validation() (live only,
+or live for the bills the sales snapshot does not cover yet);
+sales_snapshot.py compares its own lookups with them (`check`).
+"""
+from db_query import fetch_dataframe, staged_keys
+
+# Staged upload keys; (table, column) entries copy the production column's type and collation
+RTV_KEY_COLUMNS = {
+    "outlets_id": "INT",
+    "bill_no": ("minimized_sales_register", "GST_bill_number"),
+    "combination_id": ("tbl_sales", "combination_id"),
+    "barcode": ("tbl_sales", "barcode"),
+}
+RTO_KEY_COLUMNS = {"outlets_id": "INT", "bill_no": ("minimized_sales_register", "GST_bill_number")}
+
+
+# RTV validation: one query that validates store mapping AND gets qty sold for each
+# uploaded (store id, bill, combination_id, barcode); the keys are staged in a
+# temporary table and joined instead of a huge IN list. `since` limits it to
+# bills from that date on (the part not covered by the sales snapshot).
+def fetch_rtv_sales(conn, key_tuples, outlet_ids, since=None):
+    query = """
+        SELECT 
+            t2.store_full_name as stores, 
+            msr.GST_bill_number as `bill no`, 
+            t1.combination_id, 
+            t1.barcode,
+            SUM(t1.sold_qty) AS db_qty
+        FROM tbl_sales t1 
+        INNER JOIN minimized_sales_register msr 
+            ON t1.bill_number = msr.bill_number AND t1.bill_date = msr.bill_date
+        INNER JOIN tbl_store_data t2 
+            ON t1.outlets_id = t2.id
+        INNER JOIN {keys} k
+            ON k.outlets_id = t1.outlets_id AND k.bill_no = msr.GST_bill_number
+            AND k.combination_id = t1.combination_id AND k.barcode = t1.barcode
+        WHERE t1.outlets_id IN ({outlet_placeholders})
+        AND t1.bill_date >= CURDATE() - INTERVAL 180 DAY
+        {since_filter}
+        GROUP BY t2.store_full_name, msr.GST_bill_number, t1.combination_id, t1.barcode;
+    """
+    since_filter = "AND t1.bill_date >= %s" if since is not None else ""
+    with staged_keys(conn, "tmp_rtv_keys", RTV_KEY_COLUMNS, key_tuples) as keys:
+        return fetch_dataframe(
+            conn,
+            query.format(
+                keys=keys, outlet_placeholders=",".join(["%s"] * len(outlet_ids)), since_filter=since_filter
+            ),
+            list(outlet_ids) + ([since] if since is not None else []),
+            dtypes={"db_qty": "float64"},
+        )
+
+
+# RTO validation: query that validates BOTH store AND GST bill number and returns
+# the items sold on each bill, joined against the staged keys (`since` as for RTV)
+def fetch_rto_sales(conn, key_tuples, outlet_ids, since=None):
+    query = """
+        SELECT DISTINCT 
+            t3.store_full_name as stores,
+            t1.GST_bill_number as `bill no`,
+            t2.combination_id, 
+            t1.bill_date, 
+            t1.bill_number,
+            t2.design_number as `design numbers`, 
+            SUM(t2.sold_qty) as qty, 
+            t2.barcode
+        FROM minimized_sales_register t1
+        INNER JOIN tbl_sales t2 
+            ON t1.bill_number = t2.bill_number AND t1.bill_date = t2.bill_date
+        INNER JOIN tbl_store_data t3
+            ON t2.outlets_id = t3.id
+        INNER JOIN {keys} k
+            ON k.outlets_id = t2.outlets_id AND k.bill_no = t1.GST_bill_number
+        WHERE t2.outlets_id IN ({outlet_placeholders})
+        AND t1.bill_date >= curdate() - INTERVAL 120 DAY
+        AND t2.bill_date >= curdate() - INTERVAL 120 DAY
+        {since_filter}
+        GROUP BY t3.store_full_name, t1.GST_bill_number, t2.combination_id, 
+                t1.bill_date, t1.bill_number, t2.design_number, t2.barcode;
+    """
+    since_filter = "AND t2.bill_date >= %s" if since is not None else ""
+    with staged_keys(conn, "tmp_rto_keys", RTO_KEY_COLUMNS, key_tuples) as keys:
+        return fetch_dataframe(
+            conn,
+            query.format(
+                keys=keys, outlet_placeholders=",".join(["%s"] * len(outlet_ids)), since_filter=since_filter
+            ),
+            list(outlet_ids) + ([since] if since is not None else []),
+        )
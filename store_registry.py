@@ -0,0 +1,97 @@
+"""
+Store metadata from tbl_wh_store_config and tbl_store_data in one object.
+
+The upload pages, the config page and the SR/TO reports all look stores up
+by name. A StoreRegistry loads both tables once and answers those lookups
+from dicts keyed by the normalized name (stripped, lower case); the app
+keeps it in its change-log cache, so it is reloaded only after a write
+bumps tbl_wh_store_config (update_store_config, the upload commit).
+"""
+import time
+
+import pandas as pd
+
+from db_query import fetch_dataframe
+
+STORE_CONFIG_QUERY = "SELECT store_name, config, max_to, address FROM tbl_wh_store_config"
+STORE_DATA_QUERY = "SELECT id, store_full_name FROM tbl_store_data"
+
+
+def normalize_store(name):
+    return str(name).strip().lower()
+
+
+def parse_to_numbers(rows):
+    """Last TO sequence per store from (store_name, max_to) rows with max_to values like 'TO123'."""
+    return {name: int(max_to[2:]) for name, max_to in rows if isinstance(max_to, str) and max_to}
+
+
+class StoreRegistry:
+    """
+    Read-only snapshot of the store tables.
+
+    Parameters:
+        config (pd.DataFrame): store_name, config, max_to, address rows of tbl_wh_store_config
+        store_data (pd.DataFrame): id, store_full_name rows of tbl_store_data
+    """
+
+    def __init__(self, config, store_data, clock=time.monotonic):
+        self.loaded_at = clock()
+        self._clock = clock
+        # Sorted, one row per configured store (the last row wins, as dict(...) did before)
+        self.frame = (
+            config.drop_duplicates("store_name", keep="last")
+            .sort_values("store_name", key=lambda names: names.str.lower(), kind="stable")
+            .reset_index(drop=True)
+        )
+        names = self.frame["store_name"].tolist()
+        keys = [normalize_store(name) for name in names]
+        self.names = names
+        self.canonical = dict(zip(keys, names))
+        # config = 1, compared as MySQL would when the column holds text
+        self.active = set(self.frame.loc[pd.to_numeric(self.frame["config"], errors="coerce") == 1, "store_name"])
+        self.addresses = dict(zip(keys, self.frame["address"]))
+        self.to_numbers = parse_to_numbers(zip(names, self.frame["max_to"]))
+        self.store_ids = {
+            normalize_store(name): store_id
+            for store_id, name in store_data[["id", "store_full_name"]].itertuples(index=False, name=None)
+            if name is not None
+        }
+
+    @classmethod
+    def load(cls, conn):
+        """Read both tables on `conn` (two queries)."""
+        config = fetch_dataframe(conn, STORE_CONFIG_QUERY)
+        store_data = fetch_dataframe(conn, STORE_DATA_QUERY)
+        return cls(config, store_data)
+
+    def age(self):
+        return self._clock() - self.loaded_at
+
+    def canonical_name(self, name):
+        """Configured spelling of `name`, or None for an unconfigured store."""
+        return self.canonical.get(normalize_store(name))
+
+    @property
+    def case_mapping(self):
+        """Normalized store name (normalize_store) -> store name as configured, like canonical_name()."""
+        return dict(self.canonical)
+
+    @property
+    def active_stores(self):
+        """Names of stores with config = 1."""
+        return [name for name in self.names if name in self.active]
+
+    def is_active(self, name):
+        return self.canonical_name(name) in self.active
+
+    def address(self, name):
+        return self.addresses.get(normalize_store(name))
+
+    def store_id(self, name):
+        """tbl_store_data.id for store_full_name `name` (case-insensitive), or None."""
+        return self.store_ids.get(normalize_store(name))
+
+    def config_frame(self):
+        """store_name, config per store, for the config page (a copy: the registry is shared)."""
+        return self.frame[["store_name", "config"]].copy()
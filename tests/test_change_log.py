@@ -0,0 +1,83 @@
+from contextlib import contextmanager
+
+import change_log
+from change_log import SALES_RETURNS, SALES_RETURNS_HIDDEN, STORE_CONFIG, VersionedCache, hidden_version
+
+
+class FakePool:
+    @contextmanager
+    def connection(self):
+        yield object()
+
+
+class Versions:
+    """Stands in for fetch_versions(): the change-log rows, counting reads."""
+
+    def __init__(self, **versions):
+        self.versions = versions
+        self.reads = 0
+
+    def __call__(self, conn):
+        self.reads += 1
+        return dict(self.versions)
+
+
+def make_cache(monkeypatch, versions, check_interval=2.0):
+    now = [0.0]
+    monkeypatch.setattr(change_log, "fetch_versions", versions)
+    return VersionedCache(FakePool(), check_interval=check_interval, clock=lambda: now[0]), now
+
+
+def test_hit_until_the_version_changes(monkeypatch):
+    versions = Versions(**{STORE_CONFIG: 1, SALES_RETURNS: 7})
+    cache, now = make_cache(monkeypatch, versions)
+    loads = []
+
+    def loader(conn):
+        loads.append(conn)
+        return len(loads)
+
+    assert cache.get("stores", [STORE_CONFIG], loader) == 1
+    assert cache.get("stores", [STORE_CONFIG], loader) == 1
+    # Another entity moving on does not reload
+    versions.versions[SALES_RETURNS] = 8
+    now[0] = 5.0
+    assert cache.get("stores", [STORE_CONFIG], loader) == 1
+    versions.versions[STORE_CONFIG] = 2
+    now[0] = 10.0
+    assert cache.get("stores", [STORE_CONFIG], loader) == 2
+    assert cache.stats() == {"checks": 3, "hits": 2, "loads": 2, "entries": 1}
+
+
+def test_versions_are_read_once_per_interval(monkeypatch):
+    versions = Versions(**{STORE_CONFIG: 1})
+    cache, now = make_cache(monkeypatch, versions)
+    cache.get("stores", [STORE_CONFIG], lambda conn: "a")
+    versions.versions[STORE_CONFIG] = 2
+    now[0] = 1.0
+    # Within check_interval the old version is still trusted
+    assert cache.get("stores", [STORE_CONFIG], lambda conn: "b") == "a"
+    assert versions.reads == 1
+    cache.refresh()
+    assert cache.get("stores", [STORE_CONFIG], lambda conn: "b") == "b"
+    assert versions.reads == 2
+
+
+def test_unversioned_entities_and_invalidate_reload(monkeypatch):
+    cache, _ = make_cache(monkeypatch, Versions(**{STORE_CONFIG: 1}))
+    loads = []
+    loader = lambda conn: loads.append(conn) or len(loads)
+    # Not in the change log (e.g. before its migration): never cached
+    assert cache.get("sales", [SALES_RETURNS], loader) == 1
+    assert cache.get("sales", [SALES_RETURNS], loader) == 2
+    assert cache.get("stores", [STORE_CONFIG], loader) == 3
+    cache.invalidate("stores")
+    assert cache.get("stores", [STORE_CONFIG], loader) == 4
+
+
+def test_hidden_version():
+    assert hidden_version({SALES_RETURNS_HIDDEN: 4, SALES_RETURNS: 9}) == 4
+    assert hidden_version({SALES_RETURNS: 9}) is None
+    # Before migration 5: stable within one max_age window, new in the next
+    assert hidden_version({}, max_age=900, clock=lambda: 1000.0) == hidden_version({}, max_age=900, clock=lambda: 1700.0)
+    assert hidden_version({}, max_age=900, clock=lambda: 1000.0) != hidden_version({}, max_age=900, clock=lambda: 1900.0)
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.alive = True
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        if not self.alive:
+            raise ConnectionError("server has gone away")
+        self.rollbacks += 1
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            raise ConnectionError("server has gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnect:
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self, **config):
+        conn = FakeConnection(len(self.opened) + 1)
+        self.opened.append(conn)
+        return conn
+
+
+def make_pool(size=1, checkout_timeout=1.0, **kwargs):
+    connect = FakeConnect()
+    return ConnectionPool({}, size=size, checkout_timeout=checkout_timeout, connect=connect, **kwargs), connect
+
+
+def test_checkout_reuses_the_returned_connection():
+    pool, connect = make_pool(size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    assert len(connect.opened) == 1
+    assert first.rollbacks == 2
+    stats = pool.stats()
+    assert (stats["checkouts"], stats["opened"], stats["idle"], stats["in_use"]) == (2, 1, 1, 0)
+
+
+def test_checkout_times_out_when_every_connection_is_busy():
+    pool, _ = make_pool(size=1, checkout_timeout=0.1)
+    with pool.connection():
+        started = time.perf_counter()
+        with pytest.raises(PoolTimeout):
+            with pool.connection():
+                pass
+        assert time.perf_counter() - started >= 0.1
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_discard_wakes_a_waiter():
+    pool, connect = make_pool(size=1, checkout_timeout=5.0)
+    got = []
+
+    def wait_for_connection():
+        with pool.connection() as conn:
+            got.append((conn, time.perf_counter()))
+
+    with pool.connection() as conn:
+        waiter = threading.Thread(target=wait_for_connection)
+        waiter.start()
+        time.sleep(0.1)
+        # A failed rollback discards the connection and frees its slot
+        conn.alive = False
+        released = time.perf_counter()
+    waiter.join(2.0)
+
+    assert not waiter.is_alive()
+    (new_conn, woken), = got
+    assert new_conn is not conn and conn.closed
+    assert woken - released < 1.0
+    assert len(connect.opened) == 2
+    assert pool.stats()["discarded"] == 1
+
+
+def test_stale_connection_is_replaced_on_checkout():
+    now = [0.0]
+    pool, connect = make_pool(size=1, ping_after_idle=60, clock=lambda: now[0])
+    with pool.connection() as conn:
+        pass
+    conn.alive = False
+    now[0] = 61.0
+    with pool.connection() as fresh:
+        assert fresh is not conn
+    assert conn.closed
+    stats = pool.stats()
+    assert (stats["stale_replaced"], stats["opened"], stats["pings"]) == (1, 1, 1)
@@ -0,0 +1,69 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from dup_keys import key_hashes, key_hashes64, upload_key_hashes64, visible_sql, VISIBLE_RETURN_SQL
+from returned_qty import return_key_hashes
+
+# MD5 of CONCAT_WS(CHAR(31), ...) as the server computes it for the stored row
+# 2024-01-05 / 'Store A' / 'GST/1' / 'C1' / '8901234' (duplicate key) and
+# 'Store A' / 'GST/1' / 'C1' / '8901234' (ledger key)
+DUP_KEY_MD5 = "0ddbbc4eb2d1d629e0d37ea6c262ba5f"
+DUP_KEY_MD5_NO_COMBINATION = "4e5f35e00272fec9765fe054028543ca"
+RETURN_KEY_MD5 = "e1e3412ba44c6b9a76cded548f373f01"
+
+
+def returns_frame(rows):
+    return pd.DataFrame(rows, columns=["return_date", "outlet_name", "bill_no", "combination_id", "barcode"])
+
+
+def test_fixed_vectors_match_the_sql_expression():
+    assert hashlib.md5("2024-01-05\x1fstore a\x1fgst/1\x1fc1\x1f8901234".encode()).hexdigest() == DUP_KEY_MD5
+    hashes = key_hashes(returns_frame([("2024-01-05", "Store A", "GST/1", "C1", "8901234")]))
+    assert hashes.iloc[0].hex() == DUP_KEY_MD5
+
+
+def test_duplicate_key_normalization():
+    hashes = key_hashes(returns_frame([
+        # Case, spaces around values (TRIM) and a DATETIME return date
+        (pd.Timestamp("2024-01-05 13:45"), "  STORE a ", "gst/1 ", " c1", "8901234 "),
+        # A barcode parsed as a number by a spreadsheet read
+        ("2024-01-05", "Store A", "GST/1", "C1", 8901234.0),
+        # NULL combination: CONCAT_WS skips it, separator included
+        ("2024-01-05", "Store A", "GST/1", None, "8901234"),
+        ("2024-01-05", "Store A", "GST/1", np.nan, "8901234"),
+        # TRIM strips spaces only
+        ("2024-01-05", "\tStore A", "GST/1", "C1", "8901234"),
+    ]))
+    assert [h.hex() for h in hashes] == [
+        DUP_KEY_MD5, DUP_KEY_MD5, DUP_KEY_MD5_NO_COMBINATION, DUP_KEY_MD5_NO_COMBINATION,
+        hashlib.md5("2024-01-05\x1f\tstore a\x1fgst/1\x1fc1\x1f8901234".encode()).hexdigest(),
+    ]
+
+
+def test_hash64_is_the_md5_prefix():
+    df = returns_frame([("2024-01-05", "Store A", "GST/1", "C1", "8901234")])
+    # CAST(CONV(LEFT(md5, 16), 16, 10) AS UNSIGNED)
+    assert key_hashes64(df).tolist() == [int(DUP_KEY_MD5[:16], 16)]
+    uploaded = pd.DataFrame(
+        [("2024-01-05", "store a", "GST/1", "C1", "8901234")],
+        columns=["date", "stores", "bill no", "combination_id", "barcode"],
+    )
+    assert upload_key_hashes64(uploaded).tolist() == [int(DUP_KEY_MD5[:16], 16)]
+
+
+def test_return_key_vectors():
+    stored = pd.DataFrame(
+        [("Store A", "GST/1", "C1", "8901234")], columns=["outlet_name", "bill_no", "combination_id", "barcode"]
+    )
+    uploaded = pd.DataFrame(
+        [(" store a", "GST/1 ", "c1", 8901234.0)], columns=["stores", "bill no", "combination_id", "barcode"]
+    )
+    assert return_key_hashes(stored).iloc[0].hex() == RETURN_KEY_MD5
+    assert return_key_hashes(uploaded, upload_columns=True).iloc[0].hex() == RETURN_KEY_MD5
+
+
+def test_visible_sql():
+    assert VISIBLE_RETURN_SQL == "COALESCE(hidden, 0) <> 1"
+    assert visible_sql("t") == "COALESCE(t.hidden, 0) <> 1"
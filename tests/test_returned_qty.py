@@ -0,0 +1,47 @@
+import pandas as pd
+
+from returned_qty import add_returned_qty, ledger_rows, return_key_hashes
+
+
+class LedgerCursor:
+    """Applies add_returned_qty()'s upserts to a dict instead of tbl_wh_returned_qty."""
+
+    def __init__(self):
+        self.ledger = {}
+
+    def execute(self, query, params=()):
+        assert "ON DUPLICATE KEY UPDATE returned_qty = returned_qty + VALUES(returned_qty)" in query
+        for start in range(0, len(params), 6):
+            key_hash, *_, qty = params[start:start + 6]
+            self.ledger[key_hash] = self.ledger.get(key_hash, 0) + qty
+
+
+def returns_frame(rows):
+    # sr_df as built by the upload pages (database column names)
+    return pd.DataFrame(rows, columns=["outlet_name", "bill_no", "combination_id", "barcode", "Sold_qty"])
+
+
+def test_ledger_sums_sold_qty_per_key():
+    rows = ledger_rows(returns_frame([
+        ("Store A", "GST/1", "C1", "B1", 2),
+        ("store a ", "gst/1", "c1", "b1", 1),
+        ("Store A", "GST/2", "C1", "B1", None),
+    ]))
+    assert sorted(row[-1] for row in rows) == [0, 3]
+    assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+
+
+def test_multi_qty_rto_blocks_later_rtv():
+    # Two units sold; one RTO line returns both of them
+    sold_qty = 2
+    cursor = LedgerCursor()
+    add_returned_qty(cursor, returns_frame([("Store A", "GST/1", "C1", "8901234", 2)]))
+
+    # An RTV line for the same key (upload column names) must now exceed the sold quantity
+    rtv_upload = pd.DataFrame(
+        [("STORE A", "gst/1 ", "C1", "8901234")], columns=["stores", "bill no", "combination_id", "barcode"]
+    )
+    already_returned = return_key_hashes(rtv_upload, upload_columns=True).map(cursor.ledger).fillna(0).astype(int)
+    assert already_returned.tolist() == [2]
+    assert (len(rtv_upload) + already_returned > sold_qty).all()
+
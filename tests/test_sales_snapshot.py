@@ -0,0 +1,46 @@
+import datetime
+
+import pandas as pd
+
+import sales_snapshot
+from sales_snapshot import SalesSnapshot, match_key
+
+TODAY = datetime.date.today()
+SALE_DAY = TODAY - datetime.timedelta(days=3)
+
+
+def test_match_key():
+    assert match_key("GST/1  ") == "gst/1"
+    # Leading spaces are significant under PAD SPACE
+    assert match_key("  GST/1") == "  gst/1"
+    assert match_key(8901234.0) == "8901234"
+    assert match_key(8901234) == "8901234"
+    assert match_key(None) is None
+
+
+def fake_fetch_dataframe(conn, query, params=None, dtypes=None):
+    if "tbl_store_data" in query:
+        return pd.DataFrame([(1, "Store A")], columns=["id", "store_full_name"])
+    day, _ = params
+    rows = [(1, "GST/1 ", "B-1", SALE_DAY, "C1", "8901234", "D1", 2.0)] if day == SALE_DAY else []
+    return pd.DataFrame(rows, columns=sales_snapshot.SNAPSHOT_COLUMNS)
+
+
+def make_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(sales_snapshot, "fetch_dataframe", fake_fetch_dataframe)
+    snapshot = SalesSnapshot(str(tmp_path / "sales.sqlite3"), retention_days=7)
+    assert snapshot.refresh(object(), today=TODAY, log=lambda line: None) == 1
+    return snapshot
+
+
+def test_rtv_keys_match_case_and_trailing_spaces(tmp_path, monkeypatch):
+    snapshot = make_snapshot(tmp_path, monkeypatch)
+    df = snapshot.rtv_sales([(1, "gst/1", "c1", "8901234 "), (1, "GST/2", "C1", "8901234")], [1])
+    assert df[["stores", "bill no", "barcode", "db_qty"]].values.tolist() == [["Store A", "GST/1 ", "8901234", 2.0]]
+
+
+def test_rto_keys_match_by_bill(tmp_path, monkeypatch):
+    snapshot = make_snapshot(tmp_path, monkeypatch)
+    df = snapshot.rto_sales([(1, "Gst/1"), (2, "GST/1")], [1, 2])
+    assert df[["stores", "bill_number", "qty"]].values.tolist() == [["Store A", "B-1", 2.0]]
+    assert df["bill_date"].tolist() == [SALE_DAY]